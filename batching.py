@@ -0,0 +1,93 @@
+"""
+Adaptive batch sizing for database loads
+
+Picks the number of rows per commit from the measured commit latency, aiming for a target transaction
+duration: grows while the server keeps up, shrinks when commits run long (EG lock waits) or fail.
+One controller per database config is kept for the whole run, so what is learnt on one scroll page
+carries over to the next.
+"""
+
+import threading
+
+TARGET_SECONDS = 2.0         # aim for commits of about this long
+MIN_ROWS = 100
+MAX_ROWS = 100000
+INITIAL_ROWS = 2000
+MAX_BATCH_BYTES = 64 * 1024 * 1024
+MAX_GROWTH = 2.0             # grow by at most this factor per batch
+SLOW_FACTOR = 2.0            # a commit this many times over target is treated as a stall - halve at once
+SMOOTHING = 0.5              # weight of the newest measurement
+
+_BATCHERS = {}
+_BATCHERS_LOCK = threading.Lock()
+
+
+class AdaptiveBatcher:
+    """
+    :param target_seconds: target commit duration
+    :param min_rows: never go below this batch size
+    :param max_rows: never go above this batch size
+    :param initial_rows: first batch size, before any measurement
+    :param max_batch_bytes: cap on estimated bytes per batch (rows x row width)
+    """
+    def __init__(self, target_seconds=TARGET_SECONDS, min_rows=MIN_ROWS, max_rows=MAX_ROWS, initial_rows=INITIAL_ROWS,
+                 max_batch_bytes=MAX_BATCH_BYTES):
+        self.target_seconds = float(target_seconds)
+        self.min_rows = int(min_rows)
+        self.max_rows = int(max_rows)
+        self.max_batch_bytes = int(max_batch_bytes)
+        self.rows = self._clamp(int(initial_rows))
+        self.row_bytes = None
+        self.lock = threading.Lock()
+
+    def _clamp(self, rows, row_bytes=None):
+        if row_bytes:
+            rows = min(rows, int(self.max_batch_bytes / row_bytes))
+        return max(self.min_rows, min(self.max_rows, int(rows)))
+
+    def next_size(self):
+        with self.lock:
+            return self.rows
+
+    def record(self, rows, seconds, row_bytes=None):
+        """
+        Feed back a committed batch - rows committed, commit duration and estimated bytes per row
+        """
+        if rows <= 0:
+            return
+        with self.lock:
+            if row_bytes:
+                self.row_bytes = row_bytes
+            if seconds > self.target_seconds * SLOW_FACTOR:
+                new_rows = self.rows / 2
+            else:
+                rate = rows / max(seconds, 1e-6)
+                ideal = rate * self.target_seconds
+                new_rows = SMOOTHING * ideal + (1 - SMOOTHING) * self.rows
+                new_rows = min(new_rows, self.rows * MAX_GROWTH)
+            self.rows = self._clamp(new_rows, self.row_bytes)
+
+    def on_error(self):
+        """
+        A batch failed with a retryable error (lock timeout, deadlock ...) - halve the batch size
+        :return: the new batch size
+        """
+        with self.lock:
+            self.rows = self._clamp(self.rows / 2, self.row_bytes)
+            return self.rows
+
+
+def get_batcher(key, params=None):
+    """
+    The run-wide controller for key (a database config), created on first use from the config params:
+        batchtarget (seconds), batchmin, batchmax, batchinitial, batchmaxbytes
+    """
+    params = params or {}
+    with _BATCHERS_LOCK:
+        if key not in _BATCHERS:
+            _BATCHERS[key] = AdaptiveBatcher(target_seconds=params.get("batchtarget", TARGET_SECONDS),
+                                             min_rows=params.get("batchmin", MIN_ROWS),
+                                             max_rows=params.get("batchmax", MAX_ROWS),
+                                             initial_rows=params.get("batchinitial", INITIAL_ROWS),
+                                             max_batch_bytes=params.get("batchmaxbytes", MAX_BATCH_BYTES))
+        return _BATCHERS[key]
@@ -0,0 +1,9 @@
+"""
+Extract / load benchmark harness
+
+Serves synthetic job-accounting docs from a local fake ElasticSearch and runs the real extract path
+into a CSV file, the terminal, a Postgres database config or a recording stub, reporting rows/sec,
+per-stage latency percentiles and peak RSS.
+
+    $> python -m bench --docs 10000,100000 --sinks csv,stub
+"""
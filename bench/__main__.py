@@ -0,0 +1,254 @@
+"""
+Benchmark CLI - run the ElasticSearch extract against a local fake ES for each data size / sink combination
+
+Each combination runs in its own process so peak RSS is measured per run.
+
+EXAMPLE - CSV and stub-database sinks at two data sizes:
+    $> python -m bench --docs 10000,100000 --sinks csv,stub
+EXAMPLE - load into a real Postgres database config from conf/esextract.conf, 4 workers, pipelined:
+    $> python -m bench --docs 100000 --sinks db --dbconf PostgresLocal --workers 4 --pipeline
+EXAMPLE - one day out of 200 daily indices, with and without index pruning:
+    $> python -m bench --docs 400000 --indices 200 --daily --range 1541980800#1542067200 --prune none
+    $> python -m bench --docs 400000 --indices 200 --daily --range 1541980800#1542067200 --prune pattern
+"""
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SINKS = ["csv", "db", "stdout", "stub"]
+PERCENTILES = [50, 90, 99]
+
+
+class StageTimer:
+    """
+    Records call durations for one stage and reports latency percentiles
+    """
+    def __init__(self, name):
+        self.name = name
+        self.durations = []
+
+    def wrap(self, fn):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.durations.append(time.perf_counter() - start)
+        return timed
+
+    def wrap_async(self, fn):
+        async def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                self.durations.append(time.perf_counter() - start)
+        return timed
+
+    def summary(self):
+        durations = sorted(self.durations)
+        result = {"calls": len(durations), "total_s": round(sum(durations), 4)}
+        for p in PERCENTILES:
+            result["p" + str(p) + "_ms"] = round(percentile(durations, p) * 1000, 2)
+        result["max_ms"] = round(durations[-1] * 1000, 2) if durations else 0.0
+        return result
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    k = (len(sorted_values) - 1) * p / 100.0
+    lower = int(k)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (k - lower)
+
+
+def peak_rss_mb():
+    # ru_maxrss is KB on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return round(rss / (1024 * 1024), 1)
+    return round(rss / 1024, 1)
+
+
+def write_config(path, es_port, args):
+    """
+    Bench config - a BenchElasticSearch input source pointing at the fake ES, plus the database
+    sections of the real config (for the db sink)
+    """
+    lines = ["[BenchElasticSearch]",
+             "class: elasticsearch",
+             "elasticsearchhost: 127.0.0.1",
+             "elasticsearchport: " + str(es_port),
+             "querylimit: " + str(args.querylimit),
+             "colsfile: " + os.path.abspath(args.colsfile),
+             "indexmask: filebeat*",
+             "decoder: " + args.decoder,
+             "indexprune: " + args.prune,
+             "indexprunefield: endTime",
+             "indexpattern: filebeat-YYYY.MM.DD",
+             ""]
+    with open(path, "w") as f:
+        f.write("\n".join(lines))
+        if args.sink == "db":
+            with open(args.config) as real:
+                f.write("\n" + real.read())
+
+
+def run_single(args):
+    """
+    One benchmark run in this process - prints a JSON result line
+    """
+    workdir = tempfile.mkdtemp(prefix="esextract_bench_")
+    os.makedirs(workdir + "/log")
+    fake_args = ["--port", "0", "--docs", str(args.docs_per_index), "--indices", str(args.indices),
+                 "--latency", str(args.es_latency)] + (["--daily"] if args.daily else [])
+    fake = subprocess.Popen([sys.executable, "-m", "bench.fake_es"] + fake_args,
+                            cwd=REPO_ROOT, stdout=subprocess.PIPE, text=True)
+    try:
+        es_port = int(fake.stdout.readline().split()[-1])
+        config_path = workdir + "/bench.conf"
+        write_config(config_path, es_port, args)
+        os.environ["CONFIG_PATH"] = config_path
+        os.environ["LOG_ROOT"] = workdir + "/log"
+        if args.sink == "db":
+            os.environ.setdefault("KEY_PATH", os.path.dirname(os.path.abspath(args.config)))
+
+        sys.path.insert(0, REPO_ROOT)
+        import esextract
+        import metrics
+        from elasticsearch import Elasticsearch
+        from bench import stub_db
+
+        stub = None
+        if args.sink == "stub":
+            stub = stub_db.RecordingDatabase(args.commit_latency).install(esextract)
+
+        timers = {"fetch": StageTimer("fetch"), "transform": StageTimer("transform"), "load": StageTimer("load")}
+        Elasticsearch.search = timers["fetch"].wrap(Elasticsearch.search)
+        Elasticsearch.scroll = timers["fetch"].wrap(Elasticsearch.scroll)
+        if args.engine == "async":
+            from elasticsearch import AsyncElasticsearch
+            AsyncElasticsearch.search = timers["fetch"].wrap_async(AsyncElasticsearch.search)
+            AsyncElasticsearch.scroll = timers["fetch"].wrap_async(AsyncElasticsearch.scroll)
+        esextract.create_dataframe = timers["transform"].wrap(esextract.create_dataframe)
+        esextract.DataFrameWriter.write = timers["load"].wrap(esextract.DataFrameWriter.write)
+
+        csvfile = workdir + "/bench.csv" if args.sink == "csv" else None
+        database_conf = args.dbconf if args.sink in ("db", "stub") else None
+        if args.sink == "stub":
+            database_conf = "stub"
+
+        real_stdout = sys.stdout
+        if args.sink == "stdout" or args.quiet:
+            sys.stdout = open(os.devnull, "w")
+        startrange, _, endrange = args.range.partition("#")
+        start = time.perf_counter()
+        try:
+            n = esextract.extract_data_range(inputsource="BenchElasticSearch", filterkey=None, filterval=None,
+                                             rangefield="endTime", startrange=startrange, endrange=endrange or None,
+                                             cols_file=os.path.abspath(args.colsfile), csvfile=csvfile,
+                                             database_conf=database_conf, workers=args.workers, slices=args.slices,
+                                             pipelined=args.pipeline or None, engine=args.engine)
+        finally:
+            if sys.stdout is not real_stdout:
+                sys.stdout.close()
+                sys.stdout = real_stdout
+        elapsed = time.perf_counter() - start
+
+        result = {"sink": args.sink, "docs": args.docs_per_index * args.indices, "rows": n,
+                  "seconds": round(elapsed, 3), "rows_per_sec": round(n / elapsed) if elapsed > 0 else 0,
+                  "es_searches": timers["fetch"].summary()["calls"],
+                  "peak_rss_mb": peak_rss_mb(),
+                  "stages": {name: timer.summary() for name, timer in timers.items()}}
+        if stub:
+            result["loaded_rows"] = stub.rows
+        result["metrics"] = metrics.summary()
+        print(json.dumps(result), flush=True)
+    finally:
+        fake.terminate()
+        fake.wait()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def print_report(results):
+    print("")
+    print("sink".ljust(8) + "docs".rjust(10) + "rows/sec".rjust(12) + "seconds".rjust(10) + "peak RSS MB".rjust(13)
+          + "   stage p50/p90/p99 ms")
+    for r in results:
+        stages = "  ".join(name + ":" + "/".join(str(s["p" + str(p) + "_ms"]) for p in PERCENTILES)
+                           for name, s in r["stages"].items())
+        print(r["sink"].ljust(8) + str(r["docs"]).rjust(10) + str(r["rows_per_sec"]).rjust(12)
+              + str(r["seconds"]).rjust(10) + str(r["peak_rss_mb"]).rjust(13) + "   " + stages)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="esextract throughput benchmark against a local fake ElasticSearch",
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--docs', dest="docs", default="10000"
+                        , help='comma separated total doc counts to benchmark - EG 10000,100000')
+    parser.add_argument('--indices', dest="indices", type=int, default=1, help='daily indices to spread docs over')
+    parser.add_argument('--daily', dest="daily", action='store_true', default=False
+                        , help='fake ES - each index holds the docs of the day in its name')
+    parser.add_argument('--range', dest="range", default="0", help='endTime range START[#END] - default everything')
+    parser.add_argument('--prune', dest="prune", default="none", help='index pruning: none, pattern, stats')
+    parser.add_argument('--sinks', dest="sinks", default="csv,stub", help='comma separated sinks: ' + ",".join(SINKS))
+    parser.add_argument('--dbconf', dest="dbconf", default=None, help='database config section for the db sink')
+    parser.add_argument('--config', dest="config", default=REPO_ROOT + "/conf/esextract.conf"
+                        , help='config file holding the --dbconf section')
+    parser.add_argument('--colsfile', dest="colsfile", default=REPO_ROOT + "/conf/cols.conf")
+    parser.add_argument('--querylimit', dest="querylimit", type=int, default=10000, help='docs per page')
+    parser.add_argument('--commit_latency', dest="commit_latency", type=float, default=0.0
+                        , help='stub sink - seconds per committed batch')
+    parser.add_argument('--es_latency', dest="es_latency", type=float, default=0.0
+                        , help='fake ES - seconds added to every response, simulates a remote cluster')
+    parser.add_argument('-w', '--workers', dest="workers", type=int, default=None)
+    parser.add_argument('--slices', dest="slices", type=int, default=None)
+    parser.add_argument('--engine', dest="engine", default=None)
+    parser.add_argument('--decoder', dest="decoder", default="auto", help='response JSON parser: auto, orjson, json')
+    parser.add_argument('--pipeline', dest="pipeline", action='store_true', default=False)
+    parser.add_argument('--json', dest="json_out", default=None, help='also write the results to this JSON file')
+    parser.add_argument('--keep', dest="keep", action='store_true', default=False, help='keep the temp work dir')
+    parser.add_argument('--verbose', dest="verbose", action='store_true', default=False, help='show extract log output')
+    # internal - run one combination in this process
+    parser.add_argument('--single', dest="single", action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--sink', dest="sink", default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--docs_per_index', dest="docs_per_index", type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.quiet = not args.verbose
+
+    if args.single:
+        run_single(args)
+        sys.exit(0)
+
+    results = []
+    for docs in [int(d) for d in args.docs.split(",")]:
+        for sink in args.sinks.split(","):
+            if sink not in SINKS:
+                parser.error("unknown sink " + sink)
+            if sink == "db" and not args.dbconf:
+                parser.error("--dbconf is needed for the db sink")
+            cmd = [sys.executable, "-m", "bench", "--single", "--sink", sink,
+                   "--docs_per_index", str(max(1, docs // args.indices))] + sys.argv[1:]
+            proc = subprocess.run(cmd, cwd=REPO_ROOT, stdout=subprocess.PIPE, text=True)
+            lines = [l for l in proc.stdout.splitlines() if l.startswith("{")]
+            if proc.returncode != 0 or not lines:
+                print("benchmark failed: sink " + sink + " docs " + str(docs), file=sys.stderr)
+                print(proc.stdout, file=sys.stderr)
+                sys.exit(1)
+            results.append(json.loads(lines[-1]))
+            print(lines[-1], flush=True)
+
+    print_report(results)
+    if args.json_out:
+        with open(args.json_out, "w") as f:
+            json.dump(results, f, indent=2)
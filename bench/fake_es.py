@@ -0,0 +1,454 @@
+"""
+Local fake ElasticSearch HTTP endpoint serving synthetic job-accounting documents
+
+Implements just enough of the REST API for the extract engines: GET / (product check), index listing,
+_cat/indices, search with scroll, scroll / clear-scroll, point-in-time + search_after, composite
+aggregations (terms / histogram / date_histogram sources, sum avg min max value_count cardinality metrics),
+top-level min / max / percentiles aggregations and a terms aggregation on _index with min / max sub-aggregations.
+Docs are generated on the fly from the cols spec (cols.conf), so any data size can be served
+without holding it in memory.  Query clauses other than slice, size, _source includes, search_after, a
+range on endTime and an endTime sort are ignored - every other doc in an index matches.
+By default every index holds docs over the same time span; with --daily each index holds the docs of the day
+in its name (docs_per_index up to 5830), for index pruning benchmarks.
+"""
+
+import argparse
+import datetime
+import json
+import math
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+BASE_EPOCH = 1541680814  # endTime of the first synthetic doc
+DAY = 86400
+STATUSES = ["JOB_FINISH", "JOB_FINISH2", "EXIT"]
+QUEUES = ["normal", "long", "short", "gpu"]
+
+
+def synthetic_doc(pos, index_no, fields, stride=1):
+    """
+    Deterministic job-accounting doc number pos in index index_no, with just the requested fields
+    """
+    end = end_time(pos, index_no, stride)
+    doc = {
+        "jobStatus": STATUSES[pos % len(STATUSES)],
+        "@timestamp": datetime.datetime.utcfromtimestamp(end).strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+        "jobID": index_no * 10000000 + pos,
+        "jobName": "job_" + str(pos % 997),
+        "userName": "user" + str(pos % 53),
+        "projectName": "project" + str(pos % 17),
+        "queue": QUEUES[pos % len(QUEUES)],
+        "submitTime": end - 3600 - pos % 600,
+        "startTime": end - 1800 - pos % 300,
+        "runTime": 1800 + pos % 300,
+        "endTime": end,
+        "ru_maxrss": 1024 * (pos % 4096),
+        "ru_stime": round((pos % 100) * 0.37, 2),
+        "ru_utime": round((pos % 1000) * 1.13, 2),
+        "ru_nswap": 0,
+        "avgMem": 512 + pos % 2048,
+        "execHosts": ["node" + str((pos + h) % 400).zfill(3) for h in range(0, 1 + pos % 4)],
+        "command": "/apps/bin/solver --input /scratch/run_" + str(pos) + ".dat " + "--opt " * 20,
+    }
+    if fields is None:
+        return doc
+    return {f: doc.get(f) for f in fields}
+
+
+def end_time(pos, index_no, stride=1):
+    """
+    :param stride: seconds between the endTimes of doc pos in one index and the next - 1, or DAY for daily indices
+    """
+    return BASE_EPOCH + pos * 7 + index_no * stride
+
+
+def range_positions(positions, index_no, bounds, stride=1):
+    """
+    The positions (a range) whose endTime is within the gt / gte / lt / lte bounds - endTime grows with pos
+    """
+    low = 0
+    high = positions.stop
+    for op, value in bounds.items():
+        value = float(value)
+        # first pos with endTime >= value (gte) / > value (gt), or past the last pos allowed by lt / lte
+        edge = (value - BASE_EPOCH - index_no * stride) / 7.0
+        if op == "gte":
+            low = max(low, int(math.ceil(edge)))
+        elif op == "gt":
+            low = max(low, int(math.floor(edge)) + 1)
+        elif op == "lt":
+            high = min(high, int(math.ceil(edge)))
+        elif op == "lte":
+            high = min(high, int(math.floor(edge)) + 1)
+    low = max(low, positions.start)
+    # first position of the slice at or after low
+    first = positions.start + -(-(low - positions.start) // positions.step) * positions.step
+    return range(first, max(first, high), positions.step)
+
+
+def range_bounds(body):
+    """
+    gt / gte / lt / lte of a range filter on endTime in a search body, or None
+    """
+    filters = body.get("query", {}).get("bool", {}).get("filter", [])
+    for clause in filters:
+        bounds = clause.get("range", {}).get("endTime")
+        if bounds is not None:
+            return bounds
+    return None
+
+
+def bucket_key(kind, spec, value):
+    if value is None or kind == "terms":
+        return value
+    if kind == "histogram":
+        interval = float(spec["interval"])
+        return float(value // interval * interval)
+    # date_histogram - epoch-second or ISO values, keys in epoch ms; calendar day / month or fixed intervals
+    if isinstance(value, str):
+        stamp = datetime.datetime.strptime(value[:19], "%Y-%m-%dT%H:%M:%S").replace(tzinfo=datetime.timezone.utc)
+    else:
+        stamp = datetime.datetime.fromtimestamp(value, datetime.timezone.utc)
+    interval = spec.get("calendar_interval") or spec.get("fixed_interval")
+    if interval in ("month", "1M"):
+        stamp = stamp.replace(day=1, hour=0, minute=0, second=0)
+    elif interval in ("year", "1y"):
+        stamp = stamp.replace(month=1, day=1, hour=0, minute=0, second=0)
+    else:
+        units = {"s": 1, "m": 60, "h": 3600, "d": 86400, "minute": 60, "hour": 3600, "day": 86400}
+        number = re.match(r"^([0-9]*)(.*)$", interval)
+        seconds = int(number.group(1) or 1) * units[number.group(2)]
+        return int(stamp.timestamp()) // seconds * seconds * 1000
+    return int(stamp.timestamp()) * 1000
+
+
+def metric_value(func, values):
+    if func == "value_count":
+        return len(values)
+    if func == "cardinality":
+        return len(set(values))
+    if not values:
+        return None
+    if func == "sum":
+        return float(sum(values))
+    if func == "avg":
+        return sum(values) / len(values)
+    return float(min(values) if func == "min" else max(values))
+
+
+class FakeElasticsearch:
+    """
+    :param docs_per_index: synthetic docs in each index
+    :param indices: number of daily indices, named filebeat-YYYY.MM.DD
+    :param latency: seconds added to every response - simulates a remote cluster
+    :param daily: each index holds the docs of the day in its name, rather than all indices the same time span
+    """
+    def __init__(self, docs_per_index=10000, indices=1, host="127.0.0.1", port=0, latency=0.0, daily=False):
+        self.docs_per_index = int(docs_per_index)
+        self.latency = float(latency)
+        self.stride = DAY if daily else 1
+        self.index_names = [(datetime.date(2018, 11, 8) + datetime.timedelta(days=i)).strftime("filebeat-%Y.%m.%d")
+                            for i in range(0, int(indices))]
+        self.cursors = {}  # scroll / pit id -> cursor state
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def matching_indices(self, mask):
+        pattern = "^" + re.escape(mask).replace("\\*", ".*").replace(",", "|") + "$"
+        return [i for i in self.index_names if re.match(pattern, i)]
+
+    def _positions(self, body, index_no):
+        """
+        doc positions in an index matching the slice and endTime range in the search body
+        """
+        slice_spec = body.get("slice")
+        if slice_spec:
+            positions = range(int(slice_spec["id"]), self.docs_per_index, int(slice_spec["max"]))
+        else:
+            positions = range(0, self.docs_per_index)
+        bounds = range_bounds(body)
+        if bounds:
+            positions = range_positions(positions, index_no, bounds, self.stride)
+        return positions
+
+    def _segments(self, indices, body):
+        """
+        (index name, index number, positions) for each index searched - or, when the search is sorted on endTime,
+        a single segment of (index name, index number, pos) docs in endTime order (materialised)
+        """
+        segments = [(name, self.index_names.index(name), self._positions(body, self.index_names.index(name)))
+                    for name in indices]
+        sort = body.get("sort") or [None]
+        if isinstance(sort[0], dict) and "endTime" in sort[0]:
+            docs = sorted(((end_time(pos, index_no, self.stride), index_no, pos, name)
+                           for name, index_no, positions in segments for pos in positions))
+            return [(None, None, [(name, index_no, pos) for _, index_no, pos, name in docs])]
+        return segments
+
+    def _fields(self, body):
+        source = body.get("_source")
+        if isinstance(source, dict):
+            return source.get("includes")
+        if isinstance(source, list):
+            return source
+        return None
+
+    def new_cursor(self, indices, body, size=10, cursor_id=None):
+        """
+        Cursor over every doc of the indices in the slice of the search body - docs are addressed by offset,
+        only materialised for a search sorted on endTime
+        """
+        cursor_id = cursor_id or uuid.uuid4().hex
+        with self.lock:
+            self.cursors[cursor_id] = {"indices": indices, "segments": self._segments(indices, body), "offset": 0,
+                                       "body": body, "size": int(size)}
+        return cursor_id
+
+    def drop_cursor(self, cursor_id):
+        if isinstance(cursor_id, list):
+            cursor_id = cursor_id[0] if cursor_id else None
+        with self.lock:
+            self.cursors.pop(cursor_id, None)
+
+    def page(self, cursor_id, search_after=None, size=None):
+        with self.lock:
+            cursor = self.cursors[cursor_id]
+            size = int(size or cursor["size"])
+            if search_after is not None:
+                offset = int(search_after[-1]) + 1
+            else:
+                offset = cursor["offset"]
+            segments = cursor["segments"]
+            total = sum(len(positions) for _, _, positions in segments)
+            end = min(offset + size, total)
+            cursor["offset"] = end
+        fields = self._fields(cursor["body"])
+        hits = []
+        k = offset
+        start = 0
+        for segment_index, segment_no, positions in segments:
+            while start <= k < min(start + len(positions), end):
+                if segment_index is None:
+                    index_name, index_no, pos = positions[k - start]
+                else:
+                    index_name, index_no, pos = segment_index, segment_no, positions[k - start]
+                source = synthetic_doc(pos, index_no, fields, self.stride)
+                hits.append({"_index": index_name, "_id": str(index_no) + "-" + str(pos), "_score": None,
+                             "_source": source, "sort": [end_time(pos, index_no, self.stride), k]})
+                k = k + 1
+            start = start + len(positions)
+        return {"took": 1, "timed_out": False,
+                "hits": {"total": {"value": total, "relation": "eq"}, "max_score": None, "hits": hits}}
+
+    def metric(self, indices, body, agg):
+        """
+        Top-level min / max / percentiles of endTime over the docs matching the search body
+        """
+        func, spec = list(agg.items())[0]
+        values = sorted(end_time(pos, index_no, self.stride)
+                        for _, index_no, positions in self._segments(indices, body) for pos in positions)
+        if func == "percentiles":
+            if not values:
+                return {"values": {str(float(p)): None for p in spec["percents"]}}
+            return {"values": {str(float(p)): float(values[min(len(values) - 1, int(len(values) * p / 100.0))])
+                               for p in spec["percents"]}}
+        if not values:
+            return {"value": None}
+        return {"value": float(values[0] if func == "min" else values[-1])}
+
+    def index_terms(self, indices, body, agg):
+        """
+        terms aggregation on _index with top-level-style min / max (of endTime) sub-aggregations - query ignored
+        """
+        buckets = []
+        for name in indices:
+            bucket = {"key": name, "doc_count": self.docs_per_index}
+            for sub_name, sub_agg in agg.get("aggs", {}).items():
+                bucket[sub_name] = self.metric([name], {}, sub_agg)
+            buckets.append(bucket)
+        return {"buckets": buckets[:int(agg["terms"].get("size", 10))]}
+
+    def composite(self, indices, body, agg):
+        """
+        Page of a composite aggregation over the docs matching the search body - computed by a full pass over the docs
+        """
+        composite = agg["composite"]
+        sources = [(name, kind, spec) for source in composite["sources"] for name, spec in source.items()
+                   for kind, spec in spec.items()]
+        metric_specs = [(name, func, spec["field"]) for name, m in agg.get("aggs", {}).items()
+                        for func, spec in m.items()]
+        fields = [spec["field"] for _, _, spec in sources] + [field for _, _, field in metric_specs]
+        groups = {}
+        for _, index_no, positions in self._segments(indices, body):
+            for pos in positions:
+                doc = synthetic_doc(pos, index_no, [f.replace(".keyword", "") for f in fields], self.stride)
+                key = tuple(bucket_key(kind, spec, doc.get(spec["field"].replace(".keyword", "")))
+                            for _, kind, spec in sources)
+                group = groups.setdefault(key, {"doc_count": 0, "values": {}})
+                group["doc_count"] = group["doc_count"] + 1
+                for name, func, field in metric_specs:
+                    value = doc.get(field)
+                    if value is not None:
+                        group["values"].setdefault(name, []).append(value)
+        keys = sorted(groups, key=lambda k: [(v is not None, v) for v in k])
+        after = composite.get("after")
+        if after:
+            after_key = tuple(after[name] for name, _, _ in sources)
+            keys = [k for k in keys if [(v is not None, v) for v in k] > [(v is not None, v) for v in after_key]]
+        keys = keys[:int(composite.get("size", 10))]
+        buckets = []
+        for k in keys:
+            bucket = {"key": {name: v for (name, _, _), v in zip(sources, k)}, "doc_count": groups[k]["doc_count"]}
+            for name, func, _ in metric_specs:
+                bucket[name] = {"value": metric_value(func, groups[k]["values"].get(name, []))}
+            buckets.append(bucket)
+        result = {"buckets": buckets}
+        if buckets:
+            result["after_key"] = buckets[-1]["key"]
+        return result
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _body(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                if length == 0:
+                    return {}
+                return json.loads(self.rfile.read(length))
+
+            def _send(self, payload, status=200, content_type="application/json"):
+                if isinstance(payload, (dict, list)):
+                    data = json.dumps(payload).encode()
+                else:
+                    data = payload.encode()
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.send_header("X-Elastic-Product", "Elasticsearch")
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _route(self, method):
+                with fake.lock:
+                    fake.requests = fake.requests + 1
+                if fake.latency:
+                    time.sleep(fake.latency)
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                parts = [p for p in url.path.split("/") if p]
+                body = self._body()
+
+                if not parts:
+                    return self._send({"name": "fake", "cluster_name": "bench", "tagline": "You Know, for Search",
+                                       "version": {"number": "7.17.0", "build_flavor": "default"}})
+                if parts[0] == "_cat" and parts[1] == "indices":
+                    names = fake.matching_indices(parts[2]) if len(parts) > 2 else fake.index_names
+                    if query.get("format") == ["json"]:
+                        return self._send([{"index": n, "docs.count": str(fake.docs_per_index)} for n in names])
+                    lines = ["green open " + n + " uuid 1 0 " + str(fake.docs_per_index) + " 0 1mb 1mb" for n in names]
+                    return self._send("\n".join(lines) + "\n", content_type="text/plain")
+                if parts[0] == "_search" and len(parts) > 1 and parts[1] == "scroll":
+                    if method == "DELETE":
+                        fake.drop_cursor(body.get("scroll_id"))
+                        return self._send({"succeeded": True, "num_freed": 1})
+                    scroll_id = body.get("scroll_id")
+                    page = fake.page(scroll_id)
+                    page["_scroll_id"] = scroll_id
+                    return self._send(page)
+                if parts[0] == "_pit" and method == "DELETE":
+                    fake.drop_cursor(body.get("id"))
+                    return self._send({"succeeded": True, "num_freed": 1})
+                if parts[0] == "_search" and "pit" in body:
+                    pit_id = body["pit"]["id"]
+                    with fake.lock:
+                        pending = fake.cursors[pit_id].get("pending")
+                    if pending:
+                        # first search on the PIT fixes the slice / projection
+                        fake.new_cursor(fake.cursors[pit_id]["indices"], body, body.get("size", 10), pit_id)
+                    page = fake.page(pit_id, body.get("search_after"), body.get("size", 10))
+                    page["pit_id"] = pit_id
+                    return self._send(page)
+                if len(parts) > 1 and parts[1] == "_pit":
+                    pit_id = uuid.uuid4().hex
+                    with fake.lock:
+                        fake.cursors[pit_id] = {"indices": fake.matching_indices(parts[0]), "pending": True}
+                    return self._send({"id": pit_id})
+                if len(parts) > 1 and parts[1] == "_search" and "aggs" in body:
+                    indices = fake.matching_indices(parts[0])
+                    return self._send({"took": 1, "timed_out": False, "hits": {"hits": []},
+                                       "aggregations": {name: fake.composite(indices, body, agg) if "composite" in agg
+                                                        else fake.index_terms(indices, body, agg) if "terms" in agg
+                                                        else fake.metric(indices, body, agg)
+                                                        for name, agg in body["aggs"].items()}})
+                if len(parts) > 1 and parts[1] == "_search":
+                    indices = fake.matching_indices(parts[0])
+                    size = query.get("size", [body.get("size", 10)])[0]
+                    cursor_id = fake.new_cursor(indices, body, size)
+                    page = fake.page(cursor_id)
+                    if "scroll" in query:
+                        page["_scroll_id"] = cursor_id
+                    else:
+                        fake.drop_cursor(cursor_id)
+                    return self._send(page)
+                if len(parts) == 1 and method in ("GET", "HEAD"):
+                    names = fake.matching_indices(parts[0])
+                    return self._send({n: {"aliases": {}, "mappings": {}, "settings": {}} for n in names})
+                return self._send({"error": "unsupported fake ES request " + method + " " + self.path}, status=400)
+
+            def do_GET(self):
+                self._route("GET")
+
+            def do_POST(self):
+                self._route("POST")
+
+            def do_DELETE(self):
+                self._route("DELETE")
+
+            def do_HEAD(self):
+                self._route("HEAD")
+
+        return Handler
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Fake ElasticSearch serving synthetic job-accounting docs")
+    parser.add_argument('--port', dest="port", type=int, default=9200)
+    parser.add_argument('--docs', dest="docs", type=int, default=100000, help='docs per index')
+    parser.add_argument('--indices', dest="indices", type=int, default=1, help='number of daily indices')
+    parser.add_argument('--latency', dest="latency", type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--daily', dest="daily", action="store_true", help='each index holds the docs of its day')
+    args = parser.parse_args()
+
+    fake = FakeElasticsearch(docs_per_index=args.docs, indices=args.indices, port=args.port,
+                             latency=args.latency, daily=args.daily).start()
+    print("Fake ElasticSearch listening on port", fake.port, flush=True)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        fake.stop()
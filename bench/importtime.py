@@ -0,0 +1,87 @@
+"""
+Startup benchmark - wall time of light CLI modes and the heavy modules they import
+
+Each mode runs in a fresh interpreter N times (min / median reported), then once more with -X importtime to list
+the slowest imports and flag any heavy dependency (pandas, numpy, SQLAlchemy, ElasticSearch client, pyarrow) that
+the mode loaded but should not need.
+
+EXAMPLE:
+    $> python -m bench.importtime
+    $> python -m bench.importtime --runs 20 --top 15
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ["pandas", "numpy", "sqlalchemy", "elasticsearch", "pyarrow", "orjson"]
+MODES = {
+    "import": ["-c", "import esextract"],
+    "help": ["esextract.py", "--help"],
+    "dumpparams": ["esextract.py", "dumpparams"],
+}
+
+
+def run_mode(argv, env):
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable] + argv, cwd=REPO_ROOT, env=env, stdout=subprocess.DEVNULL,
+                          stderr=subprocess.PIPE, universal_newlines=True)
+    seconds = time.perf_counter() - start
+    if proc.returncode != 0:
+        raise RuntimeError(" ".join(argv) + " failed:\n" + proc.stderr)
+    return seconds
+
+
+def import_times(argv, env):
+    """
+    -X importtime output as a list of (cumulative microseconds, module name)
+    """
+    proc = subprocess.run([sys.executable, "-X", "importtime"] + argv, cwd=REPO_ROOT, env=env,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    times = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, module = line[len("import time:"):].split("|")
+        times.append((int(cumulative), module.strip()))
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description="esextract startup time for light CLI modes")
+    parser.add_argument('--runs', dest="runs", type=int, default=10, help='runs per mode')
+    parser.add_argument('--top', dest="top", type=int, default=10, help='slowest imports to list per mode')
+    parser.add_argument('--modes', dest="modes", default=",".join(MODES), help='comma separated: ' + ",".join(MODES))
+    parser.add_argument('--config', dest="config", default=REPO_ROOT + "/conf/esextract.conf")
+    args = parser.parse_args()
+
+    env = dict(os.environ, CONFIG_PATH=args.config)
+    heavy_loaded = False
+    print("mode".ljust(12) + "min ms".rjust(10) + "median ms".rjust(12) + "  heavy modules imported")
+    reports = []
+    for mode in args.modes.split(","):
+        argv = MODES[mode]
+        seconds = [run_mode(argv, env) for _ in range(args.runs)]
+        times = import_times(argv, env)
+        loaded = sorted(set(m for _, m in times if m in HEAVY_MODULES))
+        heavy_loaded = heavy_loaded or bool(loaded)
+        print(mode.ljust(12) + str(round(min(seconds) * 1000, 1)).rjust(10)
+              + str(round(statistics.median(seconds) * 1000, 1)).rjust(12) + "  " + (",".join(loaded) or "-"))
+        reports.append((mode, sorted(times, reverse=True)[:args.top]))
+
+    for mode, top in reports:
+        print("")
+        print("slowest imports - " + mode + " (cumulative ms)")
+        for cumulative, module in top:
+            print(str(round(cumulative / 1000.0, 1)).rjust(10) + "  " + module)
+
+    # non-zero exit so a CI step can catch a heavy import creeping back into a light mode
+    sys.exit(1 if heavy_loaded else 0)
+
+
+if __name__ == '__main__':
+    main()
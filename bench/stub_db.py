@@ -0,0 +1,39 @@
+"""
+Recording stand-in for the database sink
+
+Replaces esextract.dataframe_to_db (and the config of its database) so the extract path can be benchmarked without Postgres.
+Rows are counted (not kept) and an optional fixed commit latency per batch simulates a remote database.
+"""
+
+import threading
+import time
+
+
+class RecordingDatabase:
+    """
+    :param commit_latency: seconds to sleep per committed batch
+    """
+    def __init__(self, commit_latency=0.0):
+        self.commit_latency = float(commit_latency)
+        self.rows = 0
+        self.batches = 0
+        self.cols = None
+        self.lock = threading.Lock()
+
+    def dataframe_to_db(self, data, database_conf, batch_size=None, upsert=False, atomic=False, stage=None):
+        # same work the real loader does to turn the frame into driver values
+        values = data.astype(object).where(data.notna(), None).values
+        if self.commit_latency:
+            time.sleep(self.commit_latency)
+        with self.lock:
+            self.rows = self.rows + len(values)
+            self.batches = self.batches + 1
+            self.cols = list(data.columns)
+
+    def install(self, esextract_module, database_conf="stub"):
+        esextract_module.dataframe_to_db = self.dataframe_to_db
+        # the stub database has no config section - plain single-connection loads
+        get_database_params = esextract_module.get_database_params
+        esextract_module.get_database_params = lambda conf: {"table": conf} if conf == database_conf \
+            else get_database_params(conf)
+        return self
@@ -0,0 +1,114 @@
+"""
+Checkpoint store for incremental extracts
+
+One record per source / destination / search-key (and filter) holding the last committed range value,
+so the next run - or a re-run after a crash - carries on from where the last committed page finished.
+Records are kept in a JSON file that is replaced atomically on every update.
+"""
+
+import datetime
+import json
+import os
+import tempfile
+import threading
+
+
+# checkpoint file -> shared CheckpointStore, so concurrent extracts in one process never interleave their updates
+_STORES = {}
+_STORES_LOCK = threading.Lock()
+
+
+class CheckpointFileError(Exception):
+    pass
+
+
+def checkpoint_key(inputsource, destination, rangefield, filterkey=None, filterval=None):
+    """
+    :return: string key identifying an incremental extract
+    """
+    key = inputsource + "|" + str(destination) + "|" + rangefield
+    if filterkey:
+        key = key + "|" + filterkey + "=" + str(filterval)
+    return key
+
+
+class CheckpointStore:
+    """
+    JSON file of checkpoint records:
+        { key: {"value": <last committed range value>,
+                "boundary_ids": [<_id of committed docs with range value == value>],
+                "rows": <rows committed>, "search_after": <sort values of the last committed doc>,
+                "updated": <timestamp>} }
+    boundary_ids let a resumed extract re-read from value (inclusive) without loading the docs at value twice.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def _read(self):
+        if not os.path.isfile(self.path):
+            return {}
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except Exception as e:
+            raise CheckpointFileError(self.path + " " + str(e))
+
+    def load(self, key):
+        """
+        :return: checkpoint record for key, or None if there is no checkpoint yet
+        """
+        with self.lock:
+            return self._read().get(key)
+
+    def save(self, key, value, boundary_ids=None, rows=0, search_after=None):
+        """
+        Advance the checkpoint for key.  Written to a temp file in the same directory then renamed over
+        the checkpoint file, so a crash leaves either the old or the new checkpoint - never a partial one.
+        """
+        record = {"value": value,
+                  "boundary_ids": list(boundary_ids or []),
+                  "rows": rows,
+                  "search_after": search_after,
+                  "updated": str(datetime.datetime.now())[0:19]}
+        with self.lock:
+            checkpoints = self._read()
+            checkpoints[key] = record
+            self._write(checkpoints)
+        return record
+
+    def delete(self, keys):
+        """
+        Drop the checkpoints for keys - EG the shard checkpoints of a sharded extract once every shard is done
+        """
+        with self.lock:
+            checkpoints = self._read()
+            for key in keys:
+                checkpoints.pop(key, None)
+            self._write(checkpoints)
+
+    def _write(self, checkpoints):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".checkpoint_")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(checkpoints, f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+
+def get_store(path):
+    """
+    The process-wide CheckpointStore for a checkpoint file
+    """
+    path = os.path.abspath(path)
+    with _STORES_LOCK:
+        if path not in _STORES:
+            _STORES[path] = CheckpointStore(path)
+        return _STORES[path]
@@ -0,0 +1,193 @@
+"""
+Cols spec - the columns to extract, with optional types and source paths
+
+One column per line of the cols file:
+    name                      - untyped (Python objects), read from the source field of the same name
+    name:type                 - converted to a compact dtype when the DataFrame is built
+    name:type:source.path     - read from another (EG nested, dotted) source field and renamed to name
+    name::source.path         - renamed only
+
+Types:
+    int8 int16 int32 int64 uint8 uint16 uint32 uint64  - nullable integers (missing values kept as <NA>)
+    float32 float64
+    bool
+    string
+    category                                           - repeated values stored once, EG queue / jobStatus
+    timestamp[s] timestamp[ms] timestamp[us] timestamp[ns]
+                                                       - UTC datetimes at that resolution; numeric source values
+                                                         are epoch values in that unit, strings are parsed (ISO 8601
+                                                         fast path)
+    object                                             - untyped, the default
+
+Lines starting with # are comments.
+"""
+
+import re
+
+INT_TYPES = {"int8": "Int8", "int16": "Int16", "int32": "Int32", "int64": "Int64",
+             "uint8": "UInt8", "uint16": "UInt16", "uint32": "UInt32", "uint64": "UInt64"}
+FLOAT_TYPES = ["float32", "float64"]
+TIMESTAMP_TYPE = re.compile(r"^timestamp\[(s|ms|us|ns)\]$")
+OTHER_TYPES = ["bool", "string", "category", "object"]
+
+
+class ColsSpecError(Exception):
+    pass
+
+
+class Column:
+    """
+    :param name: DataFrame column name
+    :param dtype: type from the cols spec, None for untyped
+    :param source: source field (dotted path for nested fields) - default name
+    """
+    def __init__(self, name, dtype=None, source=None):
+        self.name = name
+        self.dtype = dtype
+        self.source = source or name
+        self.path = self.source.split(".")
+
+    def __repr__(self):
+        return "Column(" + ":".join([self.name, self.dtype or "", self.source]) + ")"
+
+
+def check_type(dtype):
+    if dtype in INT_TYPES or dtype in FLOAT_TYPES or dtype in OTHER_TYPES or TIMESTAMP_TYPE.match(dtype):
+        return dtype
+    raise ColsSpecError("unknown col type " + dtype)
+
+
+def parse_line(line):
+    """
+    "name[:type[:source]]" -> Column, None for blank / comment lines
+    """
+    line = line.strip()
+    if not line or line.startswith("#"):
+        return None
+    parts = [p.strip() for p in line.split(":", 2)]
+    name = parts[0]
+    if not name:
+        raise ColsSpecError("no col name in cols spec line: " + line)
+    dtype = parts[1] if len(parts) > 1 and parts[1] else None
+    if dtype:
+        check_type(dtype)
+    if dtype == "object":
+        dtype = None
+    source = parts[2] if len(parts) > 2 and parts[2] else None
+    return Column(name, dtype, source)
+
+
+def parse(lines):
+    columns = [c for c in (parse_line(l) for l in lines) if c is not None]
+    names = [c.name for c in columns]
+    duplicated = sorted(set(n for n in names if names.count(n) > 1))
+    if duplicated:
+        raise ColsSpecError("duplicate col names in cols spec: " + ",".join(duplicated))
+    return columns
+
+
+def read(cols_file):
+    with open(cols_file, 'r') as f:
+        return parse(f.readlines())
+
+
+def get_path(record, path):
+    """
+    Value at a dotted path in a nested source record - flat keys containing dots are tried first
+    """
+    if len(path) == 1:
+        return record.get(path[0])
+    value = record.get(".".join(path))
+    if value is not None:
+        return value
+    value = record
+    for key in path:
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+
+def build_frame(records, columns):
+    """
+    DataFrame from a list of source records (dicts) with the columns / types of the cols spec.
+    Built col by col - one value list per col read from the records, converted to its type, then
+    assembled - which avoids pandas' row-by-row dict handling and lets typed cols skip the object -> float64
+    detour (large integers with missing values stay exact)
+    """
+    import pandas as pd
+    data = {}
+    for c in columns:
+        if len(c.path) == 1:
+            key = c.source
+            values = [r.get(key) for r in records]
+        else:
+            values = [get_path(r, c.path) for r in records]
+        if c.dtype is None:
+            data[c.name] = values
+        else:
+            data[c.name] = convert(pd.Series(values, dtype=object), c.dtype)
+    return pd.DataFrame(data, columns=[c.name for c in columns])
+
+
+def apply_types(data, columns):
+    """
+    Convert the typed columns of a DataFrame in place - values that do not convert become missing
+    """
+    for c in columns:
+        if c.dtype is None or c.name not in data.columns:
+            continue
+        data[c.name] = convert(data[c.name], c.dtype)
+    return data
+
+
+def is_number(values):
+    """
+    True if the first value of an object Series is an epoch value - a number or a numeric string
+    """
+    first = values.first_valid_index()
+    if first is None:
+        return False
+    value = values[first]
+    if isinstance(value, str):
+        return value.lstrip("-").replace(".", "", 1).isdigit()
+    return isinstance(value, (int, float))
+
+
+def pandas_2():
+    # dtype_backend and the ISO8601 / mixed datetime formats need pandas 2
+    import pandas as pd
+    return int(pd.__version__.split(".")[0]) >= 2
+
+
+def convert(values, dtype):
+    import pandas as pd
+    if dtype in INT_TYPES:
+        if pandas_2():
+            # nullable backend keeps large integers exact when some values are missing
+            numeric = pd.to_numeric(values, errors="coerce", dtype_backend="numpy_nullable")
+        else:
+            numeric = pd.to_numeric(values, errors="coerce")
+        if not pd.api.types.is_integer_dtype(numeric):
+            numeric = numeric.round()
+        return numeric.astype(INT_TYPES[dtype])
+    if dtype in FLOAT_TYPES:
+        return pd.to_numeric(values, errors="coerce").astype(dtype)
+    if dtype == "bool":
+        return values.astype("boolean")
+    if dtype == "string":
+        return values.astype("string")
+    if dtype == "category":
+        return values.astype("category")
+    unit = TIMESTAMP_TYPE.match(dtype).group(1)
+    if pd.api.types.is_numeric_dtype(values) or is_number(values):
+        stamps = pd.to_datetime(pd.to_numeric(values, errors="coerce"), unit=unit, utc=True, errors="coerce")
+    elif not pandas_2():
+        # pandas 1 infers the format per value
+        stamps = pd.to_datetime(values, utc=True, errors="coerce")
+    else:
+        try:
+            stamps = pd.to_datetime(values, utc=True, format="ISO8601")
+        except (ValueError, TypeError):
+            stamps = pd.to_datetime(values, utc=True, errors="coerce", format="mixed")
+    return stamps.astype("datetime64[" + unit + ", UTC]")
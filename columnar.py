@@ -0,0 +1,167 @@
+"""
+Columnar file sinks - Parquet and Arrow IPC (Feather v2)
+
+Each extracted batch is appended to the open file as a new row group (Parquet) or record batch (Arrow IPC),
+so memory stays bounded by the batch size.  Optionally the output is split Hive-style by a date derived from the
+range field:
+    <path>/date=2018-11-08/part-0.parquet
+    <path>/date=2018-11-09/part-0.parquet
+
+Incremental extracts append - each run writes new part files next to the earlier runs' files, as Parquet / Arrow
+files cannot be reopened for writing:
+    <path>/part-0.parquet, <path>/part-1.parquet ...     (or <path>/date=.../part-N.parquet when partitioned)
+
+pyarrow is optional - only needed when one of these sinks is selected.
+"""
+
+import os
+import threading
+
+import colspec
+import metrics
+
+FORMATS = ["parquet", "arrow"]
+PARTITIONS = ["day", "month"]
+DEFAULT_COMPRESSION = {"parquet": "snappy", "arrow": "lz4"}
+EXTENSIONS = {"parquet": ".parquet", "arrow": ".arrow"}
+PARTITION_FORMATS = {"day": ("date", "%Y-%m-%d"), "month": ("month", "%Y-%m")}
+EPOCH_MS_THRESHOLD = 10 ** 11  # numeric range values above this are epoch milliseconds, below epoch seconds
+
+
+class ColumnarSinkError(Exception):
+    pass
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+        import pyarrow.ipc
+    except ImportError:
+        raise ColumnarSinkError("pyarrow is needed for Parquet / Arrow output - pip install pyarrow")
+    return pyarrow
+
+
+def partition_dates(values):
+    """
+    Range field values (epoch seconds / milliseconds or date strings) as a datetime Series
+    """
+    import pandas as pd
+    if pd.api.types.is_numeric_dtype(values):
+        unit = "ms" if values.dropna().abs().max() > EPOCH_MS_THRESHOLD else "s"
+        return pd.to_datetime(values, unit=unit, utc=True, errors="coerce")
+    if colspec.pandas_2():
+        return pd.to_datetime(values, utc=True, errors="coerce", format="mixed")
+    # pandas 1 parses each value on its own when the formats differ
+    return pd.to_datetime(values, utc=True, errors="coerce")
+
+
+class ColumnarSink:
+    """
+    :param path: output file, or output directory when partitioned
+    :param format: parquet or arrow
+    :param compression: codec - parquet: snappy, zstd, gzip, lz4, none; arrow: lz4, zstd, none
+    :param partition_by: None, day or month - Hive-style directories by the date of partition_field
+    :param partition_field: data-frame column the partition date is derived from (the range field)
+    :param append: add new part files to an existing output directory (incremental extracts) - path is always a
+                   directory
+    """
+    def __init__(self, path, format="parquet", compression=None, partition_by=None, partition_field=None,
+                 append=False):
+        if format not in FORMATS:
+            raise ColumnarSinkError("unknown output format " + str(format) + " - expected one of " + ",".join(FORMATS))
+        if partition_by and partition_by not in PARTITIONS:
+            raise ColumnarSinkError("unknown partitioning " + str(partition_by) + " - expected one of " + ",".join(PARTITIONS))
+        if partition_by and not partition_field:
+            raise ColumnarSinkError("partitioned output needs the range field")
+        if append and os.path.isfile(path):
+            raise ColumnarSinkError("cannot append to " + path + " - appended output is a directory of part files")
+        self.pa = import_pyarrow()
+        self.path = path
+        self.format = format
+        self.compression = compression or DEFAULT_COMPRESSION[format]
+        if self.compression == "none":
+            self.compression = None
+        self.partition_by = partition_by
+        self.partition_field = partition_field
+        self.append = append
+        self.schema = None
+        self.writers = {}  # output file -> (file handle, writer)
+        self.parts = {}  # output directory -> this run's part file
+        self.rows = 0
+        self.lock = threading.Lock()
+
+    def write(self, data):
+        """
+        Append a data-frame - one row group / record batch per output file it touches
+        """
+        with self.lock, metrics.timer(self.format + "_write"):
+            if not self.partition_by and not self.append:
+                self._write_table(self.path, data)
+            elif not self.partition_by:
+                self._write_table(self._part_file(self.path), data)
+            else:
+                if self.partition_field not in data.columns:
+                    raise ColumnarSinkError("partition field " + self.partition_field + " is not an extracted column")
+                name, fmt = PARTITION_FORMATS[self.partition_by]
+                keys = partition_dates(data[self.partition_field]).dt.strftime(fmt).fillna("unknown")
+                for key, part in data.groupby(keys.values, sort=True):
+                    directory = os.path.join(self.path, name + "=" + key)
+                    self._write_table(self._part_file(directory), part)
+            self.rows = self.rows + len(data)
+        metrics.incr(self.format + "_rows", len(data))
+
+    def _part_file(self, directory):
+        """
+        This run's file in an output directory - the first unused part-N, so earlier runs' files are kept
+        """
+        if directory not in self.parts:
+            n = 0
+            while os.path.exists(os.path.join(directory, "part-" + str(n) + EXTENSIONS[self.format])):
+                n = n + 1
+            self.parts[directory] = os.path.join(directory, "part-" + str(n) + EXTENSIONS[self.format])
+        return self.parts[directory]
+
+    def _table(self, data):
+        pa = self.pa
+        if self.schema is None:
+            schema = pa.Schema.from_pandas(data, preserve_index=False)
+            for i, field in enumerate(schema):
+                if pa.types.is_null(field.type):
+                    # an all-null column in the first batch gives a null type later batches cannot be cast to
+                    schema = schema.set(i, field.with_type(pa.string()))
+                elif pa.types.is_dictionary(field.type) and self.format == "arrow":
+                    # category cols - the IPC file format cannot replace a dictionary between batches
+                    schema = schema.set(i, field.with_type(field.type.value_type))
+                elif pa.types.is_dictionary(field.type):
+                    # category codes widen as new values appear in later batches
+                    schema = schema.set(i, field.with_type(pa.dictionary(pa.int32(), field.type.value_type)))
+            self.schema = schema.remove_metadata()
+        try:
+            return pa.Table.from_pandas(data, schema=self.schema, preserve_index=False)
+        except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+            raise ColumnarSinkError("batch does not match the output schema set by the first batch: " + str(e))
+
+    def _write_table(self, filename, data):
+        table = self._table(data)
+        if filename not in self.writers:
+            directory = os.path.dirname(filename)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            if self.format == "parquet":
+                writer = self.pa.parquet.ParquetWriter(filename, self.schema, compression=self.compression or "none")
+                self.writers[filename] = (None, writer)
+            else:
+                f = self.pa.OSFile(filename, "wb")
+                options = self.pa.ipc.IpcWriteOptions(compression=self.compression)
+                self.writers[filename] = (f, self.pa.ipc.new_file(f, self.schema, options=options))
+        self.writers[filename][1].write_table(table)
+
+    def close(self):
+        with self.lock:
+            for f, writer in self.writers.values():
+                writer.close()
+                if f is not None:
+                    f.close()
+            self.writers = {}
+            self.parts = {}
@@ -0,0 +1,60 @@
+"""
+Search response decoding
+
+Responses are parsed with orjson when it is installed (several times faster than the stdlib json module on large
+pages), else with json.  The parser is plugged into the ElasticSearch client as its JSON serializer, so every
+search / scroll page is decoded with it.  Either parser still builds one dict per hit; the page's _source dicts are
+collected in a list and colspec.build_frame reads one value list per configured col from them, which is cheaper
+than pandas' row-by-row DataFrame construction but does not avoid the dicts themselves.
+
+The "decoder" param of an input source selects the parser: orjson, json, or auto (default - orjson if installed).
+"""
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from elasticsearch.serializer import JSONSerializer
+from elasticsearch.exceptions import SerializationError
+
+DECODERS = ["auto", "orjson", "json"]
+
+
+class DecoderConfigError(Exception):
+    pass
+
+
+class OrjsonSerializer(JSONSerializer):
+    """
+    ElasticSearch client serializer that parses responses with orjson - request bodies are still written by the
+    stdlib serializer, they are small
+    """
+    def loads(self, s):
+        try:
+            return orjson.loads(s)
+        except (orjson.JSONDecodeError, TypeError) as e:
+            raise SerializationError(s, e)
+
+
+def decoder_name(name=None):
+    """
+    The parser to use for a "decoder" config value
+    """
+    name = (name or "auto").lower()
+    if name not in DECODERS:
+        raise DecoderConfigError("unknown decoder " + name + " - expected one of " + ",".join(DECODERS))
+    if name == "auto":
+        return "orjson" if orjson is not None else "json"
+    if name == "orjson" and orjson is None:
+        raise DecoderConfigError("decoder orjson selected but orjson is not installed - pip install orjson")
+    return name
+
+
+def serializer(name=None):
+    """
+    Serializer for the ElasticSearch client, None for the client default (stdlib json)
+    """
+    if decoder_name(name) == "orjson":
+        return OrjsonSerializer()
+    return None
@@ -0,0 +1,215 @@
+"""
+Hash based de-duplication of extracted rows
+
+Each row (or a configured set of key cols) is hashed to a 64-bit value with pd.util.hash_pandas_object,
+and only the hashes are remembered, so duplicates are found across every page of a run without
+building string copies of the data-frame.
+
+Seen-set backends:
+    memory - sorted numpy runs of hashes, 8 bytes per unique row
+    disk   - sqlite file of hashes, for runs too big to hold the hashes in memory
+    bloom  - fixed size bloom filter; bounded memory, but a small fraction (error rate) of unique rows
+             are reported as duplicates and dropped
+"""
+
+import math
+import os
+import sqlite3
+import threading
+
+import numpy
+import pandas as pd
+
+BACKENDS = ["memory", "disk", "bloom"]
+BLOOM_CAPACITY = 10000000
+BLOOM_ERROR_RATE = 0.0001
+SQLITE_BATCH = 500  # max host params per sqlite IN (...) lookup
+
+
+class DedupeConfigError(Exception):
+    pass
+
+
+def hash_rows(dataframe, keys=None):
+    """
+    :param dataframe:
+    :param keys: optional list of cols to hash on - default all cols
+    :return: numpy uint64 array, one hash per row
+    """
+    if keys:
+        missing = [k for k in keys if k not in dataframe.columns]
+        if missing:
+            raise DedupeConfigError("dedupe key cols not in data: " + ",".join(missing))
+        dataframe = dataframe[keys]
+    try:
+        return pd.util.hash_pandas_object(dataframe, index=False).values
+    except (TypeError, ValueError):
+        # nested list / dict values (EG execHosts) can't be hashed directly - hash their string form
+        dataframe = dataframe.apply(lambda col: col.map(_hashable) if col.dtype == object else col)
+        return pd.util.hash_pandas_object(dataframe, index=False).values
+
+
+def _hashable(value):
+    if isinstance(value, (list, dict)):
+        return str(value)
+    return value
+
+
+class MemorySeenSet:
+    """
+    Hashes held as sorted runs - each page is sorted on its own and a run is only merged into the one before it
+    once it has grown to the same size, so adding a page costs about its own size (amortised) and there are never
+    more than log2(rows) runs to search
+    """
+    def __init__(self):
+        self.runs = []
+
+    def contains(self, hashes):
+        found = numpy.zeros(len(hashes), dtype=bool)
+        for run in self.runs:
+            pos = numpy.searchsorted(run, hashes)
+            pos[pos == len(run)] = 0
+            found |= run[pos] == hashes
+        return found
+
+    def add(self, hashes):
+        if len(hashes) == 0:
+            return
+        self.runs.append(numpy.sort(hashes))
+        while len(self.runs) > 1 and len(self.runs[-2]) <= len(self.runs[-1]):
+            last = self.runs.pop()
+            self.runs[-1] = numpy.sort(numpy.concatenate([self.runs[-1], last]), kind="mergesort")
+
+    def close(self):
+        self.runs = []
+
+
+class DiskSeenSet:
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=OFF")
+        self.conn.execute("PRAGMA synchronous=OFF")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS seen (h INTEGER PRIMARY KEY)")
+
+    def contains(self, hashes):
+        # sqlite integers are signed 64-bit
+        signed = hashes.view(numpy.int64)
+        found = set()
+        for i in range(0, len(signed), SQLITE_BATCH):
+            chunk = [int(h) for h in signed[i:i + SQLITE_BATCH]]
+            stmt = "SELECT h FROM seen WHERE h IN ({})".format(",".join("?" for _ in chunk))
+            found.update(row[0] for row in self.conn.execute(stmt, chunk))
+        return numpy.array([int(h) in found for h in signed], dtype=bool)
+
+    def add(self, hashes):
+        signed = hashes.view(numpy.int64)
+        self.conn.executemany("INSERT OR IGNORE INTO seen (h) VALUES (?)", ((int(h),) for h in signed))
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class BloomSeenSet:
+    """
+    Bloom filter over the 64-bit row hashes - k bit positions per hash by double hashing the two 32-bit halves
+    """
+    def __init__(self, capacity=BLOOM_CAPACITY, error_rate=BLOOM_ERROR_RATE):
+        capacity = int(capacity)
+        error_rate = float(error_rate)
+        self.nbits = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.k = max(1, int(round(self.nbits / capacity * math.log(2))))
+        self.bits = numpy.zeros((self.nbits + 7) // 8, dtype=numpy.uint8)
+
+    def _positions(self, hashes):
+        h1 = (hashes & numpy.uint64(0xFFFFFFFF)).astype(numpy.uint64)
+        h2 = (hashes >> numpy.uint64(32)).astype(numpy.uint64)
+        i = numpy.arange(self.k, dtype=numpy.uint64)
+        return (h1[:, None] + i[None, :] * h2[:, None]) % numpy.uint64(self.nbits)
+
+    def contains(self, hashes):
+        if len(hashes) == 0:
+            return numpy.zeros(0, dtype=bool)
+        pos = self._positions(hashes)
+        bits = (self.bits[pos // numpy.uint64(8)] >> (pos % numpy.uint64(8)).astype(numpy.uint8)) & 1
+        return bits.all(axis=1)
+
+    def add(self, hashes):
+        if len(hashes) == 0:
+            return
+        pos = self._positions(hashes).ravel()
+        numpy.bitwise_or.at(self.bits, pos // numpy.uint64(8),
+                            numpy.left_shift(1, (pos % numpy.uint64(8)).astype(numpy.uint8)).astype(numpy.uint8))
+
+    def close(self):
+        self.bits = numpy.zeros(0, dtype=numpy.uint8)
+
+
+class Deduplicator:
+    """
+    Drop rows already seen in this data-frame or in any earlier data-frame passed to the same Deduplicator.
+    Safe to share between extract worker threads.
+    :param keys: list of cols that identify a row (EG ["jobID", "endTime"]) - default all cols
+    :param backend: memory / disk / bloom
+    :param path: sqlite file for the disk backend (removed on close)
+    :param capacity: expected unique rows for the bloom backend
+    :param error_rate: bloom false-positive rate
+    """
+    def __init__(self, keys=None, backend="memory", path=None, capacity=BLOOM_CAPACITY, error_rate=BLOOM_ERROR_RATE):
+        self.keys = keys
+        self.backend = backend
+        if backend == "memory":
+            self.seen = MemorySeenSet()
+        elif backend == "disk":
+            if path is None:
+                raise DedupeConfigError("disk dedupe needs a path")
+            self.seen = DiskSeenSet(path)
+        elif backend == "bloom":
+            self.seen = BloomSeenSet(capacity, error_rate)
+        else:
+            raise DedupeConfigError("unknown dedupe backend " + str(backend) + " - use one of " + ",".join(BACKENDS))
+        self.lock = threading.Lock()
+        self.rows = 0
+        self.dropped = 0
+
+    def drop_duplicates(self, dataframe):
+        """
+        :return: (de-duplicated data-frame, data-frame of the dropped rows)
+        """
+        if len(dataframe) == 0:
+            return dataframe, dataframe
+        hashes = hash_rows(dataframe, self.keys)
+        # first occurrence within this frame
+        keep = ~pd.Series(hashes).duplicated().values
+        with self.lock:
+            keep = keep & ~self.seen.contains(hashes)
+            self.seen.add(hashes[keep])
+            self.rows = self.rows + len(dataframe)
+            self.dropped = self.dropped + int((~keep).sum())
+        return dataframe[keep], dataframe[~keep]
+
+    def close(self):
+        self.seen.close()
+
+
+def from_config(params, path=None):
+    """
+    Deduplicator for a run from input source params:
+        dedupe:          memory (default) / disk / bloom / none
+        dedupekeys:      comma separated key cols - default all cols
+        dedupecapacity:  bloom expected unique rows
+        dedupeerrorrate: bloom false-positive rate
+    :return: Deduplicator, or None if dedupe is switched off
+    """
+    backend = params.get("dedupe", "memory").lower()
+    if backend == "none":
+        return None
+    keys = params.get("dedupekeys")
+    if keys:
+        keys = [k.strip() for k in keys.split(",") if k.strip()]
+    return Deduplicator(keys=keys or None, backend=backend, path=path,
+                        capacity=params.get("dedupecapacity", BLOOM_CAPACITY),
+                        error_rate=params.get("dedupeerrorrate", BLOOM_ERROR_RATE))
@@ -0,0 +1,152 @@
+"""
+Asyncio extract engine - many scroll cursors in flight from one thread
+
+The blocking client has one request in flight per thread, so with a remote cluster each cursor spends most of its
+time waiting on the network.  Here every (index, slice) task is a coroutine scrolling on the async client
+(AsyncElasticsearch, needs aiohttp); up to "concurrency" cursors have a request in flight at once.  Pages are handed
+to a thread pool for the DataFrame build and the write (CSV / database / Parquet sinks), so that work never blocks
+the event loop.  Each cursor fetches its next page while its previous page is written, and waits for that write
+before handing over another, so memory stays bounded at two pages per cursor.
+
+Selected with --engine async (or "engine: async" in the input source config).
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import esextract
+import metrics
+import elasticsearch_nosql
+
+CONCURRENCY = 8  # cursors in flight
+
+
+class AsyncEngineError(Exception):
+    pass
+
+
+def es_connect(params):
+    """
+    Async client for the ElasticSearch host configured for an input source - must be used (and closed) on the
+    event loop it is used from
+    """
+    try:
+        from elasticsearch import AsyncElasticsearch
+    except ImportError:
+        raise AsyncEngineError("the async engine needs the async ElasticSearch client - pip install elasticsearch[async]")
+    hosts, kwargs = elasticsearch_nosql.client_args(params)
+    return AsyncElasticsearch(hosts, **kwargs)
+
+
+async def scroll_pages(es, index_name, body, query_size, slice_id=None, slices=None,
+                       keepalive=elasticsearch_nosql.SCROLL_KEEPALIVE):
+    """
+    Async generator - elasticsearch_nosql.scroll_pages on the async client, one list of hits per page.
+    The scroll context is cleared when the generator finishes or is closed.
+    """
+    body = dict(body)
+    if slices and int(slices) > 1:
+        body["slice"] = {"id": slice_id, "max": int(slices)}
+    if "sort" not in body:
+        body["sort"] = ["_doc"]
+
+    with metrics.timer("es_fetch"):
+        page = await es.search(index=index_name, scroll=keepalive, size=query_size, body=body,
+                               filter_path=elasticsearch_nosql.SEARCH_FILTER_PATH)
+    sid = page['_scroll_id']
+    esextract.log("Index: " + index_name + elasticsearch_nosql.slice_label(slice_id, slices)
+                  + " Hits:" + str(elasticsearch_nosql.hits_total(page)))
+
+    try:
+        hits = elasticsearch_nosql.page_hits(page)
+        while len(hits) > 0:
+            metrics.incr("es_pages")
+            metrics.incr("es_hits", len(hits))
+            yield hits
+            with metrics.timer("es_fetch"):
+                page = await es.scroll(scroll_id=sid, scroll=keepalive,
+                                       filter_path=elasticsearch_nosql.SEARCH_FILTER_PATH)
+            sid = page['_scroll_id']
+            hits = elasticsearch_nosql.page_hits(page)
+    finally:
+        try:
+            await es.clear_scroll(scroll_id=sid)
+        except Exception as e:
+            metrics.incr("es_errors")
+            esextract.log("   Failed to clear scroll context: " + str(e), level="warning")
+
+
+def write_page(transform, writer, extract):
+    """
+    Build and write the DataFrame for one page - runs on the thread pool
+    """
+    writer.write(transform(extract))
+    return len(extract)
+
+
+async def extract_task(es, limit, pool, index_name, slice_id, slices, body, query_size, keepalive, transform, writer):
+    """
+    Extract one index (or one slice of an index), holding one of the "limit" cursor slots while it runs
+    :return: number of records "n" processed
+    """
+    loop = asyncio.get_running_loop()
+    n = 0
+    async with limit:
+        pages = scroll_pages(es, index_name, body, query_size, slice_id, slices, keepalive)
+        written = None
+        try:
+            async for hits in pages:
+                extract = [elasticsearch_nosql.hit_source(hit) for hit in hits]
+                esextract.log("Extracted " + str(len(extract)) + " records"
+                              + elasticsearch_nosql.slice_label(slice_id, slices))
+                if written is not None:
+                    n = n + await written
+                written = loop.run_in_executor(pool, write_page, transform, writer, extract)
+            if written is not None:
+                n = n + await written
+                written = None
+        finally:
+            await pages.aclose()
+            if written is not None:
+                # let a write already running on the pool finish before the error propagates
+                await asyncio.wait([written])
+    return n
+
+
+async def extract_all(params, tasks, body, query_size, transform, writer, concurrency, slices, keepalive):
+    es = es_connect(params)
+    limit = asyncio.Semaphore(concurrency)
+    pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="esextract-write")
+    running = [asyncio.ensure_future(extract_task(es, limit, pool, index_name, slice_id, slices, body, query_size,
+                                                  keepalive, transform, writer))
+               for index_name, slice_id in tasks]
+    try:
+        counts = await asyncio.gather(*running)
+    except BaseException:
+        # stop the other cursors (clearing their scrolls) before the client is closed
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+        raise
+    finally:
+        await es.close()
+        pool.shutdown(wait=True)
+    return sum(counts)
+
+
+def extract_tasks(params, tasks, body, query_size, transform, writer, concurrency=None, slices=None):
+    """
+    Run the (index, slice) tasks of a range extract on the asyncio engine
+    :param tasks: list of (index name, slice id or None)
+    :param transform: fn(extract) -> DataFrame, from elasticsearch_nosql.dataframe_builder()
+    :param writer: esextract.DataFrameWriter - called from the thread pool, must be thread-safe
+    :param concurrency: cursors in flight - defaults to "concurrency" config param or CONCURRENCY
+    :return: number of records "n" processed
+    """
+    if concurrency is None:
+        concurrency = params.get("concurrency", CONCURRENCY)
+    concurrency = int(concurrency)
+    keepalive = params.get("keepalive", elasticsearch_nosql.SCROLL_KEEPALIVE)
+    esextract.log("Async extract: " + str(len(tasks)) + " tasks, " + str(concurrency) + " cursors in flight")
+    return asyncio.run(extract_all(params, tasks, body, query_size, transform, writer, concurrency, slices,
+                                   keepalive))
@@ -2,16 +2,515 @@
 Elasticsearch extract functions
 """
 
-from elasticsearch import Elasticsearch
+from concurrent.futures import ThreadPoolExecutor
+import re
+import threading
 import esextract
+import metrics
+import colspec
+import pipeline
+import planner
+import indexprune
 
 QUERY_SIZE = 10000
+SCROLL_KEEPALIVE = '2m'
+PIT_KEEPALIVE = '5m'
+PIT_TIEBREAKER = '_shard_doc'
+ENGINES = ["scroll", "pit", "async"]
+
+AGG_NAME = "esextract_agg"
+AGG_PAGE_SIZE = 1000  # composite buckets per page
+AGG_METRICS = ["sum", "avg", "min", "max", "value_count", "cardinality"]
+AGG_FILTER_PATH = ["aggregations." + AGG_NAME + ".after_key", "aggregations." + AGG_NAME + ".buckets"]
+CALENDAR_INTERVALS = ["minute", "hour", "day", "week", "month", "quarter", "year"]
+
+# (host, port, decoder) -> shared Elasticsearch client - one connection pool per cluster for the whole process
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
+
+class AggregationSpecError(Exception):
+    pass
+
+# trim search / scroll responses to the parts the extract reads
+SEARCH_FILTER_PATH = ["_scroll_id", "pit_id", "hits.total", "hits.hits._id", "hits.hits._source", "hits.hits.fields",
+                      "hits.hits.sort"]
+
+def client_args(params):
+    """
+    Hosts and keyword args for an ElasticSearch client (sync or async) for an input source
+    :param params: dictionary of params for this ES input source - "decoder" selects the response JSON parser
+    :return: hosts, kwargs
+    """
+    import decoder
+    kwargs = {}
+    serializer = decoder.serializer(params.get("decoder"))
+    if serializer:
+        kwargs["serializer"] = serializer
+    return [{u'host': params['elasticsearchhost'], u'port': int(params['elasticsearchport'])}], kwargs
+
+
+def es_connect(params):
+    """
+    Connect to the ElasticSearch host configured for an input source.  Clients are cached per host / port /
+    decoder, so extracts run in the same process (EG jobs of a job file) share connections.
+    :param params: dictionary of params for this ES input source
+    :return: Elasticsearch client (thread-safe, can be shared between extract workers)
+    """
+    from elasticsearch import Elasticsearch
+    key = (params['elasticsearchhost'], str(params['elasticsearchport']), params.get("decoder"))
+    with _CLIENTS_LOCK:
+        if key not in _CLIENTS:
+            hosts, kwargs = client_args(params)
+            _CLIENTS[key] = Elasticsearch(hosts, **kwargs)
+            metrics.incr("es_clients_created")
+        return _CLIENTS[key]
+
+
+def build_range_query(filterkey, filterval, rangefield, startrange, endrange=None, equality=False,
+                      lower_op=None, upper_op=None):
+    """
+    Build the ElasticSearch search-body for a range extract, optionally filtered by a key-value pair
+    :param filterkey:
+    :param filterval:
+    :param rangefield:
+    :param startrange:
+    :param endrange: None or "None" means scan to end
+    :param equality: flag to switch on gte / lte equality range
+    :param lower_op: override the start-of-range operator ("gt" / "gte")
+    :param upper_op: override the end-of-range operator ("lt" / "lte")
+    :return: search-body dictionary
+    """
+    # Change to gte / lte equality range search
+    if lower_op is None:
+        lower_op = "gte" if equality else "gt"
+    if upper_op is None:
+        upper_op = "lte" if equality else "lt"
+
+    bounds = {lower_op: str(startrange)}
+    # if no end-range is specified, leave out the "lt" part of range search - search to end
+    if endrange is not None and str(endrange) != "None":
+        bounds[upper_op] = str(endrange)
+
+    # filter context - no relevance scoring
+    filters = [{"range": {rangefield: bounds}}]
+    if filterkey:
+        filters.insert(0, {"match": {filterkey: filterval}})
+    query = {"bool": {"filter": filters}}
+
+    ##esextract.log("DEBUG: dumping ES search-body")
+    ##esextract.log(json.dumps(query))
+
+    return {"query": query}
+
+
+def project_fields(body, fields, fetchfields="source"):
+    """
+    Restrict the search to the given fields so only those are sent back by ES
+    :param body: search-body dictionary - updated in place
+    :param fields: list of field names, EG the cols.conf cols
+    :param fetchfields: source - _source includes (default)
+                        docvalues - read from doc-values (keyword / numeric / date fields only), no _source
+                        stored - read stored fields, no _source
+    :return: body
+    """
+    fields = list(fields)
+    if fetchfields == "docvalues":
+        body["_source"] = False
+        body["docvalue_fields"] = fields
+    elif fetchfields == "stored":
+        body["_source"] = False
+        body["stored_fields"] = fields
+    else:
+        body["_source"] = {"includes": fields}
+    return body
+
+
+def hit_source(hit):
+    """
+    The field values of a hit - from _source, or from "fields" for doc-value / stored-field searches
+    (single values are un-wrapped from the list ES returns them in)
+    """
+    if '_source' in hit:
+        return hit['_source']
+    source = {}
+    for field, values in hit.get('fields', {}).items():
+        if len(values) == 1:
+            source[field] = values[0]
+        else:
+            source[field] = values
+    return source
+
+
+def page_hits(page):
+    """
+    The hits in a response - filter_path drops "hits.hits" altogether when there are none
+    """
+    return page.get('hits', {}).get('hits', [])
+
+
+def hits_total(page):
+    """
+    Total hits for a search response - ES 7+ reports {"value": n, "relation": "eq"} rather than an int
+    """
+    total = page['hits']['total']
+    if isinstance(total, dict):
+        total = total['value']
+    return total
+
+
+def scroll_pages(es, index_name, body, query_size, slice_id=None, slices=None, keepalive=SCROLL_KEEPALIVE):
+    """
+    Generator - scroll through the results of a search to handle > 10,000 records, one list of hits per page.
+    If slices > 1 this cursor only reads its own slice_id of the index (ES sliced-scroll)
+    Unless the body has a sort, docs come back in _doc (index) order - the cheapest order for a scroll.
+    The scroll context is cleared when the generator finishes or is closed.
+    """
+    body = dict(body)
+    if slices and int(slices) > 1:
+        body["slice"] = {"id": slice_id, "max": int(slices)}
+    if "sort" not in body:
+        body["sort"] = ["_doc"]
+
+    with metrics.timer("es_fetch"):
+        page = es.search(index=index_name,
+                         scroll = keepalive,
+                         size = query_size,
+                         body = body,
+                         filter_path = SEARCH_FILTER_PATH)
+    sid = page['_scroll_id']
+    esextract.log("Index: " + index_name + slice_label(slice_id, slices) + " Hits:" + str(hits_total(page)))
+
+    try:
+        # Get the number of results that we returned in the last scroll
+        while len(page_hits(page)) > 0:
+            metrics.incr("es_pages")
+            metrics.incr("es_hits", len(page_hits(page)))
+            yield page_hits(page)
+            with metrics.timer("es_fetch"):
+                page = es.scroll(scroll_id=sid, scroll=keepalive, filter_path=SEARCH_FILTER_PATH)
+            # Update the scroll ID
+            sid = page['_scroll_id']
+    finally:
+        try:
+            es.clear_scroll(scroll_id=sid)
+        except Exception as e:
+            metrics.incr("es_errors")
+            esextract.log("   Failed to clear scroll context: " + str(e), level="warning")
+
+
+def pit_sort(rangefield, tiebreaker=PIT_TIEBREAKER):
+    """
+    Sort for point-in-time pagination - range-field order with a unique tiebreaker so search_after never
+    skips or repeats docs.  _shard_doc is only valid within one PIT; use a unique field (EG a doc id field)
+    if the sort values need to be valid for resuming with a new PIT.
+    """
+    return [{rangefield: "asc"}, {tiebreaker: "asc"}]
+
+
+def pit_pages(es, index_name, body, query_size, sort, slice_id=None, slices=None, keepalive=PIT_KEEPALIVE,
+              search_after=None):
+    """
+    Generator - page through the results of a search with a point-in-time and search_after, one list of hits per page.
+    Each hit carries its "sort" values - pass the last hit's sort values back in as search_after to resume.
+    The keep-alive is renewed with every page, and the PIT is released when the generator finishes or is closed.
+    """
+    pit_id = es.open_point_in_time(index=index_name, keep_alive=keepalive)['id']
+    body = dict(body)
+    body["sort"] = sort
+    body["size"] = int(query_size)
+    body["track_total_hits"] = False
+    if slices and int(slices) > 1:
+        body["slice"] = {"id": slice_id, "max": int(slices)}
+    esextract.log("Index: " + index_name + slice_label(slice_id, slices) + " point-in-time opened")
+
+    try:
+        while True:
+            body["pit"] = {"id": pit_id, "keep_alive": keepalive}
+            if search_after is not None:
+                body["search_after"] = search_after
+            with metrics.timer("es_fetch"):
+                page = es.search(body=body, filter_path=SEARCH_FILTER_PATH)
+            # the PIT id can change between requests
+            pit_id = page.get('pit_id', pit_id)
+            hits = page_hits(page)
+            if len(hits) == 0:
+                break
+            metrics.incr("es_pages")
+            metrics.incr("es_hits", len(hits))
+            yield hits
+            search_after = hits[-1]['sort']
+    finally:
+        try:
+            es.close_point_in_time(body={"id": pit_id})
+        except Exception as e:
+            metrics.incr("es_errors")
+            esextract.log("   Failed to close point-in-time: " + str(e), level="warning")
+
+
+def page_reader(es, engine, body, query_size, rangefield=None, keepalive=None, tiebreaker=PIT_TIEBREAKER):
+    """
+    :param engine: scroll - scroll cursors
+                   pit - point-in-time + search_after
+    :return: fn(index_name, slice_id=None, slices=None) -> generator of pages of hits
+    """
+    if engine not in ["scroll", "pit"]:
+        raise AttributeError('unknown extract engine ' + str(engine) + ' - use one of ' + ",".join(ENGINES))
+
+    def reader(index_name, slice_id=None, slices=None):
+        if engine == "pit":
+            return pit_pages(es, index_name, body, query_size, pit_sort(rangefield, tiebreaker), slice_id, slices,
+                             keepalive or PIT_KEEPALIVE)
+        return scroll_pages(es, index_name, body, query_size, slice_id, slices, keepalive or SCROLL_KEEPALIVE)
+    return reader
+
+
+def slice_label(slice_id, slices):
+    if slices and int(slices) > 1:
+        return " Slice:" + str(slice_id) + "/" + str(slices)
+    return ""
+
+
+def dataframe_builder(cols_file, deduper=None):
+    """
+    :param deduper: run-wide dedupe.Deduplicator, or None for no de-duplication
+    :return: fn(extract) -> DataFrame
+    """
+    return lambda extract: esextract.create_dataframe(extract, cols_file, drop_duplicates=deduper is not None,
+                                                      deduper=deduper)
+
+
+def extract_index(reader, index_name, transform, writer, slice_id=None, slices=None):
+    """
+    Extract one index (or one slice of an index) and hand each page of results to the writer
+    :param reader: page reader from page_reader()
+    :param transform: fn(extract) -> DataFrame, from dataframe_builder()
+    :return: number of records "n" processed
+    """
+    extract = [] # extracted list of results
+    n = 0  # number of records processed
+
+    for hits in reader(index_name, slice_id, slices):
+        # Extract page data to extract list (append)
+        for hit in hits:
+            extract.append(hit_source(hit))
+            if (len(extract) % 10000) == 0:
+                print("#", end='')
+        print("\n")
+        esextract.log("Extracted " + str(len(extract)) + " records" + slice_label(slice_id, slices))
+
+        # write to database or CSV - create a Pandas Data frame and then write it out to DB/csv
+        data = transform(extract)
+        writer.write(data)
+
+        # reset the extract list
+        n = n + len(extract)
+        extract = []
+        esextract.log("Scrolling...")
+    return n
+
+
+def task_pages(reader, tasks, slices=None):
+    """
+    Generator - the pages of _source records for a list of (index, slice) tasks, one task after another
+    """
+    for index_name, slice_id in tasks:
+        for hits in reader(index_name, slice_id, slices):
+            yield [hit_source(hit) for hit in hits]
+
+
+def extract_pipelined(reader, tasks, transform, writer, workers=1, slices=None, queue_size=None):
+    """
+    Streaming extract - ES fetch, DataFrame build and writes run as concurrent stages linked by bounded queues.
+    Tasks are spread over "workers" fetch threads.
+    :return: number of records "n" processed
+    """
+    if queue_size is None:
+        queue_size = pipeline.QUEUE_SIZE
+    fetchers = [task_pages(reader, tasks[w::workers], slices) for w in range(0, workers)]
+    esextract.log("Pipelined extract: " + str(len(tasks)) + " tasks on " + str(workers) + " fetch threads"
+                  + " queue size " + str(queue_size))
+    etl = pipeline.Pipeline(fetchers,
+                            transform=transform,
+                            load=writer.write,
+                            queue_size=queue_size)
+    return etl.run()
+
+
+def extract_incremental(params, filterkey, filterval, rangefield, startrange, endrange, cols_file, writer,
+                        store, key, boundary_ids=None, engine=None, search_after=None, lower_op="gte", upper_op=None,
+                        deduper=None):
+    """
+    Incremental extract - read the range in range-field order across the whole indexmask with one cursor,
+    and advance the checkpoint after each page has been committed by the writer - in one transaction, so the
+    checkpoint never trails rows that are already loaded (DataFrameWriter atomic).
+    A resumed extract starts at the checkpoint value inclusive (gte); docs in boundary_ids were committed by the
+    previous run and are skipped, so it neither loses nor re-loads the docs sharing the checkpoint value.
+    A first run uses the operators of the other -r modes (gt, or gte with -e).
+    Also runs each shard of a sharded range extract (planner.py) - with the shard's own operators.
+    :param store: checkpoint.CheckpointStore
+    :param key: checkpoint key for this source / destination / search-key
+    :param boundary_ids: _ids of docs at startrange that are already committed
+    :param engine: scroll / pit - defaults to "engine" config param or scroll.  async reads with one scroll cursor
+                   (a single cursor gains nothing from the async engine)
+    :param search_after: pit engine only - sort values of the last committed doc, to resume exactly after it
+                         (needs a "tiebreaker" field in the config that is valid across PITs, not _shard_doc)
+    :param lower_op: start-of-range operator - gte (resume from a checkpoint, or -e) or gt (first run, first shard of a
+                     sharded extract)
+    :param upper_op: end-of-range operator - default lt
+    :param deduper: run-wide dedupe.Deduplicator shared with other shards - default one for this extract
+    :return: number of records loaded (after de-dupe)
+    """
+    try:
+        indexmask = params["indexmask"]
+    except:
+        indexmask = '*'
+    query_size = params.get("querylimit", QUERY_SIZE)
+
+    es = es_connect(params)
+    body = build_range_query(filterkey, filterval, rangefield, startrange, endrange, lower_op=lower_op,
+                             upper_op=upper_op)
+    # range-field is needed for the checkpoint value even if it isn't a loaded col
+    fields = [c.source for c in esextract.get_col_spec(cols_file)]
+    if rangefield not in fields:
+        fields = fields + [rangefield]
+    project_fields(body, fields, params.get("fetchfields", "source"))
+
+    if engine is None:
+        engine = params.get("engine", "scroll")
+    tiebreaker = params.get("tiebreaker", PIT_TIEBREAKER)
+    if engine == "pit":
+        if tiebreaker == PIT_TIEBREAKER:
+            search_after = None
+        pages = pit_pages(es, indexmask, body, query_size, pit_sort(rangefield, tiebreaker),
+                          keepalive=params.get("keepalive", PIT_KEEPALIVE), search_after=search_after)
+    else:
+        body["sort"] = [{rangefield: "asc"}, "_doc"]
+        pages = scroll_pages(es, indexmask, body, query_size, keepalive=params.get("keepalive", SCROLL_KEEPALIVE))
+
+    shared_deduper = deduper is not None
+    if not shared_deduper:
+        deduper = esextract.get_deduplicator(params)
+    transform = dataframe_builder(cols_file, deduper)
+
+    n = 0
+    loaded = 0  # rows written - less than n when duplicates are dropped
+    skip_ids = set(boundary_ids or [])
+    last_value = startrange
+    last_ids = set(skip_ids)
+    try:
+        for hits in pages:
+            extract = []
+            for hit in hits:
+                source = hit_source(hit)
+                value = colspec.get_path(source, rangefield.split("."))
+                if hit['_id'] in skip_ids and str(value) == str(startrange):
+                    continue
+                extract.append(source)
+                # track the docs at the highest range value committed so far
+                if str(value) != str(last_value):
+                    last_value = value
+                    last_ids = set()
+                last_ids.add(hit['_id'])
+            if extract:
+                data = transform(extract)
+                writer.write(data)
+                n = n + len(extract)
+                loaded = loaded + len(data)
+                store.save(key, last_value, last_ids, n, hits[-1].get('sort'))
+                esextract.log("Checkpoint " + key + " advanced to " + str(last_value) + " (" + str(n) + " records)")
+    finally:
+        # release the cursor now on a failed write - a sharded extract carries on with its other shards
+        pages.close()
+        if deduper and not shared_deduper:
+            deduper.close()
+    esextract.log("Total Data Extract and Load: " + str(n) + " records, " + str(loaded) + " loaded")
+    return loaded
+
+
+def extract_sharded(params, filterkey, filterval, rangefield, startrange, endrange, cols_file, writer, store, key,
+                    shards, method=None, equality=False, workers=None, engine=None):
+    """
+    Sharded range extract - split the range into sub-ranges (planner.plan) and extract each on its own worker with
+    its own checkpoint.  The plan is saved with the checkpoints, so re-running the same extract after a failure
+    re-uses it and every shard carries on from its last committed page; once all shards are done their
+    checkpoints are removed.
+    :param store: checkpoint.CheckpointStore
+    :param key: checkpoint key for this source / destination / search-key - shard keys are derived from it
+    :param shards: number of shards to plan
+    :param method: docs / width - defaults to "shardmethod" config param or docs
+    :param workers: shards extracted at once - default one worker per shard
+    :return: number of records loaded (after de-dupe)
+    """
+    try:
+        indexmask = params["indexmask"]
+    except:
+        indexmask = '*'
+    if method is None:
+        method = params.get("shardmethod", "docs")
+    if endrange is not None and str(endrange) == "None":
+        endrange = None
+
+    plan_key = (key + "|plan=" + str(startrange) + "#" + str(endrange) + "|" + str(shards) + "|" + method
+                + ("|equality" if equality else ""))
+    record = store.load(plan_key)
+    if record:
+        plan = [planner.Shard(*s) for s in record["value"]]
+        esextract.log("Sharded extract - resume plan " + plan_key + " (" + str(len(plan)) + " shards, saved "
+                      + record["updated"] + ")")
+    else:
+        es = es_connect(params)
+        body = build_range_query(filterkey, filterval, rangefield, startrange, endrange, equality)
+        plan = planner.plan(es, indexmask, body, rangefield, startrange, endrange, shards, method, equality)
+        store.save(plan_key, [s.as_list() for s in plan])
+
+    deduper = esextract.get_deduplicator(params)
+
+    def extract_shard(shard):
+        shard_key = key + "|shard=" + shard.label()
+        start, lower_op, boundary_ids, search_after = shard.start, shard.lower_op, None, None
+        shard_record = store.load(shard_key)
+        if shard_record:
+            # resume at the last committed value - inclusive, the docs already committed there are skipped
+            start, lower_op = shard_record["value"], "gte"
+            boundary_ids, search_after = shard_record["boundary_ids"], shard_record.get("search_after")
+            esextract.log("Shard [" + shard.label() + "] resume from checkpoint " + str(start))
+        return extract_incremental(params, filterkey, filterval, rangefield, start, shard.end, cols_file, writer,
+                                   store, shard_key, boundary_ids, engine, search_after, lower_op, shard.upper_op,
+                                   deduper)
+
+    workers = int(workers or len(plan))
+    esextract.log("Sharded extract: " + str(len(plan)) + " shards on " + str(workers) + " workers")
+    n = 0
+    errors = []
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [(shard, pool.submit(extract_shard, shard)) for shard in plan]
+            # let every shard finish (and checkpoint) before reporting a failure
+            for shard, future in futures:
+                try:
+                    n = n + future.result()
+                except Exception as e:
+                    esextract.log("Shard [" + shard.label() + "] failed: " + str(e), level="error")
+                    errors.append(e)
+    finally:
+        if deduper:
+            deduper.close()
+    if errors:
+        esextract.log(str(len(errors)) + " of " + str(len(plan)) + " shards failed - re-run the same extract to "
+                      "resume them from their checkpoints", level="error")
+        raise errors[0]
+    store.delete([plan_key] + [key + "|shard=" + shard.label() for shard in plan])
+    esextract.log("Total Data Extract and Load: " + str(n) + " records loaded")
+    return n
+
 
 def extract_data_range(params, inputsource, filterkey, filterval, rangefield, startrange, endrange=None, cols_file=None,
-                       csvfile=None, database_conf=None, equality=False):
+                       csvfile=None, database_conf=None, equality=False, workers=None, slices=None, pipelined=None,
+                       engine=None, upsert=False, sink=None):
     """
     Query ElasticSearch for a given filter and range-field with startrange and endrange vars
     Null endrange means scan to end.
+    Indices of the indexmask wholly outside the range are skipped - see indexprune.py
     Either dump to CSV or write to db during loop through of batches of results from ES
     :param params - dictionary of params for this ES input source
     :param inputsource - this is a config ref to the ES Host to read data from
@@ -24,7 +523,15 @@ def extract_data_range(params, inputsource, filterkey, filterval, rangefield, st
     :param csvfile:  path to file
     :param database_conf:  Config Identifier for Database
     :param equality: flag to switch on gte / lte equality range
-    :return: number of records "n" processes
+    :param workers: number of indices / slices to extract concurrently - defaults to "workers" config param or 1;
+                    for the async engine the cursors in flight - defaults to "concurrency" config param or 8
+    :param slices: number of sliced-scroll cursors per index - defaults to "slices" config param or 1
+    :param pipelined: run fetch / transform / load as concurrent stages - defaults to "pipeline" config param or False
+    :param engine: scroll - scroll cursors, pit - point-in-time + search_after, async - scroll cursors on the asyncio
+                   engine (elasticsearch_async); defaults to "engine" config param or scroll
+    :param upsert: write batches straight into the database table with ON CONFLICT on the configured key
+    :param sink: columnar.ColumnarSink for Parquet / Arrow output
+    :return: number of records loaded (after de-dupe)
     """
     #sections = esextract.getconfig(CONFIG_PATH)
     #params = sections[inputsource]
@@ -40,14 +547,30 @@ def extract_data_range(params, inputsource, filterkey, filterval, rangefield, st
     if cols_file is None:
         raise AttributeError('No Cols configuration specified')
 
+    if engine is None:
+        engine = params.get("engine", "scroll")
+    if engine == "async":
+        import elasticsearch_async
+    if workers is None and engine == "async":
+        workers = params.get("concurrency", elasticsearch_async.CONCURRENCY)
+    if workers is None:
+        workers = params.get("workers", 1)
+    workers = int(workers)
+    if slices is None:
+        slices = params.get("slices", 1)
+    slices = int(slices)
+    if pipelined is None:
+        pipelined = params.get("pipeline", "false").lower() in ("true", "yes", "1")
+
     # Query Elastic Search
     esextract.log("Extract Data between range " + startrange + " and " + endrange + " for " + rangefield)
     if filterkey:
         esextract.log(" for filterkey:" + filterkey + " filterval:" + filterval)
+    if endrange == "None":
+        esextract.log("No End-Range - scan to latest record")
     esextract.log("Query ElasticSearch at " + str(params['elasticsearchhost']) + " port " + str(params['elasticsearchport']))
-    es = Elasticsearch([{u'host': params['elasticsearchhost'], u'port': params['elasticsearchport']}])
+    es = es_connect(params)
 
-    extract = [] # extracted list of results
     n = 0  # number of records processed
 
     try:
@@ -60,168 +583,207 @@ def extract_data_range(params, inputsource, filterkey, filterval, rangefield, st
     except:
         query_size = QUERY_SIZE
 
-    #for index_name in es.indices.get('*'):
-    for index_name in es.indices.get(indexmask):
-        # scroll through results to handle > 10,000 records
-        body_string = """{
-                            "query": {
-                      """
-        if filterkey:
-            body_string = body_string + """
-                                "bool": {
-                                    "must": [{
-                                    "match": { "<filterkey>": "<filterval>"} } ,
-                                    {
-                                    """
-
-        body_string = body_string + """
-                                    "range": { "<rangefield>": {"gt": "<startrange>"
-                                                           ,"lt": "<endrange>"
-                                                          } 
-
-                                             }
-                                    """
-        if filterkey:
-            body_string = body_string + """
-                                    }
-                                    ]
-                                    """
-        body_string = body_string + """
-                                }
-                            }
-                         }
-                      """
-        # Change to gte / lte equality range search
-        if equality:
-            body_string = body_string.replace("\"gt\"", "\"gte\"" )
-            body_string = body_string.replace("\"lt\"", "\"lte\"")
-
-        # replace the tags in the template ElasticSearch query with filter vals
-        if filterkey:
-            body_string = body_string.replace("<filterkey>", filterkey)
-            body_string = body_string.replace("<filterval>", filterval)
-
-        body_string = body_string.replace("<rangefield>", rangefield)
-        body_string = body_string.replace("<startrange>", startrange)
-
-        # if no end-range is specified, remove the "lte" part of range search - search to end
-        if endrange == "None":
-            esextract.log("No End-Range - scan to latest record")
-            body_string = body_string.replace(",\"lte\": \"<endrange>\"", "")
-            body_string = body_string.replace(",\"lt\": \"<endrange>\"", "")
+    body = build_range_query(filterkey, filterval, rangefield, startrange, endrange, equality)
+    project_fields(body, [c.source for c in esextract.get_col_spec(cols_file)], params.get("fetchfields", "source"))
+    if upsert and not database_conf:
+        raise AttributeError('upsert needs a database')
+    writer = esextract.DataFrameWriter(csvfile=csvfile, database_conf=database_conf, upsert=upsert, sink=sink)
+    deduper = esextract.get_deduplicator(params)
+    transform = dataframe_builder(cols_file, deduper)
+
+    completed = False
+    try:
+        # one task per index, or per index-slice for sliced-scroll - skipping indices wholly outside the range
+        indices = indexprune.prune(es, params, indexmask, rangefield, startrange, endrange,
+                                   indexprune.list_indices(es, indexmask))
+        tasks = []
+        for index_name, docs in indices:
+            esextract.log("Index: " + index_name + " Total_Records:" + str(docs))
+            if slices > 1:
+                for slice_id in range(0, slices):
+                    tasks.append((index_name, slice_id))
+            else:
+                tasks.append((index_name, None))
+
+        if engine != "async":
+            reader = page_reader(es, engine, body, query_size, rangefield, params.get("keepalive"),
+                                 params.get("tiebreaker", PIT_TIEBREAKER))
+
+        if engine == "async":
+            n = elasticsearch_async.extract_tasks(params, tasks, body, query_size, transform, writer, workers, slices)
+        elif pipelined:
+            n = extract_pipelined(reader, tasks, transform, writer, workers, slices, params.get("queuesize"))
+        elif workers > 1:
+            esextract.log("Parallel extract: " + str(len(tasks)) + " tasks on " + str(workers) + " workers")
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(extract_index, reader, index_name, transform, writer, slice_id, slices)
+                           for index_name, slice_id in tasks]
+                for future in futures:
+                    n = n + future.result()
         else:
-            body_string = body_string.replace("<endrange>", endrange)
+            for index_name, slice_id in tasks:
+                n = n + extract_index(reader, index_name, transform, writer, slice_id, slices)
+        completed = True
+    finally:
+        # always close the writer - a Parquet / Arrow file without its footer is unreadable
+        try:
+            writer.close(completed)
+        finally:
+            if deduper:
+                esextract.log("Duplicates dropped: " + str(deduper.dropped))
+                deduper.close()
+    esextract.log("Total Data Extract and Load: " + str(n) + " records, " + str(writer.rows) + " loaded")
 
-        ##esextract.log("DEBUG: dumping ES search-body string")
-        ##esextract.log(body_string)
+    return writer.rows
 
-        page = es.search(index=index_name,
-                         scroll = '2m',
-                         size = query_size,
-                         body = body_string)
-
-        sid = page['_scroll_id']
-        scroll_size = page['hits']['total']
-        esextract.log("Index: " + index_name + " Total_Records:" + str(es.cat.indices(index_name).split()[6]) + " Hits:" + str(
-            scroll_size))
-
-        # Start scrolling
-        while (scroll_size > 0):
-            # Extract page data to extract list (append)
-            for i in range(0, len(page['hits']['hits'])):
-                payload = page['hits']['hits'][i]['_source']
-                extract.append(payload)
-                if (len(extract) % 10000) == 0:
-                    print("#", end='')
-            print("\n")
-            esextract.log("Extracted " + str(len(extract)) + " records")
-
-            # write to database or CSV - create a Pandas Data frame and then write it out to DB/csv
-            data = esextract.create_dataframe(extract, cols_file)
-            if database_conf:
-                #log("Inserting data to database table at " + database_conf)
-                esextract.dataframe_to_db(data, database_conf)
-            elif csvfile:
-                # log("Writing CSV data to " + csvfile)
-                esextract.write_csv(data, csvfile)
-            else:
-                esextract.write_stdout(data)
+def parse_agg_metrics(spec):
+    """
+    "sum:ru_utime,avg:avgMem,count" -> [("sum", "ru_utime"), ("avg", "avgMem")] - "count" (bucket doc counts) is
+    always returned so is accepted and dropped
+    """
+    agg_metrics = []
+    for item in [i.strip() for i in (spec or "").split(",") if i.strip()]:
+        if item == "count":
+            continue
+        func, _, field = item.partition(":")
+        if func not in AGG_METRICS or not field:
+            raise AggregationSpecError("bad aggregate metric " + item + " - expected <" + "|".join(AGG_METRICS)
+                                       + ">:<field> or count")
+        agg_metrics.append((func, field))
+    return agg_metrics
 
-            # reset the extract list
-            n = n + len(extract)
-            extract = []
-            esextract.log("Scrolling...")
-            page = es.scroll(scroll_id=sid, scroll='2m')
-            # Update the scroll ID
-            sid = page['_scroll_id']
-            # Get the number of results that we returned in the last scroll
-            scroll_size = len(page['hits']['hits'])
-    esextract.log("Total Data Extract and Load: " + str(n) + " records")
 
-    return n
+def agg_col_name(field):
+    # terms on "userName.keyword" come back as col "userName"
+    if field.endswith(".keyword"):
+        field = field[:-len(".keyword")]
+    return field.replace(".", "_")
 
-def extract_data_agg(params, filterkey='jobStatus', filterval='JOB_FINISH2', monthshist='now-12M', aggkey='cpuTime',
-                     aggtype='sum'):
+
+def interval_source(rangefield, interval):
+    """
+    Composite source bucketing the range field by interval:
+        calendar unit (minute hour day week month quarter year, or 1d / 1M style)  -> date_histogram calendar_interval
+        fixed time (EG 12h, 90m, 30d)                                             -> date_histogram fixed_interval
+        number (EG 86400 for daily buckets of an epoch-seconds field)             -> histogram
     """
-    ** !! WIP - NEEDS a RE_WRITE **
-    Push down a sum-aggregate query to ElasticSearch
-    Aggregate hard-coded to MONTHS
-    Supply key-value filter, date-range (needs to be months or years) - EG "gte": "now-12M"
-    Supply key to sum the value of - EG: "cpuTime"
-    return
-    ** This fn only aggregates a single field; compound elasticsearch aggregate is possible future enhancment
-    ** Didn't bother paging results; assume aggregate won't hit 100,000 record limit
+    if re.match(r"^[0-9.]+$", interval):
+        return {"histogram": {"field": rangefield, "interval": float(interval)}}, False
+    if interval in CALENDAR_INTERVALS or re.match(r"^1[mhdwMqy]$", interval):
+        return {"date_histogram": {"field": rangefield, "calendar_interval": interval}}, True
+    if re.match(r"^[0-9]+(ms|s|m|h|d)$", interval):
+        return {"date_histogram": {"field": rangefield, "fixed_interval": interval}}, True
+    raise AggregationSpecError("bad interval " + interval)
 
-    :param filterkey:
-    :param filterval:
-    :param monthshist:
-    :param aggkey:
-    :param aggtype:
-    :return: list of key-val list: [ 'YYYY-MM', <int> ]
+
+def build_agg_body(filterkey, filterval, rangefield, startrange, endrange, group_by, interval, agg_metrics,
+                   equality=False, page_size=AGG_PAGE_SIZE):
     """
-    #params = esextract.getconfig(CONFIG_PATH)
+    Search-body for a composite aggregation - size 0 (no hits), one composite source per group-by term plus an
+    optional interval source on the range field, and one sub-aggregation per metric
+    :return: body, list of (col name, source name, is_date) for the composite key cols
+    """
+    if startrange is not None and str(startrange) != "None":
+        body = build_range_query(filterkey, filterval, rangefield, startrange, endrange, equality)
+    elif filterkey:
+        body = {"query": {"bool": {"filter": [{"match": {filterkey: filterval}}]}}}
+    else:
+        body = {"query": {"match_all": {}}}
 
-    # Query Elastic Search
-    esextract.log("Aggregate Data for last n months:" + monthshist + " filterkey:" + filterkey + " filterval:" + filterval)
-    esextract.log("aggregating for " + aggkey)
+    sources = []
+    keys = []
+    for field in group_by:
+        sources.append({agg_col_name(field): {"terms": {"field": field, "missing_bucket": True}}})
+        keys.append((agg_col_name(field), agg_col_name(field), False))
+    if interval:
+        source, is_date = interval_source(rangefield, interval)
+        name = agg_col_name(rangefield)
+        sources.append({name: source})
+        keys.append((name, name, is_date))
+    if not sources:
+        raise AggregationSpecError("aggregate needs group-by terms and / or an interval")
+
+    body["size"] = 0
+    body["aggs"] = {AGG_NAME: {"composite": {"size": int(page_size), "sources": sources},
+                               "aggs": {func + "_" + agg_col_name(field): {func: {"field": field}}
+                                        for func, field in agg_metrics}}}
+    return body, keys
+
+
+def agg_pages(es, index_name, body):
+    """
+    Generator - the bucket lists of a composite aggregation, one page at a time, following after_key
+    """
+    composite = body["aggs"][AGG_NAME]["composite"]
+    while True:
+        with metrics.timer("es_agg_fetch"):
+            page = es.search(index=index_name, body=body, filter_path=AGG_FILTER_PATH)
+        result = page.get("aggregations", {}).get(AGG_NAME, {})
+        buckets = result.get("buckets", [])
+        metrics.incr("es_agg_pages")
+        metrics.incr("es_agg_buckets", len(buckets))
+        if buckets:
+            yield buckets
+        if not buckets or "after_key" not in result:
+            return
+        composite["after"] = result["after_key"]
+
+
+def agg_dataframe(buckets, keys, agg_metrics):
+    """
+    DataFrame from a page of composite buckets - the key cols, doc_count and one col per metric
+    """
+    import pandas as pd
+    data = {}
+    for name, source, is_date in keys:
+        values = [b["key"].get(source) for b in buckets]
+        if is_date:
+            # date_histogram keys are epoch milliseconds
+            values = pd.to_datetime(pd.Series(values, dtype="float64"), unit="ms", utc=True)
+        data[name] = values
+    data["doc_count"] = [b["doc_count"] for b in buckets]
+    for func, field in agg_metrics:
+        name = func + "_" + agg_col_name(field)
+        data[name] = [b.get(name, {}).get("value") for b in buckets]
+    return pd.DataFrame(data)
+
+
+def extract_data_agg(params, filterkey, filterval, rangefield, startrange=None, endrange=None, group_by=None,
+                     interval=None, agg_metrics=None, writer=None, equality=False):
+    """
+    Push the aggregation down to ElasticSearch - only the aggregated rows come back.
+    Buckets are paged with a composite aggregation so any number of groups can be returned; each page of buckets
+    is written to the writer as a DataFrame
+    :param params: dictionary of params for this ES input source - "aggsize" buckets per page
+    :param rangefield: range field, also bucketed by interval
+    :param startrange: None for no range filter
+    :param group_by: list of term fields to group by (keyword / numeric fields), EG ["userName.keyword", "queue"]
+    :param interval: bucket the range field - EG month, 1d, 12h, or a number for a numeric histogram
+    :param agg_metrics: list of (func, field) - func is one of AGG_METRICS - see parse_agg_metrics
+    :param writer: esextract.DataFrameWriter
+    :return: number of aggregated rows
+    """
+    group_by = group_by or []
+    agg_metrics = agg_metrics or []
+    indexmask = params.get("indexmask", "*")
+    body, keys = build_agg_body(filterkey, filterval, rangefield, startrange, endrange, group_by, interval,
+                                agg_metrics, equality, params.get("aggsize", AGG_PAGE_SIZE))
+
+    esextract.log("Aggregate " + indexmask + " by " + ",".join(group_by + ([rangefield + "/" + interval] if interval else []))
+                  + " metrics: " + ",".join(["count"] + [f + ":" + c for f, c in agg_metrics]))
     esextract.log("Query ElasticSearch at " + str(params['elasticsearchhost']) + " port " + str(params['elasticsearchport']))
-    es = Elasticsearch([{u'host': params['elasticsearchhost'], u'port': params['elasticsearchport']}])
-
-    # Final extracted list of results
-    extract = []
-    results = es.search(index="*", body={"query": {
-        "constant_score": {
-            "filter": {
-                "bool": {
-                    "must": [
-                        {"match": {"jobStatus": "JOB_FINISH2"}},
-                        {"range": {"@timestamp": {"gte": "now-12M"}}}
-                    ]
-                }
-            }
-        }
-    }
-        ,
-        "size": 0,
-        "aggs": {
-            "group_by_month": {
-                "date_histogram": {
-                    "field": "@timestamp",
-                    "interval": "month"
-                },
-                "aggs": {
-                    "aggValue": {aggtype: {"field": aggkey}}
-                }
-            }
-        }
-    })
-
-    esextract.log("Returned " + str(len(results['aggregations']['group_by_month']['buckets'])) + " aggregations")
-
-    for r in results['aggregations']['group_by_month']['buckets']:
-        month = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(r['key'] / 1000))[:7]  # ES down-grades to EPOC
-        val = round(r['aggValue']['value'], 2)
-        row = [month, val]
-        extract.append(row)
-
-    return extract
\ No newline at end of file
+    es = es_connect(params)
+
+    n = 0
+    completed = False
+    try:
+        for buckets in agg_pages(es, indexmask, body):
+            data = agg_dataframe(buckets, keys, agg_metrics)
+            writer.write(data)
+            n = n + len(data)
+            esextract.log("Aggregated " + str(n) + " rows")
+        completed = True
+    finally:
+        writer.close(completed)
+    esextract.log("Total Aggregated Rows: " + str(n))
+    return n
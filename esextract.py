@@ -6,9 +6,10 @@ Query some cols (based on a config file) from noSQL datasource and create a pand
 Extract a range of data between two vals based on a range-key and also filter by (another) key - value pair
 
 """
-# Python package imports
-import pandas as pd
+# Python package imports - pandas and the database / ElasticSearch clients are imported in the functions that need
+# them, so light modes (dumpparams, -m max-val) start fast
 import io
+import itertools
 import os
 import sys
 import math
@@ -17,9 +18,25 @@ import time
 import re
 import datetime
 import argparse
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+import uuid
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 # Modules
 import pwdutil  # utility for retreiving  password that is not stored in clear-text fmt.  Requires previous setup and .key file configuration
+import batching # adaptive database batch sizes
+import checkpoint # checkpoint store for incremental extracts
+import colspec # typed cols spec
+import columnar # Parquet / Arrow file sinks
 import elasticsearch_nosql # Elastics search data access functions
+import metrics # per-stage timers and counters
+import pipeline # Concurrent fetch / transform / load stages
+import planner # range sharding
 import postgres_db # Postgres DB functions
 
 if os.environ.get('CONFIG_PATH'):
@@ -43,6 +60,35 @@ else:
 
 CSV_PATH = LOG_ROOT + "/esextract.csv"
 
+LOGGER_NAME = "esextract"
+LOG_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+_LOGGER_LOCK = threading.Lock()
+CSV_SAMPLE_ROWS = 10000  # rows read to infer col dtypes for a chunked CSV import
+CSV_INT_PATTERN = r"[-+]?[0-9]+"
+
+if os.environ.get('CHECKPOINT_PATH'):
+    CHECKPOINT_PATH = os.environ.get('CHECKPOINT_PATH')
+else:
+    CHECKPOINT_PATH = LOG_ROOT + "/esextract_checkpoint.json"
+
+if os.environ.get('INDEXSTATS_PATH'):
+    INDEXSTATS_PATH = os.environ.get('INDEXSTATS_PATH')
+else:
+    INDEXSTATS_PATH = LOG_ROOT + "/esextract_indexstats.json"
+
+MERGE_STRATEGIES = ["except", "range", "nothing", "update"]
+UPSERT_TEMP_TABLE = "esextract_upsert"  # per-session temp table for COPY upserts
+LOAD_RETRIES = 1  # parallel load - retries of a failed partition from its last committed row
+_SHADOW_TABLE_IDS = itertools.count()
+
+# cols file -> parsed cols spec
+_COL_SPECS = {}
+_COL_SPECS_LOCK = threading.Lock()
+
+# database config section -> (params, password); read once per process, connections are pooled by postgres_db
+_DATABASE_PARAMS = {}
+_DATABASE_PARAMS_LOCK = threading.Lock()
+
 class ConfigFileAccessError(Exception):
     pass
 class ConfigFileParseError(Exception):
@@ -53,6 +99,10 @@ class DataExtractSourceClass(Exception):
     pass
 class ConfigNotFound(Exception):
     pass
+class PartitionLoadError(Exception):
+    pass
+class MergeConfigError(Exception):
+    pass
 
 def fileexists(fname):
     return (os.path.isfile(fname))
@@ -93,25 +143,76 @@ def getconfig(CONFIG_PATH):
     return sections
 
 
-def log(text, printFlag=True):
-    if printFlag:
-        print(gettimestamp(), text)
-    text = gettimestamp() + " " + str(text) + "\n"
-    with open(LOG_PATH, "a") as f:
-        f.write(text)
+class JsonLogFormatter(logging.Formatter):
+    """
+    One JSON object per line - for LOG_FORMAT=json
+    """
+    def format(self, record):
+        return json.dumps({"time": self.formatTime(record, LOG_DATE_FORMAT),
+                           "level": record.levelname,
+                           "thread": record.threadName,
+                           "message": record.getMessage()})
 
 
-def log_rotate():
-    if os.path.exists(LOG_PATH):
-        # Occasionally get spurious file permission / locking issues on windows
-        # don't let this interrupt the data-load
-        try:
-            PREVIOUS_LOG = LOG_PATH + ".previous"
-            if os.path.exists(PREVIOUS_LOG):
-                os.remove(PREVIOUS_LOG)
-            os.rename(LOG_PATH, PREVIOUS_LOG)
-        except:
-            pass
+def get_logger():
+    """
+    The esextract logger - set up on first use.  Records are put on an in-memory queue and written to
+    LOG_PATH by a background listener thread, so log I/O never stalls the extract / load loop.
+    Configured from the environment:
+        LOG_LEVEL         DEBUG / INFO (default) / WARNING / ERROR
+        LOG_FORMAT        text (default) / json
+        LOG_ROTATE        none (default) / size / time
+        LOG_MAX_BYTES     size rotation - bytes per file (default 10MB)
+        LOG_ROTATE_WHEN   time rotation - logging.handlers.TimedRotatingFileHandler "when" (default midnight)
+        LOG_BACKUP_COUNT  rotated files to keep (default 7)
+    """
+    logger = logging.getLogger(LOGGER_NAME)
+    with _LOGGER_LOCK:
+        if logger.handlers:
+            return logger
+        logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+        logger.propagate = False
+
+        os.makedirs(os.path.dirname(os.path.abspath(LOG_PATH)), exist_ok=True)
+        rotate = os.environ.get('LOG_ROTATE', 'none').lower()
+        backup_count = int(os.environ.get('LOG_BACKUP_COUNT', 7))
+        if rotate == "size":
+            file_handler = logging.handlers.RotatingFileHandler(
+                LOG_PATH, maxBytes=int(os.environ.get('LOG_MAX_BYTES', 10 * 1024 * 1024)), backupCount=backup_count)
+        elif rotate == "time":
+            file_handler = logging.handlers.TimedRotatingFileHandler(
+                LOG_PATH, when=os.environ.get('LOG_ROTATE_WHEN', 'midnight'), backupCount=backup_count)
+        else:
+            file_handler = logging.FileHandler(LOG_PATH)
+
+        if os.environ.get('LOG_FORMAT', 'text').lower() == "json":
+            file_handler.setFormatter(JsonLogFormatter())
+        else:
+            file_handler.setFormatter(logging.Formatter("%(asctime)s  %(message)s", LOG_DATE_FORMAT))
+
+        log_queue = queue.Queue(-1)
+        listener = logging.handlers.QueueListener(log_queue, file_handler)
+        listener.start()
+        # flush the queue and close the file at exit
+        atexit.register(listener.stop)
+        logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    return logger
+
+
+def log(text, printFlag=True, level="info"):
+    """
+    Log a message to LOG_PATH (asynchronously) and optionally echo it to the terminal
+    :param text:
+    :param printFlag: also print to the terminal
+    :param level: debug / info / warning / error
+    """
+    logger = get_logger()
+    levelno = logging.getLevelName(level.upper())
+    if not logger.isEnabledFor(levelno):
+        return
+    if printFlag:
+        print(gettimestamp(), text)
+    logger.log(levelno, str(text))
 
 
 def date_to_epoc(year, month, day, hr24, min=0, sec=0):
@@ -133,19 +234,36 @@ def epoc_to_date(epoc_timestamp):
 
 
 def get_cols(cols_file):
-    try:
-        if cols_file:
-            # Read in the columns to parse from the colsfile
-            f = open(cols_file, 'r')
-            cols = f.readlines()
-            f.close()
-            cols = [x.strip() for x in cols]
-    except Exception as e:
-        raise DataFrameColsSpecification(e)
-    return cols
+    """
+    DataFrame col names of a cols file
+    """
+    return [c.name for c in get_col_spec(cols_file)]
+
+def col_name(cols_file, field):
+    """
+    DataFrame col name of a source field - the cols spec may rename it (EG timestamp::@timestamp)
+    """
+    for col in get_col_spec(cols_file):
+        if col.source == field:
+            return col.name
+    return field
+
+def get_col_spec(cols_file):
+    """
+    The cols of a cols file as colspec.Column (name, type, source field) - parsed once per file and cached
+    """
+    with _COL_SPECS_LOCK:
+        if cols_file not in _COL_SPECS:
+            try:
+                # Read in the columns to parse from the colsfile
+                _COL_SPECS[cols_file] = colspec.read(cols_file)
+            except Exception as e:
+                raise DataFrameColsSpecification(e)
+        return _COL_SPECS[cols_file]
 
 def extract_data_range(inputsource, filterkey, filterval, rangefield, startrange, endrange=None, cols_file=None,
-                       csvfile=None, database_conf=None, equality = False):
+                       csvfile=None, database_conf=None, equality = False, workers=None, slices=None, pipelined=None,
+                       engine=None, upsert=False, sink=None):
     """
     function to call the correct NoSQL data-store (ES / Splunk etc)
     :param inputsource:
@@ -157,66 +275,232 @@ def extract_data_range(inputsource, filterkey, filterval, rangefield, startrange
     :param cols_file: Specify the location of a file containing list of cols to extract
     :param csvfile:
     :param database_conf:
-    :return:
+    :param workers: number of concurrent extract workers (overrides "workers" in the input source config)
+    :param slices: number of sliced-scroll cursors per index (overrides "slices" in the input source config)
+    :param pipelined: run fetch, DataFrame build and writes as concurrent stages (overrides "pipeline" in the input source config)
+    :param engine: ES pagination - scroll, pit or async (overrides "engine" in the input source config)
+    :param upsert: write each batch straight into the database table with ON CONFLICT on "upsertkey"
+    :param sink: columnar.ColumnarSink to write Parquet / Arrow output to
+    :return: number of records loaded (after de-dupe)
     """
 
     sections = getconfig(CONFIG_PATH)
     params = sections[inputsource]
 
     if params["class"] == "elasticsearch" :
-        n = elasticsearch_nosql.extract_data_range(params, inputsource, filterkey, filterval, rangefield, startrange, endrange, cols_file, csvfile, database_conf, equality)
+        n = elasticsearch_nosql.extract_data_range(params, inputsource, filterkey, filterval, rangefield, startrange, endrange, cols_file, csvfile, database_conf, equality,
+                                                   workers=workers, slices=slices, pipelined=pipelined,
+                                                   engine=engine, upsert=upsert, sink=sink)
     else:
         raise DataExtractSourceClass("unhandled class of extract type")
 
     return n
 
 
-def create_dataframe(extract, cols_file=None, cols=None, drop_duplicates=True):
+def extract_data_agg(inputsource, filterkey, filterval, rangefield, startrange=None, endrange=None, group_by=None,
+                     interval=None, agg_spec=None, csvfile=None, database_conf=None, equality=False, sink=None):
+    """
+    Aggregate in the NoSQL data-store and write the aggregated rows to the destination
+    :param group_by: comma separated term fields to group by
+    :param interval: bucket interval for the range field (EG month)
+    :param agg_spec: comma separated metrics - "count,sum:ru_utime,avg:avgMem"
+    :return: number of aggregated rows
+    """
+    sections = getconfig(CONFIG_PATH)
+    params = sections[inputsource]
+
+    if database_conf and csvfile:
+        raise AttributeError('cannot specify csvfile AND database')
+
+    if params["class"] == "elasticsearch" :
+        writer = DataFrameWriter(csvfile=csvfile, database_conf=database_conf, sink=sink)
+        n = elasticsearch_nosql.extract_data_agg(params, filterkey, filterval, rangefield, startrange, endrange,
+                                                 group_by=[g.strip() for g in (group_by or "").split(",") if g.strip()],
+                                                 interval=interval,
+                                                 agg_metrics=elasticsearch_nosql.parse_agg_metrics(agg_spec),
+                                                 writer=writer, equality=equality)
+    else:
+        raise DataExtractSourceClass("unhandled class of extract type")
+
+    return n
+
+
+def extract_incremental(inputsource, filterkey, filterval, rangefield, startrange=None, endrange=None, cols_file=None,
+                        csvfile=None, database_conf=None, engine=None, upsert=False, sink=None, equality=False):
+    """
+    Incremental extract driven by a checkpoint per source / destination / search-key.
+    Starts from the checkpointed range value if there is one, else from startrange; the checkpoint is
+    advanced after every page, and each page is loaded in one transaction (DataFrameWriter atomic), so a re-run
+    carries on from the last committed page without re-loading any of its rows.
+    :param equality: -e - first run only (no checkpoint): gte / lte range like the other -r modes, default gt / lt.
+                     A resumed run always re-reads from the checkpoint value inclusive, skipping its committed docs.
+    :return: number of records loaded (after de-dupe)
+    """
+    sections = getconfig(CONFIG_PATH)
+    params = sections[inputsource]
+
+    if database_conf and csvfile:
+        raise AttributeError('cannot specify csvfile AND database')
+
+    store = checkpoint.get_store(CHECKPOINT_PATH)
+    destination = database_conf or csvfile or (sink.path if sink else "stdout")
+    key = checkpoint.checkpoint_key(inputsource, destination, rangefield, filterkey, filterval)
+    record = store.load(key)
+    boundary_ids = None
+    search_after = None
+    lower_op = "gte" if equality else "gt"
+    upper_op = "lte" if equality else "lt"
+    if record:
+        lower_op = "gte"
+        startrange = record["value"]
+        boundary_ids = record["boundary_ids"]
+        search_after = record.get("search_after")
+        log("Incremental extract - resume " + key + " from checkpoint " + str(startrange) + " (updated " + record["updated"] + ")")
+    elif startrange is not None:
+        log("Incremental extract - no checkpoint for " + key + ", start from " + str(startrange))
+    else:
+        raise AttributeError('no checkpoint for ' + key + ' - specify a start range with -r')
+
+    if params["class"] == "elasticsearch" :
+        # one transaction per page - the checkpoint is advanced per page
+        writer = DataFrameWriter(csvfile=csvfile, database_conf=database_conf, upsert=upsert, sink=sink, atomic=True)
+        try:
+            n = elasticsearch_nosql.extract_incremental(params, filterkey, filterval, rangefield, startrange, endrange,
+                                                        cols_file, writer, store, key, boundary_ids, engine,
+                                                        search_after, lower_op, upper_op)
+        finally:
+            writer.close()
+    else:
+        raise DataExtractSourceClass("unhandled class of extract type")
+
+    return n
+
+
+def extract_sharded(inputsource, filterkey, filterval, rangefield, startrange, endrange=None, cols_file=None,
+                    csvfile=None, database_conf=None, equality=False, shards=2, shard_method=None, workers=None,
+                    engine=None, upsert=False, sink=None):
+    """
+    Range extract split into shards (sub-ranges) that are extracted in parallel, each with its own checkpoint -
+    see planner.py.  A failed run is resumed by running the same extract again.
+    :param shards: number of shards
+    :param shard_method: docs (balanced by doc count) / width - overrides "shardmethod" in the input source config
+    :param workers: shards extracted at once - default all of them
+    :return: number of records loaded (after de-dupe)
+    """
+    sections = getconfig(CONFIG_PATH)
+    params = sections[inputsource]
+
+    if database_conf and csvfile:
+        raise AttributeError('cannot specify csvfile AND database')
+    if startrange is None:
+        raise AttributeError('a sharded extract needs a start range with -r')
+
+    store = checkpoint.get_store(CHECKPOINT_PATH)
+    destination = database_conf or csvfile or (sink.path if sink else "stdout")
+    key = checkpoint.checkpoint_key(inputsource, destination, rangefield, filterkey, filterval)
+
+    if params["class"] == "elasticsearch" :
+        # one transaction per page - the checkpoint is advanced per page
+        writer = DataFrameWriter(csvfile=csvfile, database_conf=database_conf, upsert=upsert, sink=sink, atomic=True)
+        try:
+            n = elasticsearch_nosql.extract_sharded(params, filterkey, filterval, rangefield, startrange, endrange,
+                                                    cols_file, writer, store, key, shards, shard_method, equality,
+                                                    workers, engine)
+        finally:
+            writer.close()
+    else:
+        raise DataExtractSourceClass("unhandled class of extract type")
+
+    return n
+
+
+def create_dataframe(extract, cols_file=None, cols=None, drop_duplicates=True, deduper=None):
     """
     Create a Pandas DataFrame from a data "extract" list-of-lists
     Either pass in a cols-file to open or a list of col-names
+    Typed cols in the cols file (name:type) are converted to compact dtypes here, once per page
     :param extract:
     :param cols_file:
     :param cols:
+    :param drop_duplicates: drop duplicate rows
+    :param deduper: dedupe.Deduplicator shared across pages, to also drop rows seen in earlier pages.
+                    Default is a new Deduplicator - duplicates within this extract only
     :return: Pandas data-frame w
     """
     log("   Building Pandas DataFrame")
 
-    cols = get_cols(cols_file)
-
-    dataframe = pd.DataFrame(extract, columns=cols)
-    n = len(dataframe)
+    if cols_file:
+        columns = get_col_spec(cols_file)
+    else:
+        columns = [colspec.Column(c) for c in cols]
 
-    cols_list = re.sub(r' +', '', (str(dataframe.columns).replace(',', '\n').replace('\n\n', '\n')))
-    cols_list = re.sub(r'\(\[', '\n', cols_list)
-    cols_list = re.sub(r']\n', '', cols_list).replace("dtype='object')", "").replace("Index", "Columns:")
+    with metrics.timer("dataframe_build"):
+        dataframe = colspec.build_frame(extract, columns)
+    metrics.incr("rows_extracted", len(dataframe))
 
     if drop_duplicates:
-        original = dataframe
-        dataframe = dataframe.iloc[dataframe.astype(str).drop_duplicates().index]
-        
-        n_no_dup = len(dataframe)
-
-    if n != n_no_dup:
-        log("WARNING droppped duplicates: " + str(n - n_no_dup) )
-        timestamp = gettimestamp(simple=True)
-        log("Dumping original dataframe pre-dedupe")
-        fname = LOG_ROOT + "/" + timestamp + "original_" + ".csv"
-        write_csv(original, fname)
-        log("Dumping dataframe de-duped")
-        fname = LOG_ROOT + "/" + timestamp + "de_duped_" + ".csv"
-        write_csv(dataframe, fname)
+        if deduper is None:
+            import dedupe
+            deduper = dedupe.Deduplicator()
+        with metrics.timer("dedupe"):
+            dataframe, dropped = deduper.drop_duplicates(dataframe)
+
+        if len(dropped) > 0:
+            metrics.incr("duplicates_dropped", len(dropped))
+            log("WARNING droppped duplicates: " + str(len(dropped)), level="warning")
+            timestamp = gettimestamp(simple=True)
+            fname = LOG_ROOT + "/" + timestamp + "duplicates_" + ".csv"
+            log("Dumping dropped duplicate rows")
+            write_csv(dropped, fname)
 
     log("   Dimensions: " + str(dataframe.shape))
     return dataframe
 
-def get_database_conn(database_conf):
+def get_deduplicator(params):
+    """
+    Run-wide Deduplicator configured by the input source params (dedupe, dedupekeys, ...) - None if dedupe: none
+    """
+    import dedupe
+    # one file per Deduplicator - concurrent extracts in one process (jobrunner) must not share a seen-set
+    path = LOG_ROOT + "/dedupe_" + gettimestamp(simple=True) + "_" + str(os.getpid()) + "_" + uuid.uuid4().hex + ".sqlite"
+    return dedupe.from_config(params, path)
+
+def get_database_params(database_conf):
+    """
+    :param database_conf: Config Identifier that maps to database, host, port, username, tablename
+    :return: dictionary of params for the database config section
+    """
+    return get_database_credentials(database_conf)[0]
+
+def get_database_credentials(database_conf):
+    """
+    Config params and decoded password for a database config - cached so the config file and key files
+    are read once per process rather than once per scroll page
+    :return: (params, password)
+    """
+    with _DATABASE_PARAMS_LOCK:
+        if database_conf not in _DATABASE_PARAMS:
+            try:
+                sections = getconfig(CONFIG_PATH)
+                params = sections[database_conf]
+            except:
+                raise ConfigNotFound(database_conf)
+            # utility for retreiving obsfucated password from ./conf dir
+            password = pwdutil.decode(pwdutil.get_key(KEY_PATH + "/.key_" + database_conf), pwdutil.get_pwd(pwdfile=KEY_PATH + "/.pwd_" + database_conf))
+            _DATABASE_PARAMS[database_conf] = (params, password)
+    return _DATABASE_PARAMS[database_conf]
+
+def get_database_conn(database_conf, pooled=True):
+    """
+    Check out a connection from the pool for database_conf - caller must conn.close() to return it to the pool.
+    Pool sizing comes from the database config: poolsize (raised to loadworkers if lower), poolmaxoverflow,
+    poolrecycle (seconds)
+    :param pooled: False for a plain connection, closed by conn.close() - for one-off queries that do not need the
+                   pool (and its SQLAlchemy import)
+    :return: conn, database type, table name
+    """
     conn = None
-    try:
-        sections = getconfig(CONFIG_PATH)
-        params = sections[database_conf]
-    except:
-        raise ConfigNotFound(database_conf)
+    params, password = get_database_credentials(database_conf)
     username = params["dbusername"]
     host = params["dbhost"]
     port = params["dbport"]
@@ -224,12 +508,16 @@ def get_database_conn(database_conf):
     type = params["type"]
     table_name = params["table"]
 
-    # utility for retreiving obsfucated password from ./conf dir
-    password = pwdutil.decode(pwdutil.get_key(KEY_PATH + "/.key_" + database_conf), pwdutil.get_pwd(pwdfile=KEY_PATH + "/.pwd_" + database_conf))
-
     # Database Connect
-    if params["type"] == "postgres":
-        conn = postgres_db.connection(username, password, host, port, database)
+    if params["type"] == "postgres" and not pooled:
+        conn = postgres_db.direct_connection(username, password, host, port, database)
+    elif params["type"] == "postgres":
+        # at least one pooled connection per load worker - a parallel load would otherwise wait on the pool
+        pool_size = max(int(params.get("poolsize", postgres_db.POOL_SIZE)), int(params.get("loadworkers", 1)))
+        conn = postgres_db.connection(username, password, host, port, database, pool_key=database_conf
+                                      , pool_size=pool_size
+                                      , max_overflow=params.get("poolmaxoverflow", postgres_db.POOL_MAX_OVERFLOW)
+                                      , pool_recycle=params.get("poolrecycle", postgres_db.POOL_RECYCLE))
     else:
         log("Database Connect to " + params["type"] + " not supported")
 
@@ -237,20 +525,107 @@ def get_database_conn(database_conf):
 
 
 # def dataframe_to_db(data, table_name):
-def dataframe_to_db(data, database_conf, batch_size=None):
+def dataframe_to_db(data, database_conf, batch_size=None, upsert=False, atomic=False, stage=None):
     """
     pass a dataframe in for a bulk-insert to database
     :param data:  Pandas data-frame
     :param database_conf: Config Identifier that maps to database, host, port, username, tablename
+    :param batch_size: rows per commit - None for adaptive batch sizes driven by commit latency
+    :param upsert: insert-or-update on the "upsertkey" columns instead of a plain insert - see upsert_spec
+    :param atomic: load the whole data-frame in one transaction - no batches, no parallel load.  For checkpointed
+                   extracts, which advance the checkpoint once the data-frame is written
+    :param stage: StagedLoad of the run - load into its staging table, published by the caller at the end of the run.
+                  None with "loadswap: true" stages and publishes this data-frame on its own
     :return: (None)
-    """
 
-    # Get Database Connection, Database Type, Database Table Name
-    conn, type, table_name = get_database_conn(database_conf)
+    The "loadmethod" param of the database config selects how rows are sent:
+       insert (default) - batched INSERT statements
+       copy - COPY FROM STDIN; if a COPY batch fails it is re-run row-by-row to isolate and dump the bad rows
+    "loadworkers" > 1 selects a parallel load - see parallel_load.  "loadswap: true" selects a staged load -
+    see StagedLoad
+    """
+    params = get_database_params(database_conf)
+    workers = max(1, int(params.get("loadworkers", 1)))
+    swap = load_swap(params)
 
-    log("   Insert to database - table " + table_name)
+    log("   Insert to database - table " + params["table"])
     log("   Rows:" + str(len(data)))
 
+    spec = None
+    if upsert:
+        spec = upsert_spec(params)
+        # one row per key - ON CONFLICT DO UPDATE cannot touch the same target row twice in a statement
+        key_cols = {c.replace("@", ""): c for c in data.columns}
+        missing = [k for k in spec[0] if k not in key_cols]
+        if missing:
+            raise MergeConfigError("upsertkey columns not in the data: " + ",".join(missing)
+                                   + " - data columns are " + ",".join(data.columns))
+        data = data.drop_duplicates(subset=[key_cols[k] for k in spec[0]], keep="last")
+        if swap:
+            log("   loadswap is ignored for upsert loads", level="warning")
+            swap = False
+            stage = None
+    if atomic:
+        batch_size = max(1, len(data))
+        workers = 1
+        swap = False
+        stage = None
+
+    if swap and stage is None:
+        # a run of one data-frame (EG a -cin import) - staged and published here
+        stage = StagedLoad(database_conf)
+        try:
+            parallel_load(data, database_conf, workers, batch_size, spec, stage)
+        except BaseException:
+            stage.discard()
+            raise
+        stage.publish()
+    elif stage is not None or workers > 1:
+        parallel_load(data, database_conf, workers, batch_size, spec, stage)
+    else:
+        load_rows(data, database_conf, batch_size=batch_size, upsert=spec)
+
+def load_swap(params):
+    return params.get("loadswap", "false").lower() in ("true", "yes", "1")
+
+def upsert_spec(params):
+    """
+    Upsert settings of a database config:
+        upsertkey - natural key columns, EG jobID,submitTime (default mergekey); needs a unique index on the table
+        upsertaction - update (default) or nothing (keep the existing row)
+    :return: (key columns, action)
+    """
+    keys = split_keys(params.get("upsertkey") or params.get("mergekey"))
+    if not keys:
+        raise MergeConfigError("upsert needs upsertkey in the database config")
+    action = params.get("upsertaction", "update").lower()
+    if action not in ("update", "nothing"):
+        raise MergeConfigError("unknown upsertaction " + action + " - expected update or nothing")
+    return keys, action
+
+def conflict_clause(keys, columns, action="update"):
+    """
+    ON CONFLICT (keys) DO UPDATE SET <non-key columns> = EXCLUDED.<col> | DO NOTHING
+    """
+    updates = ",".join("{c} = EXCLUDED.{c}".format(c=c) for c in columns if c not in keys)
+    if action == "nothing" or not updates:
+        return "ON CONFLICT ({}) DO NOTHING".format(",".join(keys))
+    return "ON CONFLICT ({}) DO UPDATE SET {}".format(",".join(keys), updates)
+
+def load_rows(data, database_conf, table_name=None, batch_size=None, partition=None, upsert=None):
+    """
+    Load a data-frame on one pooled connection, one commit per batch
+    :param table_name: load into this table rather than the config table (EG a parallel load shadow table)
+    :param partition: LoadPartition being loaded - committed rows are counted on it, and a failed batch is
+                      left for the caller to retry / dump
+    :param upsert: (key columns, action) - insert-or-update into the table.  With loadmethod copy each batch is
+                   COPYed to a session temp table and merged into the table in the same transaction
+    """
+    # Get Database Connection, Database Type, Database Table Name
+    conn, type, config_table = get_database_conn(database_conf)
+    table_name = table_name or config_table
+    loadmethod = get_database_params(database_conf).get("loadmethod", "insert").lower()
+
     # Format data to insert
     df_columns = list(data)
     # Strip any "@' symbols - not supported in Postgres
@@ -263,79 +638,345 @@ def dataframe_to_db(data, database_conf, batch_size=None):
     # create INSERT INTO table (columns) VALUES('%s',...)
     insert_stmt = "INSERT INTO {} ({}) {}".format(table_name, columns, values)
 
-    #Logic in loop to break up bulk of dataframe into sets of iterations
+    upsert_stmts = None
+    if upsert:
+        keys, action = upsert
+        insert_stmt = insert_stmt + " " + conflict_clause(keys, df_columns, action)
+        if loadmethod == "copy":
+            # temp tables are per session - every pooled connection gets its own, reused across batches / pages
+            postgres_db.execute_statements(conn, ["CREATE TEMP TABLE IF NOT EXISTS {} (LIKE {} INCLUDING DEFAULTS)".format(
+                UPSERT_TEMP_TABLE, table_name)])
+            upsert_stmts = ["INSERT INTO {} ({}) SELECT {} FROM {} {}".format(
+                                table_name, columns, columns, UPSERT_TEMP_TABLE, conflict_clause(keys, df_columns, action)),
+                            "TRUNCATE {}".format(UPSERT_TEMP_TABLE)]
+
+    # Break the data-frame up into batches, one commit per batch.  A fixed batch_size is used as given;
+    # otherwise the batch size adapts to the measured commit latency (batching.AdaptiveBatcher)
     n = len(data)
+    batcher = None
     if batch_size:
-        iterations = math.ceil(len(data)/batch_size)
-        iter_mod = n % batch_size  # modulus to factor in uneven tail of items at end of loop
+        batch_size = int(batch_size)
+        log("   Batch Size:       " + str(batch_size))
+        log("   Batch Iterations: " + str(math.ceil(n / batch_size)))
     else:
-        iterations = 1
-        iter_mod = 0
-        batch_size = n
+        batcher = batching.get_batcher(database_conf, get_database_params(database_conf))
+        log("   Batch Size:       adaptive, next " + str(batcher.next_size()))
+    log("   Load Method:      " + loadmethod)
 
-    log("   Batch Size:       " + str(batch_size))
-    log("   Batch Iterations: " + str(iterations))
+    # estimated bytes per row, to keep adaptive batches within a memory budget
+    row_bytes = None
+    if batcher and n > 0:
+        sample = data.head(100)
+        row_bytes = sample.memory_usage(index=False, deep=True).sum() / len(sample)
 
-    for i in range(0, iterations):
-
-        if i == iterations - 1:
-            #final pass, need to factor in the mod left-over for uneven final batch
-            slice_start = (i * batch_size)
-            slice_end = (i * batch_size + batch_size - iter_mod)
-            data_slice = data[slice_start : slice_end]
-        else:
-            #print(i * batch_size, " ", i * batch_size + batch_size)
-            slice_start = (i * batch_size)
-            slice_end = (i * batch_size + batch_size)
-
-            data_slice = data[slice_start : slice_end ]
+    slice_start = 0
+    while slice_start < n:
+        slice_end = min(n, slice_start + (batch_size or batcher.next_size()))
+        data_slice = data[slice_start : slice_end]
 
         # Database Execute Insert an Numpy ndarray of Values = pandas df.values
+        started = time.perf_counter()
         try:
-            if type == "postgres":
+            if type == "postgres" and loadmethod == "copy":
+                copy_to_db(conn, table_name, columns, insert_stmt, data_slice, slice_start, slice_end, upsert_stmts)
+            elif type == "postgres":
                 #postgres_db.insert_statement(conn, insert_stmt, data.values)
-                postgres_db.insert_statement(conn, insert_stmt, data_slice.values, slice_start, slice_end)
+                postgres_db.insert_statement(conn, insert_stmt, db_values(data_slice), slice_start, slice_end)
             else:
                 log("Database Connect to " + type + " not supported")
-        except:
+        except Exception as e:
+            if batcher and postgres_db.is_retryable(e) and len(data_slice) > batcher.min_rows:
+                conn.rollback()
+                metrics.incr("db_retries")
+                log("   Retryable database error - retry with batch size " + str(batcher.on_error())
+                    + ": " + str(e).strip(), level="warning")
+                continue
+            log("Failed Insert: " + insert_stmt, level="error")
+            if partition is None:
                 timestamp = gettimestamp(simple=True)
-                log("Failed Insert: " + insert_stmt)
-                log("Dumping data-frame that failed to load to CSV file")
+                log("Dumping data-frame that failed to load to CSV file", level="error")
                 fname = LOG_ROOT + "/" + "failed_" + timestamp + ".csv"
                 write_csv(data_slice,fname)
-                raise
+            conn.close()
+            raise
+        if batcher:
+            batcher.record(len(data_slice), time.perf_counter() - started, row_bytes)
+        if partition is not None:
+            partition.committed = partition.committed + len(data_slice)
+        slice_start = slice_end
     conn.close()
 
+
+class LoadPartition:
+    """
+    One partition of a parallel load - rows start:end of the data-frame, and how many of them are committed
+    """
+    def __init__(self, number, start, end):
+        self.number = number
+        self.start = start
+        self.end = end
+        self.committed = 0
+        self.attempts = 0
+        self.error = None
+
+    def remaining(self, data):
+        return data[self.start + self.committed : self.end]
+
+def parallel_load(data, database_conf, workers, batch_size=None, upsert=None, stage=None):
+    """
+    Load a data-frame over "workers" pooled connections.  The frame is split into contiguous partitions, one per
+    worker, each committed batch by batch on its own connection.  A failed partition is retried from its last
+    committed row ("loadretries" times, default 1); if it still fails its uncommitted rows are dumped to
+    failed_<timestamp>_p<partition>.csv while the other partitions carry on.
+    upsert - (key columns, action) passed on to load_rows
+    stage - StagedLoad: load into its staging table instead.  A failed partition fails the load (and the run) with
+    nothing dumped - the caller discards the staging table, the target is untouched and the run can be re-run
+    :return: rows loaded
+    """
+    params = get_database_params(database_conf)
+    table_name = params["table"]
+    retries = int(params.get("loadretries", LOAD_RETRIES))
+    n = len(data)
+    if n == 0:
+        return 0
+
+    size = math.ceil(n / workers)
+    partitions = [LoadPartition(p, start, min(n, start + size)) for p, start in enumerate(range(0, n, size))]
+
+    target = table_name
+    if stage is not None:
+        target = stage.create()
+    log("   Parallel load: " + str(len(partitions)) + " partitions on " + str(min(workers, len(partitions)))
+        + " connections" + (" into staging table " + target if stage is not None else ""))
+
+    def load(partition):
+        while True:
+            partition.attempts = partition.attempts + 1
+            started = time.perf_counter()
+            try:
+                load_rows(partition.remaining(data), database_conf, table_name=target, batch_size=batch_size,
+                          partition=partition, upsert=upsert)
+                partition.error = None
+                metrics.observe("db_partition_load_seconds", time.perf_counter() - started)
+                return
+            except Exception as e:
+                partition.error = e
+                if partition.attempts > retries:
+                    metrics.incr("db_partitions_failed")
+                    return
+                metrics.incr("db_partition_retries")
+                log("   Partition " + str(partition.number) + " failed after " + str(partition.committed)
+                    + " committed rows - retrying: " + str(e).strip(), level="warning")
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(load, partitions))
+
+    failed = [p for p in partitions if p.error is not None]
+    if stage is not None and failed:
+        raise PartitionLoadError(str(len(failed)) + " of " + str(len(partitions)) + " partitions failed loading staging "
+                                 "table " + target + ": " + str(failed[0].error).strip())
+    if stage is not None:
+        return n
+
+    timestamp = gettimestamp(simple=True)
+    for p in failed:
+        fname = LOG_ROOT + "/" + "failed_" + timestamp + "_p" + str(p.number) + ".csv"
+        log("Partition " + str(p.number) + " failed - dumping " + str(p.end - p.start - p.committed)
+            + " uncommitted rows to " + fname, level="error")
+        write_csv(p.remaining(data), fname)
+    if failed:
+        raise PartitionLoadError(str(len(failed)) + " of " + str(len(partitions)) + " partitions failed: "
+                                 + str(failed[0].error).strip())
+    return n
+
+class StagedLoad:
+    """
+    Staged copy for "loadswap: true" - all-or-nothing per run.  Every data-frame of the run loads into one UNLOGGED
+    staging table (<table>_load_<pid>_<n>, created on the first load), which is copied into the target table and
+    dropped in a single transaction at the end of the run (publish).  If the run fails the staging table is dropped
+    (discard) and the target is untouched.  Not a rename swap - the target keeps its existing rows - so every row is
+    written twice, once to the staging table and once to the target.
+    """
+    def __init__(self, database_conf):
+        self.database_conf = database_conf
+        self.table_name = get_database_params(database_conf)["table"]
+        self.staging_table = self.table_name + "_load_" + str(os.getpid()) + "_" + str(next(_SHADOW_TABLE_IDS))
+        self.created = False
+        self.lock = threading.Lock()
+
+    def create(self):
+        """
+        :return: the staging table - created on the first call
+        """
+        with self.lock:
+            if not self.created:
+                run_statements(self.database_conf, ["CREATE UNLOGGED TABLE {} (LIKE {} INCLUDING DEFAULTS)".format(
+                    self.staging_table, self.table_name)])
+                self.created = True
+                log("   Staging table " + self.staging_table + " created for " + self.table_name)
+        return self.staging_table
+
+    def publish(self):
+        """
+        Copy the staged rows into the target table and drop the staging table, in one transaction
+        :return: rows published
+        """
+        with self.lock:
+            if not self.created:
+                return 0
+            rowcounts = run_statements(self.database_conf, [
+                "INSERT INTO {} SELECT * FROM {}".format(self.table_name, self.staging_table),
+                "DROP TABLE {}".format(self.staging_table)])
+            self.created = False
+        log("   Published " + str(rowcounts[0]) + " rows from staging table " + self.staging_table + " to "
+            + self.table_name)
+        return rowcounts[0]
+
+    def discard(self):
+        with self.lock:
+            if not self.created:
+                return
+            run_statements(self.database_conf, ["DROP TABLE IF EXISTS {}".format(self.staging_table)])
+            self.created = False
+        log("Load failed - staging table " + self.staging_table + " dropped, nothing loaded to " + self.table_name,
+            level="error")
+
+def run_statements(database_conf, statements):
+    """
+    Run statements against the database of database_conf in one transaction
+    :return: list of rowcounts
+    """
+    conn, type, table_name = get_database_conn(database_conf)
+    try:
+        return postgres_db.execute_statements(conn, statements)
+    finally:
+        conn.close()
+
+def db_values(data):
+    """
+    Data-frame values as an object ndarray for the database driver - NaN / NaT / pd.NA become None (NULL)
+    """
+    data = data.astype(object)
+    return data.where(data.notna(), None).values
+
+def copy_to_db(conn, table_name, columns, insert_stmt, data_slice, slice_start=None, slice_end=None, upsert_stmts=None):
+    """
+    COPY a slice of a data-frame to the database.  If the COPY fails, fall back to row-level INSERT
+    so the good rows still load; the rejected rows are dumped to a CSV file in LOG_ROOT
+    :param upsert_stmts: COPY into the upsert temp table instead, then run these statements (merge into
+                         table_name, empty the temp table) in the same transaction
+    """
+    try:
+        if upsert_stmts:
+            postgres_db.copy_statement(conn, UPSERT_TEMP_TABLE, columns, data_slice, slice_start, slice_end,
+                                       post_statements=upsert_stmts)
+        else:
+            postgres_db.copy_statement(conn, table_name, columns, data_slice, slice_start, slice_end)
+    except Exception as e:
+        if postgres_db.is_retryable(e):
+            # lock timeout / deadlock - not a bad-row problem, let the caller retry the batch
+            raise
+        log("COPY failed - retrying batch row-by-row to isolate bad rows", level="warning")
+        failed = postgres_db.insert_rows_isolate_errors(conn, insert_stmt, db_values(data_slice))
+        if failed:
+            timestamp = gettimestamp(simple=True)
+            fname = LOG_ROOT + "/" + "rejected_" + timestamp + ".csv"
+            log("Dumping " + str(len(failed)) + " rejected rows to CSV file " + fname, level="warning")
+            write_csv(data_slice.iloc[failed], fname)
+
 def merge_on_db(merge_target, database_conf, logPrintFlag=False):
     """
-    Merge the data in "database_conf" INTO the merge_target using
+    Merge the data in "database_conf" INTO the merge_target.  The "mergestrategy" param of the database config
+    selects the statement - see merge_statement.  The default is the original full-table comparison
        INSERT INTO merge_target SELECT * FROM database_conf EXCEPT SELECT * from merge_target
      - a different syntax is needed for Oracle (... MINUS SELECT * from merge_target)
-    Very simple approach is used that is not necessarily the most efficient for large indexed tables.
+    which hashes / sorts the whole of merge_target on every run; the keyed strategies only touch the rows
+    (or the key range) of the staging data.
     :param merge_target:
     :param database_conf:
-    :return:
+    :return: rows merged
     """
     log("Merge " + database_conf + " into " + merge_target)
     # Get Database Connection, Database Type, Database Table Name
     conn, type, table_name = get_database_conn(database_conf)
-
-    merge_stmt = "INSERT INTO {} SELECT * FROM {} EXCEPT SELECT * FROM {}".format(merge_target,table_name,merge_target)
+    params = get_database_params(database_conf)
 
     # Database Execute Query-Insert
     if type == "postgres":
-        rowcount = postgres_db.insert_merge_statement(conn, merge_stmt, logPrintFlag)
+        try:
+            columns = postgres_db.table_columns(conn, table_name)
+            merge_stmt = merge_statement(merge_target, table_name, columns, params.get("mergestrategy", "except"),
+                                         split_keys(params.get("mergekey")), params.get("mergerangekey"))
+            rowcount = postgres_db.insert_merge_statement(conn, merge_stmt, logPrintFlag)
+        finally:
+            conn.close()
         log("    " + str(rowcount) + " Rows")
+        return rowcount
     else:
         log("Database Connect to " + type + " not supported")
+        if conn:
+            conn.close()
+
+def split_keys(keys):
+    """
+    "col1, col2" config value -> ["col1", "col2"] ([] if not set)
+    """
+    if not keys:
+        return []
+    return [k.strip().replace("@", "") for k in keys.split(",") if k.strip()]
+
+def merge_statement(merge_target, table_name, columns, strategy="except", keys=None, range_key=None):
+    """
+    INSERT ... SELECT statement to merge staging table_name into merge_target
+    :param columns: staging table columns (same order as merge_target)
+    :param strategy:
+        except  - insert staging rows not already in the target, comparing every column against the whole target
+        range   - as except, but only compared with target rows inside the staging min/max of range_key; with keys,
+                  a NOT EXISTS anti-join on the keys within that range.  Index range_key (or keys) on the target
+        nothing - INSERT ... ON CONFLICT (keys) DO NOTHING - needs a unique index on keys in the target
+        update  - INSERT ... ON CONFLICT (keys) DO UPDATE - upsert, staging rows replace the target row
+    :param keys: merge key columns
+    :param range_key: column bounding the range strategy
+    :return: statement
+    """
+    strategy = (strategy or "except").lower()
+    keys = keys or []
+    if strategy not in MERGE_STRATEGIES:
+        raise MergeConfigError("unknown mergestrategy " + strategy + " - expected one of " + ",".join(MERGE_STRATEGIES))
+    if strategy in ("nothing", "update") and not keys:
+        raise MergeConfigError("mergestrategy " + strategy + " needs mergekey")
+    if strategy == "range" and not range_key:
+        raise MergeConfigError("mergestrategy range needs mergerangekey")
+
+    if strategy == "except":
+        return "INSERT INTO {} SELECT * FROM {} EXCEPT SELECT * FROM {}".format(merge_target, table_name, merge_target)
+
+    if strategy == "range":
+        # target rows inside the staging range only - the MIN / MAX sub-queries run once, then an index on
+        # range_key bounds the scan of the target
+        in_range = "t.{rk} >= (SELECT MIN({rk}) FROM {s}) AND t.{rk} <= (SELECT MAX({rk}) FROM {s})".format(
+            rk=range_key, s=table_name)
+        if not keys:
+            return "INSERT INTO {t} SELECT * FROM {s} EXCEPT SELECT t.* FROM {t} t WHERE {r}".format(
+                t=merge_target, s=table_name, r=in_range)
+        key_match = " AND ".join("t.{k} = s.{k}".format(k=k) for k in keys)
+        return ("INSERT INTO {t} SELECT DISTINCT s.* FROM {s} s WHERE NOT EXISTS "
+                "(SELECT 1 FROM {t} t WHERE {m} AND {r})").format(t=merge_target, s=table_name, m=key_match,
+                                                                   r=in_range)
+
+    # ON CONFLICT - DISTINCT ON so a key repeated in the staging data cannot hit the same target row twice
+    key_list = ",".join(keys)
+    select = "SELECT DISTINCT ON ({k}) * FROM {s}".format(k=key_list, s=table_name)
+    return "INSERT INTO {} {} {}".format(merge_target, select, conflict_clause(keys, columns, strategy))
 
 def delete_on_db(database_conf, logPrintFlag=False):
     """
 
     :param database_conf: delete data from the table associated with this configuration
     :param logPrintFlag:
-    :return:
+    :return: rows deleted
     """
+    rowcount = None
 
     # Get Database Connection, Database Type, Database Table Name
     conn, type, table_name = get_database_conn(database_conf)
@@ -348,6 +989,9 @@ def delete_on_db(database_conf, logPrintFlag=False):
         log("    " + str(rowcount) + " Rows")
     else:
         log("Database Connect to " + type + " not supported")
+    if conn:
+        conn.close()
+    return rowcount
 
 
 def maxval_from_db(search_key, database_conf, filterkey, filterval, logPrintFlag=False ):
@@ -362,8 +1006,8 @@ def maxval_from_db(search_key, database_conf, filterkey, filterval, logPrintFlag
 
     log("Get max-val for " + search_key, logPrintFlag)
 
-    # Get Database Connection, Database Type, Database Table Name
-    conn, type, table_name = get_database_conn(database_conf)
+    # Get Database Connection, Database Type, Database Table Name - a single query, no pool needed
+    conn, type, table_name = get_database_conn(database_conf, pooled=False)
 
     # Database Query
     if filterkey:
@@ -376,6 +1020,8 @@ def maxval_from_db(search_key, database_conf, filterkey, filterval, logPrintFlag
         records = postgres_db.select_statement(conn, select_stmt, logPrintFlag)
     else:
         log("Database Connect to " + type + " not supported")
+    if conn:
+        conn.close()
 
     if len(records) > 1:
         raise ValueError('Unexpected max-val, more than 1 record')
@@ -383,13 +1029,73 @@ def maxval_from_db(search_key, database_conf, filterkey, filterval, logPrintFlag
     return maxval
 
 
+class DataFrameWriter:
+    """
+    Hand each extracted data-frame to the selected destination - database, CSV file, columnar file sink or terminal.
+    Shared by concurrent extract workers: CSV and terminal writes are serialised with a lock,
+    database loads open their own connection so can run concurrently.
+    :param sink: columnar.ColumnarSink (Parquet / Arrow) - closed with the writer
+    :param atomic: one database transaction per write - see dataframe_to_db
+    rows counts the rows written - after de-dupe, so it can be less than the rows extracted
+    With "loadswap: true" in the database config the writes of the run are staged (StagedLoad) and published by
+    close() - or discarded if the run did not complete.
+    """
+    def __init__(self, csvfile=None, database_conf=None, upsert=False, sink=None, atomic=False):
+        self.csvfile = csvfile
+        self.database_conf = database_conf
+        self.upsert = upsert
+        self.sink = sink
+        self.atomic = atomic
+        self.stage = None
+        if atomic and database_conf:
+            params = get_database_params(database_conf)
+            if int(params.get("loadworkers", 1)) > 1 or load_swap(params):
+                log("loadworkers / loadswap are ignored - a checkpointed extract loads each page in one transaction",
+                    level="warning")
+        elif database_conf and not upsert and load_swap(get_database_params(database_conf)):
+            self.stage = StagedLoad(database_conf)
+        self.lock = threading.Lock()
+        self.rows = 0
+
+    def write(self, data):
+        if self.database_conf:
+            #log("Inserting data to database table at " + database_conf)
+            dataframe_to_db(data, self.database_conf, upsert=self.upsert, atomic=self.atomic, stage=self.stage)
+        elif self.csvfile:
+            # log("Writing CSV data to " + csvfile)
+            with self.lock:
+                write_csv(data, self.csvfile)
+        elif self.sink:
+            log("   Appending data to " + self.sink.format + " output " + self.sink.path)
+            self.sink.write(data)
+        else:
+            with self.lock:
+                write_stdout(data)
+        with self.lock:
+            self.rows = self.rows + len(data)
+
+    def close(self, completed=True):
+        """
+        :param completed: False if the run failed - a staged load is discarded rather than published
+        """
+        if self.stage and completed:
+            self.stage.publish()
+        elif self.stage:
+            self.stage.discard()
+        if self.sink:
+            self.sink.close()
+            log(str(self.sink.rows) + " rows written to " + self.sink.format + " output " + self.sink.path)
+
+
 def write_csv(data, filename):
     """
     Write out a CSV file.  Don't include header as may be incrementally building up a CSV
     Write-Append to existing file
     """
     log("   Appending data to file " + filename)
-    data.to_csv(filename, mode='a', header=False)
+    with metrics.timer("csv_write"):
+        data.to_csv(filename, mode='a', header=False)
+    metrics.incr("csv_rows", len(data))
 
 def read_csv(filename, drop_duplicates=True):
     """
@@ -397,6 +1103,8 @@ def read_csv(filename, drop_duplicates=True):
     Warnings and Errors from Pandas passed back in messages_list
     Attempt to remove duplicates by default.
     """
+    import dedupe
+    import pandas as pd
     log("Loading data from file (first line is database cols spec) " + filename)
     #redirect STD-ERR and STD-OUT to catch warnings / errors from reading in CSV
     real_stdout = sys.stdout
@@ -407,7 +1115,7 @@ def read_csv(filename, drop_duplicates=True):
     try:
         sys.stdout = fake_stdout
         sys.stderr = fake_stderr
-        data = pd.read_csv(filename, sep=',', error_bad_lines=False, warn_bad_lines=True, skipinitialspace=True)
+        data = pd.read_csv(filename, sep=',', skipinitialspace=True, **csv_bad_lines_args())
 
 
     finally:
@@ -419,9 +1127,10 @@ def read_csv(filename, drop_duplicates=True):
         fake_stdout.close()
         fake_stderr.close()
 
-        if drop_duplicates:
+        if drop_duplicates and data is not None:
             log("   Dropping duplicates")
-            data = data.iloc[data.astype(str).drop_duplicates().index]
+            data, dropped = dedupe.Deduplicator().drop_duplicates(data)
+            log("   Dropped " + str(len(dropped)) + " duplicates")
 
         message = message[2:] # remove b' prefix - seems to be left over from bytes convert to string
         message = message[:-2] # remove final '
@@ -429,15 +1138,149 @@ def read_csv(filename, drop_duplicates=True):
         return data, message_list
 
 
+def csv_bad_lines_args():
+    """
+    pd.read_csv args to skip and warn about malformed lines - error_bad_lines / warn_bad_lines were replaced
+    by on_bad_lines in Pandas 1.3
+    """
+    import pandas as pd
+    version = tuple(int(v) for v in re.findall(r'\d+', pd.__version__)[:2])
+    if version >= (1, 3):
+        return {"on_bad_lines": "warn"}
+    return {"error_bad_lines": False, "warn_bad_lines": True}
+
+
+def infer_csv_dtypes(filename, sample_rows=CSV_SAMPLE_ROWS):
+    """
+    Infer col dtypes once from the first sample_rows of a CSV, so every chunk of a chunked read gets the same types.
+    Integer cols are read as nullable Int64 - a later chunk may have gaps the sample did not.
+    The numeric cols of the whole file are then checked (read as text, a chunk at a time) and a col is widened to
+    float64 / object if a later value does not fit - so the import never fails on a cast after earlier chunks
+    are committed.
+    """
+    import pandas as pd
+    sample = pd.read_csv(filename, sep=',', nrows=sample_rows, skipinitialspace=True, **csv_bad_lines_args())
+    dtypes = {}
+    for col, dtype in sample.dtypes.items():
+        if pd.api.types.is_integer_dtype(dtype):
+            dtypes[col] = "Int64"
+        elif pd.api.types.is_float_dtype(dtype):
+            dtypes[col] = "float64"
+        else:
+            dtypes[col] = "object"
+
+    sampled = dict(dtypes)
+    numeric = [col for col, dtype in dtypes.items() if dtype != "object"]
+    if not numeric:
+        return dtypes
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        reader = pd.read_csv(filename, sep=',', skipinitialspace=True, usecols=numeric, dtype=object,
+                             chunksize=sample_rows * 10, **csv_bad_lines_args())
+        for chunk in reader:
+            for col in numeric:
+                values = chunk[col].dropna()
+                if dtypes[col] == "Int64" and not values.str.fullmatch(CSV_INT_PATTERN).all():
+                    dtypes[col] = "float64"
+                elif dtypes[col] == "Int64":
+                    # beyond int64 - pandas would wrap it silently; kept exact as text
+                    long_values = values[values.str.lstrip("+-").str.len() >= 19]
+                    if any(not -2 ** 63 <= int(v) < 2 ** 63 for v in long_values):
+                        dtypes[col] = "object"
+                if dtypes[col] == "float64" and pd.to_numeric(values, errors="coerce").isna().any():
+                    dtypes[col] = "object"
+            numeric = [col for col in numeric if dtypes[col] != "object"]
+            if not numeric:
+                break
+        reader.close()
+    for col, dtype in sampled.items():
+        if dtypes[col] != dtype:
+            log("   Col " + col + " read as " + dtypes[col] + " - values after the first " + str(sample_rows)
+                + " rows do not fit " + dtype, level="warning")
+    return dtypes
+
+
+def read_csv_chunks(filename, chunksize, dtypes=None):
+    """
+    Generator - read a CSV in data-frames of at most chunksize rows.  Bad-line warnings are logged.
+    """
+    import pandas as pd
+    reader = pd.read_csv(filename, sep=',', skipinitialspace=True, chunksize=int(chunksize), dtype=dtypes,
+                         **csv_bad_lines_args())
+    while True:
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            try:
+                chunk = next(reader)
+            except StopIteration:
+                break
+        for w in caught:
+            log("   " + str(w.message).strip())
+        yield chunk
+    reader.close()
+
+
+def import_csv(filename, database_conf, chunksize, batch_size=None, drop_duplicates=True, queue_size=2, upsert=False):
+    """
+    Streaming CSV import - read, de-duplicate and load to database a chunk at a time, so memory is bounded
+    by the chunk size rather than the file size.  Reading the next chunk overlaps with loading the previous one.
+    :param filename: CSV file - first line is database cols spec
+    :param database_conf: Config Identifier for Database
+    :param chunksize: rows per chunk
+    :param batch_size: rows per database commit
+    :param drop_duplicates: drop duplicate rows across the whole file
+    :param queue_size: max chunks buffered between read, de-dupe and load
+    :param upsert: insert-or-update on the "upsertkey" of the database config
+    :return: number of rows loaded
+    """
+    import dedupe
+    log("Streaming data from file (first line is database cols spec) " + filename + " in chunks of " + str(chunksize))
+    dtypes = infer_csv_dtypes(filename)
+    log("   Col types: " + ", ".join(col + ":" + str(dtype) for col, dtype in dtypes.items()))
+
+    deduper = dedupe.Deduplicator() if drop_duplicates else None
+    # every chunk loads into one staging table, published once the whole file is loaded
+    stage = None
+    if not upsert and load_swap(get_database_params(database_conf)):
+        stage = StagedLoad(database_conf)
+
+    def transform(chunk):
+        if deduper:
+            chunk, dropped = deduper.drop_duplicates(chunk)
+            if len(dropped) > 0:
+                log("   Dropped " + str(len(dropped)) + " duplicates")
+        return chunk
+
+    etl = pipeline.Pipeline([read_csv_chunks(filename, chunksize, dtypes)],
+                            transform=transform,
+                            load=lambda data: dataframe_to_db(data, database_conf, batch_size=batch_size, upsert=upsert,
+                                                              stage=stage),
+                            queue_size=queue_size)
+    try:
+        n = etl.run()
+    except BaseException:
+        if stage:
+            stage.discard()
+        raise
+    if stage:
+        stage.publish()
+    if deduper:
+        log("Duplicates dropped: " + str(deduper.dropped))
+        deduper.close()
+    log("Total rows loaded: " + str(n))
+    return n
+
+
 def write_stdout(data):
     cols = list(data)
     n = len(cols)
     log("   Printing to terminal: ")
+    metrics.incr("stdout_rows", len(data))
     for idx,row in data.iterrows():
         str_out = ""
         for i in range(0, n):
             #print(row[i],", ", end="")
-            str_out = str_out + str(row[i]) + ","
+            str_out = str_out + str(row.iloc[i]) + ","
         str_out = str_out[:-1] #remove last comma
         print(str_out)
 
@@ -454,6 +1297,10 @@ if __name__ == '__main__':
                     print("\t", sectionkey, ":", sectionval)
 
             exit(0)
+        if sys.argv[1] == "run":
+            # job file - many jobs in this process, sharing ES clients and database pools
+            import jobrunner
+            exit(jobrunner.main(sys.argv[2:]))
 
     parser = argparse.ArgumentParser(description="""** ElasticSearch extract utility to dump to CSV or Load to Postgres Database. ** 
 
@@ -473,8 +1320,18 @@ EXAMPLE - extract a range of values from a start-point to the highest value (unb
     $> python esextract.py -i MyElasticSearch -s endTime -r 1541680814 -k jobStatus -f JOB_FINISH -c ./range.csv
 EXAMPLE - extract a range of timestamp values
     $> python esextract.py -i AnOtherEsConfig -s @timestamp -r 2019-01-31T14:02:39.000Z#2019-02-01T14:02:39.000Z -k jobStatus -f JOB_FINISH2 -c ../test.csv
+EXAMPLE - extract a range across all indices in the indexmask on 8 workers, 4 scroll-slices per index
+    $> python esextract.py -i MyElasticSearch -s endTime -r 1541680814#1542967602 -w 8 --slices 4 -d MyDatabase
+EXAMPLE - split a range into 8 sub-ranges of about the same number of docs, extracted in parallel
+    $> python esextract.py -i MyElasticSearch -s endTime -r 1541680814#1542967602 --shards 8 -d MyDatabase
+EXAMPLE - incremental extract, carry on from the last committed value (first run starts from -r)
+    $> python esextract.py -i MyElasticSearch -s endTime -r 1541680814 -k jobStatus -f JOB_FINISH --incremental -d MyDatabase
+EXAMPLE - stream a large CSV file into a database table 100,000 rows at a time
+    $> python esextract.py -cin ./history.csv --chunksize 100000 -b 10000 -d MyDatabase
 EXAMPLE - dump the config
     $> python esextract.py dumpparams
+EXAMPLE - run the extract / merge / delete jobs of a job file in one process (see jobrunner.py)
+    $> python esextract.py run ./conf/jobs.conf
 
 """
     , formatter_class=argparse.RawTextHelpFormatter)
@@ -513,12 +1370,53 @@ EXAMPLE - dump the config
                             , help='database destination as defined in config file')
     group_dest.add_argument('-p', '--print_output', dest="print", action='store_true', default=None
                             , help='Print output')
+    group_dest.add_argument('--parquet', dest="parquet", action='store', default=None
+                            , help='Save as Parquet - a file, or a directory with --partition_by')
+    group_dest.add_argument('--arrow', dest="arrow", action='store', default=None
+                            , help='Save as Arrow IPC (Feather v2) - a file, or a directory with --partition_by')
+
+    parser.add_argument('--partition_by', dest="partition_by", action='store', default=None, choices=columnar.PARTITIONS
+                        , help='Parquet / Arrow output - Hive-style date=YYYY-MM-DD (day) or month=YYYY-MM directories by the -s searchkey')
+    parser.add_argument('--compression', dest="compression", action='store', default=None
+                        , help='Parquet / Arrow compression codec - parquet: snappy (default), zstd, gzip, none; arrow: lz4 (default), zstd, none')
 
     parser.add_argument('-e', '--equality', dest="equality", action='store_true', default=False
                             , help='range equality (greater-than-Equal and less-then-Equal)')
 
     parser.add_argument('-b', '--batch_size', dest="batch_size", action='store', default=None
-                        , help='specify an integer batch-size number - number of records to insert to database per batch iteration')
+                        , help='specify an integer batch-size number - number of records to insert to database per batch iteration (default adaptive)')
+
+    parser.add_argument('-w', '--workers', dest="workers", action='store', default=None
+                        , help='number of indices / scroll-slices to extract in parallel (default "workers" in source config, or 1; for --engine async "concurrency", or 8)')
+    parser.add_argument('--slices', dest="slices", action='store', default=None
+                        , help='number of sliced-scroll cursors per index (default "slices" in source config, or 1)')
+
+    parser.add_argument('--engine', dest="engine", action='store', default=None, choices=elasticsearch_nosql.ENGINES
+                        , help='ES pagination engine: scroll, pit (point-in-time + search_after), or async (many scroll cursors in flight on the asyncio client, -w sets how many) - default "engine" in source config, or scroll')
+    parser.add_argument('--shards', dest="shards", action='store', type=int, default=None
+                        , help='split the -r range into this many sub-ranges extracted in parallel, each with its own checkpoint - re-run to resume a failed run')
+    parser.add_argument('--shard_method', dest="shard_method", action='store', default=None, choices=planner.METHODS
+                        , help='--shards - docs: balanced by doc count (percentiles pre-query), width: equal-width sub-ranges (default "shardmethod" in source config, or docs)')
+    parser.add_argument('--incremental', dest="incremental", action='store_true', default=False
+                        , help='carry on from the checkpoint for this source / destination / searchkey (-r start only needed for the first run)')
+    parser.add_argument('--chunksize', dest="chunksize", action='store', default=None
+                        , help='with -cin, stream the CSV file to the database in chunks of this many rows')
+    parser.add_argument('--metrics', dest="metrics", action='store', default=None
+                        , help='write a JSON summary of per-stage timers and counters to this file at the end of the run')
+    parser.add_argument('--prometheus', dest="prometheus", action='store', default=None
+                        , help='write the run metrics in Prometheus text format to this file (textfile collector / pushgateway)')
+    parser.add_argument('--profile', dest="profile", action='store', default=None
+                        , help='run under cProfile and dump the stats to this file (view with python -m pstats) - worker threads are profiled too')
+    parser.add_argument('--pipeline', dest="pipeline", action='store_true', default=None
+                        , help='stream fetch, DataFrame build and database / CSV writes as concurrent stages (default "pipeline" in source config)')
+    parser.add_argument('--agg', dest="agg", action='store', default=None
+                        , help='aggregate in ElasticSearch instead of extracting rows - comma separated metrics, EG "count,sum:ru_utime,max:ru_maxrss" (sum avg min max value_count cardinality)')
+    parser.add_argument('--groupby', dest="groupby", action='store', default=None
+                        , help='--agg - comma separated term fields to group by, EG userName.keyword,queue')
+    parser.add_argument('--interval', dest="interval", action='store', default=None
+                        , help='--agg - bucket the -s searchkey: month, day, 1h ... (date fields) or a number (numeric fields)')
+    parser.add_argument('--upsert', dest="upsert", action='store_true', default=False
+                        , help='write straight into the -d table, insert-or-update on "upsertkey" in the database config (no staging table / -merge)')
 
     args = vars(parser.parse_args())
 
@@ -530,61 +1428,176 @@ EXAMPLE - dump the config
     elif args["csvfile_in"]:
         csvfile_in = args["csvfile_in"]
 
-    #log_rotate()  # Archive the old logfile
-
-    if args["batch_size"]:
-        batch_size = int(args["batch_size"])
-    else:
-        batch_size = None
-
-    #need cols_file for data-load, for CSV import get them from the header
-    if (args["max_val"] is False and args["csvfile_in"] is None and args["merge_target"] is None and args["delete_target"] is False):
-        cols_file = params[inputsource]["colsfile"]  # Cols spec to extract data for (and load cols spec for DB / csv)
-
-    if args["csvfile"]:
-        if fileexists(args["csvfile"]):
-            log("CSV file already exists - exiting")
-            exit(1)
 
-    if args["range"]:
-        print("Range set to", args["range"])
+    if args["profile"]:
+        # cProfile only sees the thread that enabled it - ThreadProfiler also profiles the worker threads
+        profiler = metrics.ThreadProfiler()
+        profiler.start()
+        if not profiler.per_thread:
+            log("Python 3.12+ - profiling every thread with one process-wide cProfile (sys.monitoring)")
 
-        #split range on "#" to hopefully avoid chars that appear in the key - else need a more sophisticated regex
-        startrange = args["range"].split("#")[0]
-        if len(args["range"].split("#")) == 2:
-            endrange = args["range"].split("#")[1]
+    # metrics / profile are written on failure (and exit(1)) too - they are most wanted for a run that went wrong
+    try:
+        if args["batch_size"]:
+            batch_size = int(args["batch_size"])
         else:
+            batch_size = None
+
+        #need cols_file for data-load, for CSV import get them from the header
+        if (args["max_val"] is False and args["csvfile_in"] is None and args["merge_target"] is None and args["delete_target"] is False):
+            cols_file = params[inputsource]["colsfile"]  # Cols spec to extract data for (and load cols spec for DB / csv)
+
+        # an incremental extract appends to the output of its earlier runs - the checkpoint says where it got to
+        if args["csvfile"] and not args["incremental"]:
+            if fileexists(args["csvfile"]):
+                log("CSV file already exists - exiting")
+                exit(1)
+
+        sink = None
+        if args["parquet"] or args["arrow"]:
+            output_format = "parquet" if args["parquet"] else "arrow"
+            output_path = args["parquet"] or args["arrow"]
+            if os.path.exists(output_path) and not args["incremental"]:
+                log(output_format + " output already exists - exiting")
+                exit(1)
+            # aggregated rows are named from the search key itself, extracted rows by the cols spec
+            partition_field = args["searchkey"]
+            if partition_field and not args["agg"]:
+                partition_field = col_name(cols_file, partition_field)
+            sink = columnar.ColumnarSink(output_path, output_format, compression=args["compression"],
+                                         partition_by=args["partition_by"], partition_field=partition_field,
+                                         append=bool(args["incremental"]))
+
+        if args["agg"]:
+            startrange = None
             endrange = None
+            if args["range"]:
+                startrange = args["range"].split("#")[0]
+                if len(args["range"].split("#")) == 2:
+                    endrange = args["range"].split("#")[1]
+
+            n = extract_data_agg(  inputsource=inputsource
+                                 , filterkey=args["key"]
+                                 , filterval=args["filter"]
+                                 , rangefield=args["searchkey"]
+                                 , startrange=startrange
+                                 , endrange=endrange
+                                 , group_by=args["groupby"]
+                                 , interval=args["interval"]
+                                 , agg_spec=args["agg"]
+                                 , csvfile=args["csvfile"]
+                                 , database_conf=args["database_conf"]
+                                 , equality=args["equality"]
+                                 , sink=sink
+                                 )
+
+        elif args["incremental"] and args["shards"]:
+            log("--shards cannot be combined with --incremental - each shard keeps its own checkpoint already")
+            exit(1)
 
-        n = extract_data_range(  inputsource=inputsource
-                               , filterkey=args["key"]
-                               , filterval=args["filter"]
-                               , rangefield=args["searchkey"]
-                               , startrange=startrange
-                               , endrange=endrange
-                               , cols_file=cols_file
-                               , csvfile=args["csvfile"]
-                               , database_conf=args["database_conf"]
-                               , equality=args["equality"]
-                               )
-
-    elif args["max_val"]:
+        elif args["incremental"]:
+            startrange = None
+            endrange = None
+            if args["range"]:
+                startrange = args["range"].split("#")[0]
+                if len(args["range"].split("#")) == 2:
+                    endrange = args["range"].split("#")[1]
+
+            n = extract_incremental(  inputsource=inputsource
+                                    , filterkey=args["key"]
+                                    , filterval=args["filter"]
+                                    , rangefield=args["searchkey"]
+                                    , startrange=startrange
+                                    , endrange=endrange
+                                    , cols_file=cols_file
+                                    , csvfile=args["csvfile"]
+                                    , database_conf=args["database_conf"]
+                                    , engine=args["engine"]
+                                    , upsert=args["upsert"]
+                                    , sink=sink
+                                    , equality=args["equality"]
+                                    )
+
+        elif args["range"]:
+            print("Range set to", args["range"])
+
+            #split range on "#" to hopefully avoid chars that appear in the key - else need a more sophisticated regex
+            startrange = args["range"].split("#")[0]
+            if len(args["range"].split("#")) == 2:
+                endrange = args["range"].split("#")[1]
+            else:
+                endrange = None
+
+            if args["shards"]:
+                n = extract_sharded(  inputsource=inputsource
+                                    , filterkey=args["key"]
+                                    , filterval=args["filter"]
+                                    , rangefield=args["searchkey"]
+                                    , startrange=startrange
+                                    , endrange=endrange
+                                    , cols_file=cols_file
+                                    , csvfile=args["csvfile"]
+                                    , database_conf=args["database_conf"]
+                                    , equality=args["equality"]
+                                    , shards=args["shards"]
+                                    , shard_method=args["shard_method"]
+                                    , workers=args["workers"]
+                                    , engine=args["engine"]
+                                    , upsert=args["upsert"]
+                                    , sink=sink
+                                    )
+            else:
+                n = extract_data_range(  inputsource=inputsource
+                                       , filterkey=args["key"]
+                                       , filterval=args["filter"]
+                                       , rangefield=args["searchkey"]
+                                       , startrange=startrange
+                                       , endrange=endrange
+                                       , cols_file=cols_file
+                                       , csvfile=args["csvfile"]
+                                       , database_conf=args["database_conf"]
+                                       , equality=args["equality"]
+                                       , workers=args["workers"]
+                                       , slices=args["slices"]
+                                       , pipelined=args["pipeline"]
+                                       , engine=args["engine"]
+                                       , upsert=args["upsert"]
+                                       , sink=sink
+                                       )
+
+        elif args["max_val"]:
         
-        maxval = maxval_from_db(args["searchkey"], args["database_conf"], args["key"], args["filter"], logPrintFlag=False )
-        log(maxval, False)
-        print(maxval)
-    elif args["csvfile_in"]:
-        data, message_list = read_csv(csvfile_in)
-        for message in message_list:
-            log("   " + message)
-        dataframe_to_db(data, args["database_conf"], batch_size=batch_size)
-    elif args["merge_target"]:
-        #print("DEBUG Selected Merge Operation", args["merge_target"], " on ", args["database_conf"])
-        merge_on_db(args["merge_target"], args["database_conf"], logPrintFlag=True)
-    elif args["delete_target"]:
-        #print("DEBUG Selected Delete Operation", args["database_conf"])
-        delete_on_db(args["database_conf"], logPrintFlag=True)
+            maxval = maxval_from_db(args["searchkey"], args["database_conf"], args["key"], args["filter"], logPrintFlag=False )
+            log(maxval, False)
+            print(maxval)
+        elif args["csvfile_in"] and args["chunksize"]:
+            import_csv(csvfile_in, args["database_conf"], int(args["chunksize"]), batch_size=batch_size, upsert=args["upsert"])
+        elif args["csvfile_in"]:
+            data, message_list = read_csv(csvfile_in)
+            for message in message_list:
+                log("   " + message)
+            dataframe_to_db(data, args["database_conf"], batch_size=batch_size, upsert=args["upsert"])
+        elif args["merge_target"]:
+            #print("DEBUG Selected Merge Operation", args["merge_target"], " on ", args["database_conf"])
+            merge_on_db(args["merge_target"], args["database_conf"], logPrintFlag=True)
+        elif args["delete_target"]:
+            #print("DEBUG Selected Delete Operation", args["database_conf"])
+            delete_on_db(args["database_conf"], logPrintFlag=True)
 
-    else:
-        print("Unhandled mode selected")
-        exit(1)
+        else:
+            print("Unhandled mode selected")
+            exit(1)
+    finally:
+        # release pooled database connections
+        postgres_db.dispose_engines()
+        if args["profile"]:
+            profiler.stop(args["profile"])
+            log("cProfile stats written to " + args["profile"])
+        if args["metrics"]:
+            metrics.REGISTRY.write_json(args["metrics"])
+            log("Metrics summary written to " + args["metrics"])
+        if args["prometheus"]:
+            metrics.REGISTRY.write_prometheus(args["prometheus"], {"input": args["inputsource"] or args["csvfile_in"] or "",
+                                                                   "destination": args["database_conf"] or args["csvfile"] or args["parquet"]
+                                                                                  or args["arrow"] or "stdout"})
+            log("Prometheus metrics written to " + args["prometheus"])
@@ -0,0 +1,273 @@
+"""
+Time-based index pruning - only search the indices of an indexmask whose docs can fall inside the -r range
+
+With thousands of daily indices (filebeat-YYYY.MM.DD) a range covering one day would otherwise run a search on every
+index.  Each index's time bounds come from one of:
+
+    pattern - the date in the index name, with "indexpattern" (EG filebeat-YYYY.MM.DD - tokens YYYY, YY, MM, DD, HH)
+              giving the layout and its finest token the period an index covers.  "indexslack" (default 1d) widens
+              each index's bounds for docs whose range field is later / earlier than the index date (late events,
+              jobs ending the day after they were logged).  Index names that do not match the pattern are kept.
+    stats   - min / max of the range field per index from one terms aggregation on _index, cached in
+              $LOG_ROOT/esextract_indexstats.json (override with INDEXSTATS_PATH).  The cache entry of an index
+              is reused while its docs.count is unchanged, so only new and still-written indices are re-queried.
+
+Selected with "indexprune: pattern / stats / none" in the input source config - pattern by default when
+"indexpattern" and "indexprunefield" are set.  Only range extracts on the time field named by "indexprunefield" (EG endTime) are pruned -
+any other -s field (EG jobID) has no relation to the index dates, so the whole indexmask is searched.
+Pruning is conservative: an index is searched unless its bounds are wholly outside the range,
+and ranges that cannot be compared (date math such as now-1d) search every index.
+Epoch values are compared in seconds - values above 1e11 are taken as milliseconds.
+"""
+
+import calendar
+import datetime
+import json
+import os
+import re
+import tempfile
+import threading
+
+import esextract
+import metrics
+import planner
+
+METHODS = ["none", "pattern", "stats"]
+STATS_AGG = "esextract_indices"
+SLACK = "1d"
+PATTERN_TOKENS = [("YYYY", "%Y"), ("YY", "%y"), ("MM", "%m"), ("DD", "%d"), ("HH", "%H")]
+SLACK_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+# one writer at a time for the stats cache - jobs in one process may prune concurrently
+_STATS_LOCK = threading.Lock()
+
+
+class IndexPruneError(Exception):
+    pass
+
+
+def list_indices(es, indexmask):
+    """
+    Open indices of the indexmask with their doc counts - one _cat/indices request for the whole mask
+    :return: list of (index name, docs.count), sorted by name
+    """
+    with metrics.timer("es_cat_indices"):
+        rows = es.cat.indices(index=indexmask, format="json", h="index,status,docs.count", expand_wildcards="open")
+    indices = []
+    for row in rows:
+        if row.get("status", "open") != "open":
+            continue
+        indices.append((row["index"], int(row.get("docs.count") or 0)))
+    return sorted(indices)
+
+
+def parse_slack(text):
+    """
+    "90" / "90s" / "15m" / "6h" / "1d" -> seconds
+    """
+    match = re.match(r"^([0-9]+)([smhd]?)$", str(text).strip())
+    if not match:
+        raise IndexPruneError("bad indexslack " + str(text) + " - expected <number>[s|m|h|d]")
+    return int(match.group(1)) * SLACK_UNITS[match.group(2) or "s"]
+
+
+def pattern_format(pattern):
+    """
+    filebeat-YYYY.MM.DD -> (strptime format filebeat-%Y.%m.%d, period token "DD")
+    """
+    text = pattern.replace("%", "%%")
+    finest = None
+    for token, directive in PATTERN_TOKENS:
+        if token in text:
+            text = text.replace(token, directive)
+            finest = token
+    if finest is None:
+        raise IndexPruneError("indexpattern " + pattern + " has no date tokens - expected some of "
+                              + ",".join(t for t, _ in PATTERN_TOKENS))
+    return text, finest
+
+
+def period_end(start, finest):
+    if finest == "HH":
+        return start + datetime.timedelta(hours=1)
+    if finest == "DD":
+        return start + datetime.timedelta(days=1)
+    if finest == "MM":
+        return start + datetime.timedelta(days=calendar.monthrange(start.year, start.month)[1])
+    return start.replace(year=start.year + 1)
+
+
+def pattern_bounds(index_name, date_format, finest):
+    """
+    [start, end) epoch seconds covered by an index from the date in its name, or None if the name does not match
+    """
+    try:
+        start = datetime.datetime.strptime(index_name, date_format).replace(tzinfo=datetime.timezone.utc)
+    except ValueError:
+        return None
+    return start.timestamp(), period_end(start, finest).timestamp()
+
+
+def epoch_seconds(number):
+    """
+    Range values and index bounds in epoch seconds - epoch milliseconds (and date field aggregations, which ES
+    reports in milliseconds) are scaled down
+    """
+    if number is not None and abs(number) > 1e11:
+        return number / 1000.0
+    return number
+
+
+def range_numbers(startrange, endrange):
+    """
+    :return: (start, end or None) in epoch seconds - None if the range cannot be compared with index bounds
+    """
+    start = planner.parse_value(startrange)
+    if start is None:
+        return None
+    if endrange is None or str(endrange) == "None":
+        return epoch_seconds(start[0]), None
+    end = planner.parse_value(endrange)
+    if end is None:
+        return None
+    return epoch_seconds(start[0]), epoch_seconds(end[0])
+
+
+def overlaps(low, high, start, end):
+    # inclusive on both sides - an index is only skipped when it is wholly outside the range
+    return high >= start and (end is None or low <= end)
+
+
+def stats_cache_key(params, rangefield):
+    return str(params.get("elasticsearchhost")) + ":" + str(params.get("elasticsearchport")) + "|" + rangefield
+
+
+def read_stats(path):
+    if not os.path.isfile(path):
+        return {}
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except Exception as e:
+        # a damaged cache only costs a re-query
+        esextract.log("Index stats cache " + path + " unreadable, rebuilding: " + str(e), level="warning")
+        return {}
+
+
+def write_stats(path, stats):
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".indexstats_")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(stats, f, indent=2)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def query_stats(es, indexmask, rangefield, names):
+    """
+    min / max of the range field for the named indices - one terms aggregation on _index
+    :return: {index name: {"min": value or None, "max": value or None}}
+    """
+    body = {"size": 0,
+            "query": {"terms": {"_index": names}},
+            "aggs": {STATS_AGG: {"terms": {"field": "_index", "size": len(names)},
+                                 "aggs": {"min": {"min": {"field": rangefield}},
+                                          "max": {"max": {"field": rangefield}}}}}}
+    with metrics.timer("es_index_stats"):
+        page = es.search(index=indexmask, body=body,
+                         filter_path=["aggregations." + STATS_AGG + ".buckets.key",
+                                      "aggregations." + STATS_AGG + ".buckets.min.value",
+                                      "aggregations." + STATS_AGG + ".buckets.max.value"])
+    buckets = page.get("aggregations", {}).get(STATS_AGG, {}).get("buckets", [])
+    return {b["key"]: {"min": b.get("min", {}).get("value"), "max": b.get("max", {}).get("value")} for b in buckets}
+
+
+def mask_match(indexmask, name):
+    pattern = "^(" + "|".join(re.escape(m.strip()).replace("\\*", ".*") for m in indexmask.split(",")) + ")$"
+    return re.match(pattern, name) is not None
+
+
+def index_stats(es, params, indexmask, rangefield, indices, path):
+    """
+    Cached min / max of the range field per index - indices that are new or whose docs.count changed are re-queried
+    :param indices: list of (index name, docs.count) from list_indices()
+    :return: {index name: {"docs": docs.count, "min": value, "max": value}}
+    """
+    key = stats_cache_key(params, rangefield)
+    with _STATS_LOCK:
+        cache = read_stats(path)
+        cached = cache.get(key, {})
+        stale = [name for name, docs in indices if name not in cached or cached[name].get("docs") != docs]
+        if stale:
+            esextract.log("Index stats: querying " + str(len(stale)) + " of " + str(len(indices)) + " indices")
+            fresh = query_stats(es, indexmask, rangefield, stale)
+            docs_count = dict(indices)
+            for name in stale:
+                values = fresh.get(name, {"min": None, "max": None})
+                cached[name] = {"docs": docs_count[name], "min": values["min"], "max": values["max"]}
+            # forget deleted indices that the mask still covers
+            listed = set(docs_count)
+            cache[key] = {name: stats for name, stats in cached.items()
+                          if name in listed or not mask_match(indexmask, name)}
+            write_stats(path, cache)
+            cached = cache[key]
+    return cached
+
+
+def prune(es, params, indexmask, rangefield, startrange, endrange, indices, path=None):
+    """
+    The indices of the indexmask that can hold docs in the range
+    :param indices: list of (index name, docs.count) from list_indices()
+    :param path: stats cache file - default esextract.INDEXSTATS_PATH
+    :return: list of (index name, docs.count) to search, in the same order
+    """
+    prunefield = params.get("indexprunefield")
+    method = params.get("indexprune", "pattern" if params.get("indexpattern") and prunefield else "none")
+    if method not in METHODS:
+        raise IndexPruneError("unknown indexprune " + str(method) + " - expected one of " + ",".join(METHODS))
+    if method == "none" or not indices:
+        return indices
+    if not prunefield:
+        esextract.log("Index pruning: indexprune " + method + " needs indexprunefield (the time field the indices "
+                      "are partitioned on) - searching every index", level="warning")
+        return indices
+    if rangefield != prunefield:
+        esextract.log("Index pruning: " + rangefield + " is not the index time field " + prunefield
+                      + " - searching every index")
+        return indices
+    numbers = range_numbers(startrange, endrange)
+    if numbers is None:
+        esextract.log("Index pruning: range " + str(startrange) + " - " + str(endrange)
+                      + " cannot be compared with index bounds - searching every index")
+        return indices
+    start, end = numbers
+
+    kept = []
+    if method == "pattern":
+        if not params.get("indexpattern"):
+            raise IndexPruneError("indexprune pattern needs an indexpattern")
+        date_format, finest = pattern_format(params["indexpattern"])
+        slack = parse_slack(params.get("indexslack", SLACK))
+        for name, docs in indices:
+            bounds = pattern_bounds(name, date_format, finest)
+            # the index period is half-open - a doc at the end of the period is in the next index
+            if bounds is None or (bounds[1] + slack > start and (end is None or bounds[0] - slack <= end)):
+                kept.append((name, docs))
+    else:
+        stats = index_stats(es, params, indexmask, rangefield, indices, path or esextract.INDEXSTATS_PATH)
+        for name, docs in indices:
+            low = epoch_seconds(stats.get(name, {}).get("min"))
+            high = epoch_seconds(stats.get(name, {}).get("max"))
+            # no min / max - no docs with the range field
+            if low is not None and high is not None and overlaps(low, high, start, end):
+                kept.append((name, docs))
+
+    metrics.incr("es_indices_pruned", len(indices) - len(kept))
+    esextract.log("Index pruning (" + method + "): searching " + str(len(kept)) + " of " + str(len(indices))
+                  + " indices")
+    return kept
@@ -0,0 +1,394 @@
+"""
+Job-file runner - many extract / load jobs in one process
+
+    $> python esextract.py run ./conf/jobs.conf
+
+A job file has one section per job, with the options of the equivalent esextract.py command line:
+
+    [runner]
+    workers: 4                          # jobs run at once
+    hostlimit: 2                        # jobs at once against any one ES / database host
+    hostlimits: es01:9200=4,pg01:5432=1 # per-host overrides
+
+    [extract_lsf]
+    mode: range
+    input: MyElasticSearch
+    searchkey: endTime
+    range: 1541680814#1542967602
+    database: PostgresStage
+
+    [merge_lsf]
+    mode: merge
+    after: extract_lsf
+    target: lsf_jobs
+    database: PostgresStage
+
+    [clear_stage]
+    mode: delete
+    after: merge_lsf
+    database: PostgresStage
+
+Modes and their options:
+    range, incremental  input, searchkey, range, key, filter, equality, cols, upsert, engine, workers, slices, pipeline
+                        (range only: shards, shard_method - split the range into checkpointed sub-ranges)
+    agg                 input, searchkey, range, key, filter, equality, agg, groupby, interval
+    maxval              database, searchkey, key, filter
+    csvin               csvin, database, chunksize, batch_size, upsert
+    merge               target, database
+    delete              database
+Destinations (extract modes): database, csvfile, parquet / arrow (with partition_by, compression) - none prints to
+the terminal.
+
+"after" lists the jobs that must finish first - a job is skipped if one of them fails.  Independent jobs run
+concurrently on the worker pool; a ready job waits while any host it uses is at its limit.  ElasticSearch clients
+and database connection pools are shared by all jobs.
+"""
+
+import argparse
+import configparser
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import esextract
+import columnar
+import metrics
+import postgres_db
+
+RUNNER_SECTION = "runner"
+MODES = ["range", "incremental", "agg", "maxval", "csvin", "merge", "delete"]
+EXTRACT_MODES = ["range", "incremental", "agg"]
+WORKERS = 4
+HOST_LIMIT = 2
+
+
+class JobFileError(Exception):
+    pass
+
+
+class Job:
+    """
+    :param name: job file section name
+    :param options: dictionary of the section's options
+    """
+    def __init__(self, name, options):
+        self.name = name
+        self.options = options
+        self.mode = options.get("mode")
+        if self.mode not in MODES:
+            raise JobFileError("job " + name + ": mode must be one of " + ",".join(MODES) + ", got " + str(self.mode))
+        self.after = [a.strip() for a in options.get("after", "").split(",") if a.strip()]
+
+    def get(self, option, default=None):
+        return self.options.get(option, default)
+
+    def flag(self, option):
+        return self.options.get(option, "false").lower() in ("true", "yes", "1")
+
+    def hosts(self, sections):
+        """
+        The ES / database hosts this job talks to, as host:port strings
+        """
+        hosts = []
+        source = self.get("input")
+        if source and self.mode in EXTRACT_MODES:
+            params = sections[source]
+            hosts.append(params["elasticsearchhost"] + ":" + str(params["elasticsearchport"]))
+        database = self.get("database")
+        if database:
+            params = sections[database]
+            hosts.append(params["dbhost"] + ":" + str(params["dbport"]))
+        return sorted(set(hosts))
+
+
+class JobResult:
+    def __init__(self, job, status, started=None, seconds=0.0, rows=None, value=None, error=None):
+        self.job = job
+        self.status = status
+        self.started = started
+        self.seconds = seconds
+        self.rows = rows
+        self.value = value
+        self.error = error
+
+    def as_dict(self):
+        return {"job": self.job.name, "mode": self.job.mode, "status": self.status, "started_s": self.started,
+                "seconds": round(self.seconds, 3), "rows": self.rows, "value": self.value, "error": self.error}
+
+
+def read_jobs(path):
+    """
+    :return: runner options dictionary, list of Jobs in file order
+    """
+    config = configparser.ConfigParser()
+    if not config.read(path):
+        raise JobFileError("cannot read job file " + path)
+    runner = dict(config[RUNNER_SECTION]) if config.has_section(RUNNER_SECTION) else {}
+    jobs = [Job(name, dict(config[name])) for name in config.sections() if name != RUNNER_SECTION]
+    check_jobs(jobs)
+    return runner, jobs
+
+
+def check_jobs(jobs):
+    """
+    Unknown "after" jobs and dependency cycles are errors
+    """
+    names = {job.name: job for job in jobs}
+    for job in jobs:
+        for dependency in job.after:
+            if dependency not in names:
+                raise JobFileError("job " + job.name + " runs after unknown job " + dependency)
+
+    done = set()
+    visiting = []
+
+    def visit(job):
+        if job.name in done:
+            return
+        if job.name in visiting:
+            raise JobFileError("job dependency cycle: " + " -> ".join(visiting[visiting.index(job.name):] + [job.name]))
+        visiting.append(job.name)
+        for dependency in job.after:
+            visit(names[dependency])
+        visiting.pop()
+        done.add(job.name)
+
+    for job in jobs:
+        visit(job)
+
+
+def parse_host_limits(runner):
+    """
+    :return: default limit, dictionary of host:port -> limit
+    """
+    default = max(1, int(runner.get("hostlimit", HOST_LIMIT)))
+    limits = {}
+    for item in [i.strip() for i in runner.get("hostlimits", "").split(",") if i.strip()]:
+        host, _, limit = item.rpartition("=")
+        if not host:
+            raise JobFileError("bad hostlimits entry " + item + " - expected host:port=N")
+        limits[host] = max(1, int(limit))
+    return default, limits
+
+
+class HostLimits:
+    """
+    Jobs running against each host - only touched by the scheduler thread
+    """
+    def __init__(self, default, limits):
+        self.default = default
+        self.limits = limits
+        self.running = {}
+
+    def available(self, hosts):
+        return all(self.running.get(h, 0) < self.limits.get(h, self.default) for h in hosts)
+
+    def take(self, hosts):
+        for h in hosts:
+            self.running[h] = self.running.get(h, 0) + 1
+
+    def release(self, hosts):
+        for h in hosts:
+            self.running[h] = self.running[h] - 1
+
+
+def split_range(text):
+    """
+    "FROM#TO" -> (FROM, TO), "FROM" -> (FROM, None), None -> (None, None)
+    """
+    if not text:
+        return None, None
+    parts = text.split("#")
+    return parts[0], parts[1] if len(parts) == 2 else None
+
+
+def job_sink(job, cols_file=None):
+    if not (job.get("parquet") or job.get("arrow")):
+        return None
+    output_format = "parquet" if job.get("parquet") else "arrow"
+    output_path = job.get("parquet") or job.get("arrow")
+    if os.path.exists(output_path) and job.mode != "incremental":
+        raise JobFileError("job " + job.name + ": " + output_format + " output " + output_path + " already exists")
+    partition_field = job.get("searchkey", "@timestamp")
+    if cols_file and job.mode != "agg":
+        partition_field = esextract.col_name(cols_file, partition_field)
+    return columnar.ColumnarSink(output_path, output_format, compression=job.get("compression"),
+                                 partition_by=job.get("partition_by"), partition_field=partition_field,
+                                 append=job.mode == "incremental")
+
+
+def run_job(job, sections):
+    """
+    Run one job - the same calls esextract.py makes for the equivalent command line
+    :return: rows processed, value (maxval only)
+    """
+    searchkey = job.get("searchkey", "@timestamp")
+    database_conf = job.get("database")
+    csvfile = job.get("csvfile")
+    batch_size = int(job.get("batch_size")) if job.get("batch_size") else None
+
+    if job.mode in EXTRACT_MODES:
+        if not job.get("input"):
+            raise JobFileError("job " + job.name + ": " + job.mode + " needs an input")
+        if csvfile and esextract.fileexists(csvfile) and job.mode != "incremental":
+            raise JobFileError("job " + job.name + ": CSV file " + csvfile + " already exists")
+        startrange, endrange = split_range(job.get("range"))
+        cols_file = job.get("cols", sections[job.get("input")].get("colsfile"))
+        sink = job_sink(job, cols_file)
+        if job.mode == "agg":
+            n = esextract.extract_data_agg(job.get("input"), job.get("key"), job.get("filter"), searchkey,
+                                           startrange, endrange, group_by=job.get("groupby"),
+                                           interval=job.get("interval"), agg_spec=job.get("agg"), csvfile=csvfile,
+                                           database_conf=database_conf, equality=job.flag("equality"), sink=sink)
+        elif job.mode == "incremental":
+            n = esextract.extract_incremental(job.get("input"), job.get("key"), job.get("filter"), searchkey,
+                                              startrange, endrange, cols_file=cols_file, csvfile=csvfile,
+                                              database_conf=database_conf, engine=job.get("engine"),
+                                              upsert=job.flag("upsert"), sink=sink, equality=job.flag("equality"))
+        else:
+            if startrange is None:
+                raise JobFileError("job " + job.name + ": range needs a range")
+            if job.get("shards"):
+                n = esextract.extract_sharded(job.get("input"), job.get("key"), job.get("filter"), searchkey,
+                                              startrange, endrange, cols_file=cols_file, csvfile=csvfile,
+                                              database_conf=database_conf, equality=job.flag("equality"),
+                                              shards=int(job.get("shards")), shard_method=job.get("shard_method"),
+                                              workers=job.get("workers"), engine=job.get("engine"),
+                                              upsert=job.flag("upsert"), sink=sink)
+                return n, None
+            n = esextract.extract_data_range(job.get("input"), job.get("key"), job.get("filter"), searchkey,
+                                             startrange, endrange, cols_file=cols_file, csvfile=csvfile,
+                                             database_conf=database_conf, equality=job.flag("equality"),
+                                             workers=job.get("workers"), slices=job.get("slices"),
+                                             pipelined=job.flag("pipeline") or None, engine=job.get("engine"),
+                                             upsert=job.flag("upsert"), sink=sink)
+        return n, None
+
+    if not database_conf:
+        raise JobFileError("job " + job.name + ": " + job.mode + " needs a database")
+    if job.mode == "maxval":
+        value = esextract.maxval_from_db(searchkey, database_conf, job.get("key"), job.get("filter"))
+        return None, value
+    if job.mode == "csvin":
+        if job.get("chunksize"):
+            return esextract.import_csv(job.get("csvin"), database_conf, int(job.get("chunksize")),
+                                        batch_size=batch_size, upsert=job.flag("upsert")), None
+        data, message_list = esextract.read_csv(job.get("csvin"))
+        for message in message_list:
+            esextract.log("   " + message)
+        esextract.dataframe_to_db(data, database_conf, batch_size=batch_size, upsert=job.flag("upsert"))
+        return len(data), None
+    if job.mode == "merge":
+        if not job.get("target"):
+            raise JobFileError("job " + job.name + ": merge needs a target")
+        return esextract.merge_on_db(job.get("target"), database_conf, logPrintFlag=True), None
+    return esextract.delete_on_db(database_conf, logPrintFlag=True), None
+
+
+def timed_job(job, sections, run_start):
+    started = time.perf_counter()
+    esextract.log("Job " + job.name + " (" + job.mode + ") started")
+    try:
+        with metrics.timer("job_" + job.name):
+            rows, value = run_job(job, sections)
+    except (Exception, SystemExit) as e:
+        # SystemExit - some helpers exit() on bad config (EG a missing password key); fail this job only
+        seconds = time.perf_counter() - started
+        esextract.log("Job " + job.name + " failed after " + str(round(seconds, 1)) + "s: " + str(e), level="error")
+        return JobResult(job, "failed", round(started - run_start, 3), seconds, error=type(e).__name__ + ": " + str(e))
+    seconds = time.perf_counter() - started
+    esextract.log("Job " + job.name + " finished in " + str(round(seconds, 1)) + "s")
+    return JobResult(job, "ok", round(started - run_start, 3), seconds, rows, None if value is None else str(value))
+
+
+def run_jobs(jobs, sections, workers=WORKERS, host_limits=None):
+    """
+    Run jobs on a pool of "workers" threads - each job once its "after" jobs have finished and its hosts are
+    below their limits.  Jobs after a failed or skipped job are skipped.
+    :param host_limits: HostLimits - default HOST_LIMIT jobs per host
+    :return: list of JobResults in job file order
+    """
+    if host_limits is None:
+        host_limits = HostLimits(HOST_LIMIT, {})
+    hosts = {job.name: job.hosts(sections) for job in jobs}
+    results = {}
+    pending = list(jobs)
+    running = {}
+    run_start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="esextract-job") as pool:
+        while pending or running:
+            for job in list(pending):
+                if any(results.get(a) is not None and results[a].status != "ok" for a in job.after):
+                    esextract.log("Job " + job.name + " skipped - an earlier job failed", level="warning")
+                    results[job.name] = JobResult(job, "skipped")
+                    pending.remove(job)
+                elif (all(a in results for a in job.after) and len(running) < workers
+                      and host_limits.available(hosts[job.name])):
+                    host_limits.take(hosts[job.name])
+                    running[pool.submit(timed_job, job, sections, run_start)] = job
+                    pending.remove(job)
+            if not running:
+                # only skips happened this pass - look again
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                job = running.pop(future)
+                host_limits.release(hosts[job.name])
+                results[job.name] = future.result()
+
+    return [results[job.name] for job in jobs]
+
+
+def print_summary(results):
+    print("")
+    print("job".ljust(24) + "mode".ljust(13) + "status".ljust(9) + "start s".rjust(9) + "seconds".rjust(10)
+          + "rows".rjust(12) + "  value / error")
+    for r in results:
+        print(r.job.name.ljust(24) + r.job.mode.ljust(13) + r.status.ljust(9)
+              + ("" if r.started is None else str(r.started)).rjust(9) + str(round(r.seconds, 2)).rjust(10)
+              + ("" if r.rows is None else str(r.rows)).rjust(12) + "  " + (r.error or r.value or ""))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="esextract.py run",
+                                     description="Run the extract / load jobs of a job file in one process")
+    parser.add_argument('jobfile', help='job file - one section per job, see jobrunner.py')
+    parser.add_argument('-w', '--workers', dest="workers", type=int, default=None
+                        , help='jobs to run at once (default "workers" in the [runner] section, or 4)')
+    parser.add_argument('--summary', dest="summary", default=None, help='also write the job summary to this JSON file')
+    parser.add_argument('--metrics', dest="metrics", default=None
+                        , help='write a JSON summary of per-stage timers and counters for the whole run to this file')
+    args = parser.parse_args(argv)
+
+    runner, jobs = read_jobs(args.jobfile)
+    sections = esextract.getconfig(esextract.CONFIG_PATH)
+    for job in jobs:
+        for section in [job.get("input"), job.get("database")]:
+            if section and section not in sections:
+                raise JobFileError("job " + job.name + ": no section " + section + " in " + esextract.CONFIG_PATH)
+    workers = max(1, int(args.workers or runner.get("workers", WORKERS)))
+    host_limits = HostLimits(*parse_host_limits(runner))
+
+    esextract.log("Job file " + args.jobfile + ": " + str(len(jobs)) + " jobs on " + str(workers) + " workers")
+    start = time.perf_counter()
+    try:
+        results = run_jobs(jobs, sections, workers, host_limits)
+    finally:
+        postgres_db.dispose_engines()
+        # written on failure too
+        if args.metrics:
+            metrics.REGISTRY.write_json(args.metrics)
+    esextract.log("Job file " + args.jobfile + " finished in " + str(round(time.perf_counter() - start, 1)) + "s")
+
+    print_summary(results)
+    if args.summary:
+        with open(args.summary, "w") as f:
+            json.dump([r.as_dict() for r in results], f, indent=2)
+    return 0 if all(r.status == "ok" for r in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,217 @@
+"""
+Run metrics - timers, counters and histograms for each extract / load stage
+
+Stages record into the process-wide registry:
+    with metrics.timer("es_fetch"):
+        page = es.scroll(...)
+    metrics.incr("es_pages")
+    metrics.incr("db_rows", len(values))
+
+At the end of the run the registry is written as a JSON summary and / or a Prometheus text-format file
+(for the node_exporter textfile collector, or to POST to a pushgateway).
+
+ThreadProfiler is cProfile for the whole process.  Before Python 3.12 cProfile only sees the thread that enabled it,
+so each thread started after start() gets its own profiler and all of them are merged into one stats file.  From 3.12
+cProfile is built on sys.monitoring - one profiler sees every thread, and a second one cannot be enabled - so a single
+process-wide profiler is used.
+"""
+
+import cProfile
+import json
+import os
+import pstats
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+PERCENTILES = [50, 90, 99]
+METRIC_PREFIX = "esextract_"
+
+
+class Histogram:
+    """
+    Observed values for one metric - all values are kept (one float per page / batch, so small)
+    """
+    def __init__(self):
+        self.values = []
+
+    def observe(self, value):
+        self.values.append(value)
+
+    def summary(self):
+        values = sorted(self.values)
+        result = {"count": len(values), "sum": round(sum(values), 6)}
+        if values:
+            result["min"] = round(values[0], 6)
+            result["max"] = round(values[-1], 6)
+            for p in PERCENTILES:
+                result["p" + str(p)] = round(percentile(values, p), 6)
+        return result
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    k = (len(sorted_values) - 1) * p / 100.0
+    lower = int(k)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (k - lower)
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}
+        self.histograms = {}
+
+    def incr(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(value)
+
+    @contextmanager
+    def timer(self, name):
+        """
+        Time a block - recorded in the "<name>_seconds" histogram
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name + "_seconds", time.perf_counter() - start)
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.counters = {}
+            self.histograms = {}
+
+    def summary(self):
+        with self.lock:
+            return {"started": self.started,
+                    "elapsed_seconds": round(time.time() - self.started, 3),
+                    "counters": dict(self.counters),
+                    "histograms": {name: h.summary() for name, h in self.histograms.items()}}
+
+    def prometheus_text(self, labels=None):
+        """
+        Prometheus text exposition format - counters as <prefix><name>_total, histograms as summaries
+        """
+        label_str = ""
+        if labels:
+            label_str = ",".join(k + '="' + str(v).replace('"', '\\"') + '"' for k, v in sorted(labels.items()))
+        summary = self.summary()
+        lines = []
+
+        def sample(name, value, extra=None):
+            all_labels = ",".join(l for l in [label_str, extra] if l)
+            if all_labels:
+                lines.append(name + "{" + all_labels + "} " + repr(float(value)))
+            else:
+                lines.append(name + " " + repr(float(value)))
+
+        name = METRIC_PREFIX + "elapsed_seconds"
+        lines.append("# TYPE " + name + " gauge")
+        sample(name, summary["elapsed_seconds"])
+        for counter, value in sorted(summary["counters"].items()):
+            name = METRIC_PREFIX + counter + "_total"
+            lines.append("# TYPE " + name + " counter")
+            sample(name, value)
+        for histogram, h in sorted(summary["histograms"].items()):
+            name = METRIC_PREFIX + histogram
+            lines.append("# TYPE " + name + " summary")
+            for p in PERCENTILES:
+                if "p" + str(p) in h:
+                    sample(name, h["p" + str(p)], 'quantile="' + str(p / 100.0) + '"')
+            sample(name + "_sum", h["sum"])
+            sample(name + "_count", h["count"])
+        return "\n".join(lines) + "\n"
+
+    def write_json(self, path):
+        _write_atomic(path, json.dumps(self.summary(), indent=2))
+
+    def write_prometheus(self, path, labels=None):
+        _write_atomic(path, self.prometheus_text(labels))
+
+
+def _write_atomic(path, text):
+    # textfile collectors may read at any time - never let them see a partial file
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".metrics_")
+    with os.fdopen(fd, "w") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+class ThreadProfiler:
+    """
+    cProfile of the main thread and of every thread started while it runs (fetch / load workers, pipeline stages)
+    per_thread - one profiler per thread (Python < 3.12), else one process-wide profiler
+    """
+    def __init__(self):
+        self.main = cProfile.Profile()
+        self.profilers = []
+        self.lock = threading.Lock()
+        self.per_thread = sys.version_info < (3, 12)
+
+    def _start_thread(self, frame, event, arg):
+        # first profile event in a new thread - swap this hook for the thread's own profiler
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # another profiling tool is active - leave this thread unprofiled rather than fail it
+            return
+        with self.lock:
+            self.profilers.append(profiler)
+
+    def start(self):
+        if self.per_thread:
+            threading.setprofile(self._start_thread)
+        self.main.enable()
+
+    def stop(self, path):
+        """
+        Stop profiling and dump the merged stats (view with python -m pstats)
+        """
+        self.main.disable()
+        if self.per_thread:
+            threading.setprofile(None)
+        stats = pstats.Stats(self.main)
+        with self.lock:
+            profilers = list(self.profilers)
+        for profiler in profilers:
+            try:
+                stats.add(profiler)
+            except TypeError:
+                # a thread that made no calls has no stats
+                pass
+        stats.dump_stats(path)
+
+
+# process-wide registry
+REGISTRY = Metrics()
+
+
+def incr(name, value=1):
+    REGISTRY.incr(name, value)
+
+
+def observe(name, value):
+    REGISTRY.observe(name, value)
+
+
+def timer(name):
+    return REGISTRY.timer(name)
+
+
+def summary():
+    return REGISTRY.summary()
@@ -0,0 +1,168 @@
+"""
+Streaming extract-transform-load pipeline
+
+Fetch (ES scroll pages), transform (Pandas DataFrame build) and load (database / CSV / terminal writes)
+run as concurrent stages connected by bounded queues, so the network and the database are busy at the same time.
+A full queue blocks the stage feeding it (backpressure) - at most queuesize pages are held between two stages.
+"""
+
+import queue
+import threading
+import time
+
+import esextract
+
+QUEUE_SIZE = 4
+QUEUE_POLL = 0.5  # seconds between checks for a failed stage while blocked on a queue
+
+_DONE = object()  # end-of-stream marker passed down the queues
+
+
+class StageStats:
+    """
+    Throughput counters for one pipeline stage
+    """
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.rows = 0
+        self.busy = 0.0   # seconds spent doing work
+        self.wait = 0.0   # seconds blocked on an empty input / full output queue
+        self.lock = threading.Lock()
+
+    def record(self, rows, busy):
+        with self.lock:
+            self.items = self.items + 1
+            self.rows = self.rows + rows
+            self.busy = self.busy + busy
+
+    def add_wait(self, wait):
+        with self.lock:
+            self.wait = self.wait + wait
+
+    def rows_per_sec(self):
+        if self.busy > 0:
+            return self.rows / self.busy
+        return 0.0
+
+    def summary(self):
+        return ("   Stage " + self.name.ljust(9) + " pages:" + str(self.items) + " rows:" + str(self.rows)
+                + " busy:" + str(round(self.busy, 2)) + "s wait:" + str(round(self.wait, 2)) + "s"
+                + " rows/sec(busy):" + str(round(self.rows_per_sec())))
+
+
+class Pipeline:
+    """
+    Run fetch -> transform -> load as threads connected by bounded queues.
+    :param fetchers: list of iterables producing pages (lists of records) - one fetch thread per iterable
+    :param transform: fn(page) -> DataFrame
+    :param load: fn(DataFrame) -> None
+    :param queue_size: max pages buffered between two stages
+    """
+    def __init__(self, fetchers, transform, load, queue_size=QUEUE_SIZE):
+        self.fetchers = fetchers
+        self.transform = transform
+        self.load = load
+        self.fetch_q = queue.Queue(maxsize=int(queue_size))
+        self.load_q = queue.Queue(maxsize=int(queue_size))
+        self.stop = threading.Event()
+        self.errors = []
+        self.stats = {"fetch": StageStats("fetch"), "transform": StageStats("transform"), "load": StageStats("load")}
+
+    def _put(self, q, item, stats):
+        start = time.time()
+        while not self.stop.is_set():
+            try:
+                q.put(item, timeout=QUEUE_POLL)
+                break
+            except queue.Full:
+                pass
+        stats.add_wait(time.time() - start)
+
+    def _get(self, q, stats):
+        start = time.time()
+        item = _DONE
+        while not self.stop.is_set():
+            try:
+                item = q.get(timeout=QUEUE_POLL)
+                break
+            except queue.Empty:
+                pass
+        stats.add_wait(time.time() - start)
+        return item
+
+    def _fail(self, e):
+        self.errors.append(e)
+        self.stop.set()
+
+    def _fetch(self, fetcher):
+        stats = self.stats["fetch"]
+        try:
+            pages = iter(fetcher)
+            while not self.stop.is_set():
+                start = time.time()
+                try:
+                    page = next(pages)
+                except StopIteration:
+                    break
+                stats.record(len(page), time.time() - start)
+                self._put(self.fetch_q, page, stats)
+        except Exception as e:
+            self._fail(e)
+
+    def _transform(self):
+        stats = self.stats["transform"]
+        try:
+            while not self.stop.is_set():
+                page = self._get(self.fetch_q, stats)
+                if page is _DONE:
+                    break
+                start = time.time()
+                data = self.transform(page)
+                stats.record(len(data), time.time() - start)
+                self._put(self.load_q, data, stats)
+        except Exception as e:
+            self._fail(e)
+        self._put(self.load_q, _DONE, stats)
+
+    def _load(self):
+        stats = self.stats["load"]
+        try:
+            while not self.stop.is_set():
+                data = self._get(self.load_q, stats)
+                if data is _DONE:
+                    break
+                start = time.time()
+                self.load(data)
+                stats.record(len(data), time.time() - start)
+        except Exception as e:
+            self._fail(e)
+
+    def run(self):
+        """
+        Run the pipeline to completion
+        :return: number of rows loaded
+        """
+        start = time.time()
+        fetch_threads = [threading.Thread(target=self._fetch, args=(f,), name="fetch-" + str(i), daemon=True)
+                         for i, f in enumerate(self.fetchers)]
+        transform_thread = threading.Thread(target=self._transform, name="transform", daemon=True)
+        load_thread = threading.Thread(target=self._load, name="load", daemon=True)
+
+        for t in fetch_threads + [transform_thread, load_thread]:
+            t.start()
+        for t in fetch_threads:
+            t.join()
+        # all fetchers finished - tell the transform stage no more pages are coming
+        self._put(self.fetch_q, _DONE, self.stats["fetch"])
+        transform_thread.join()
+        load_thread.join()
+
+        esextract.log("Pipeline complete in " + str(round(time.time() - start, 2)) + "s")
+        for stats in self.stats.values():
+            esextract.log(stats.summary())
+
+        if self.errors:
+            esextract.log("Pipeline stage failed: " + str(self.errors[0]), level="error")
+            raise self.errors[0]
+        return self.stats["load"].rows
@@ -0,0 +1,181 @@
+"""
+Range sharding planner - split a -r range into sub-ranges that are extracted in parallel
+
+    -r 1541680814#1542967602 --shards 8
+
+Methods:
+    docs   (default) - cut points from a percentiles pre-query on the range field, so each shard holds about the
+                       same number of docs however bursty the data
+    width            - equal-width sub-ranges between the start and the end (the max value of the range field when
+                       the range has no end)
+
+Range values are epoch numbers or ISO 8601 timestamps.  Shard edges never lose or repeat a doc: the first shard
+keeps the lower operator of the requested range (gt, or gte with -e), every edge between two shards is
+[gte cut, lt next cut), and the last shard keeps the upper operator (lt, or lte with -e) - or stays open ended
+when the range has no end, so docs arriving during the extract are still read.  Ranges that cannot be split
+(date math such as now-1d, too few docs) are run as a single shard.
+"""
+
+import datetime
+import re
+
+import esextract
+import metrics
+
+METHODS = ["docs", "width"]
+PLAN_AGG = "esextract_plan"
+EPOCH_NUMBER = re.compile(r"^-?[0-9]+(\.[0-9]+)?$")
+
+
+class ShardPlanError(Exception):
+    pass
+
+
+class Shard:
+    """
+    :param start: lower bound, as sent to ES
+    :param end: upper bound, None for open ended
+    :param lower_op: gt / gte
+    :param upper_op: lt / lte
+    """
+    def __init__(self, start, end, lower_op, upper_op):
+        self.start = start
+        self.end = end
+        self.lower_op = lower_op
+        self.upper_op = upper_op
+
+    def label(self):
+        label = self.lower_op + " " + str(self.start)
+        if self.end is not None:
+            label = label + " " + self.upper_op + " " + str(self.end)
+        return label
+
+    def as_list(self):
+        return [self.start, self.end, self.lower_op, self.upper_op]
+
+    def __repr__(self):
+        return "Shard(" + self.label() + ")"
+
+
+def parse_value(value):
+    """
+    Range value -> (number, kind): epoch numbers as they are ("epoch"), ISO timestamps as epoch seconds ("iso").
+    None if the value cannot be split (EG date math)
+    """
+    value = str(value)
+    if EPOCH_NUMBER.match(value):
+        return float(value), "epoch"
+    try:
+        stamp = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if stamp.tzinfo is None:
+        stamp = stamp.replace(tzinfo=datetime.timezone.utc)
+    return stamp.timestamp(), "iso"
+
+
+def format_value(number, kind, integer):
+    if kind == "iso":
+        stamp = datetime.datetime.fromtimestamp(number, datetime.timezone.utc)
+        return stamp.strftime("%Y-%m-%dT%H:%M:%S.") + stamp.strftime("%f")[:3] + "Z"
+    if integer:
+        return str(int(number))
+    return repr(float(number))
+
+
+def agg_number(value, kind):
+    # ES reports date field aggregations in epoch milliseconds
+    if value is None:
+        return None
+    return value / 1000.0 if kind == "iso" else value
+
+
+def pre_query(es, indexmask, body, aggs):
+    query = dict(body)
+    query["size"] = 0
+    query["aggs"] = aggs
+    with metrics.timer("es_plan_query"):
+        page = es.search(index=indexmask, body=query,
+                         filter_path=["aggregations." + name + ".value" for name in aggs]
+                                     + ["aggregations." + name + ".values" for name in aggs])
+    return page.get("aggregations", {})
+
+
+def width_cuts(low, high, shards):
+    return [low + (high - low) * i / float(shards) for i in range(1, shards)]
+
+
+def docs_cuts(es, indexmask, body, rangefield, shards, kind):
+    percents = [100.0 * i / shards for i in range(1, shards)]
+    result = pre_query(es, indexmask, body, {PLAN_AGG: {"percentiles": {"field": rangefield, "percents": percents}}})
+    values = result.get(PLAN_AGG, {}).get("values", {})
+    cuts = [agg_number(values.get(str(p)), kind) for p in percents]
+    return [c for c in cuts if c is not None]
+
+
+def max_value(es, indexmask, body, rangefield, kind):
+    result = pre_query(es, indexmask, body, {PLAN_AGG: {"max": {"field": rangefield}}})
+    return agg_number(result.get(PLAN_AGG, {}).get("value"), kind)
+
+
+def shard_ranges(startrange, endrange, cuts, lower_op, upper_op):
+    """
+    Shards from the requested range and the (formatted, increasing) cut points between them
+    """
+    edges = [startrange] + cuts + [endrange]
+    shards = []
+    for i in range(0, len(edges) - 1):
+        shards.append(Shard(edges[i], edges[i + 1],
+                            lower_op if i == 0 else "gte",
+                            upper_op if i == len(edges) - 2 else "lt"))
+    return shards
+
+
+def plan(es, indexmask, body, rangefield, startrange, endrange, shards, method="docs", equality=False):
+    """
+    Split a range extract into shards
+    :param body: search-body of the whole range (build_range_query) - used for the pre-queries
+    :param endrange: None for open ended
+    :param shards: number of shards wanted - fewer are returned if there are not enough distinct cut points
+    :return: list of Shards, in range order
+    """
+    if method not in METHODS:
+        raise ShardPlanError("unknown shard method " + str(method) + " - expected one of " + ",".join(METHODS))
+    lower_op = "gte" if equality else "gt"
+    upper_op = "lte" if equality else "lt"
+    if endrange is not None and str(endrange) == "None":
+        endrange = None
+    single = [Shard(str(startrange), endrange, lower_op, upper_op)]
+
+    shards = int(shards)
+    start = parse_value(startrange)
+    end = parse_value(endrange) if endrange is not None else None
+    if shards < 2 or start is None or (endrange is not None and end is None):
+        esextract.log("Shard plan: range " + str(startrange) + " - " + str(endrange) + " is run as a single shard")
+        return single
+    low, kind = start
+    integer = kind == "epoch" and "." not in str(startrange)
+
+    if method == "docs":
+        cuts = docs_cuts(es, indexmask, body, rangefield, shards, kind)
+    else:
+        high = end[0] if end is not None else max_value(es, indexmask, body, rangefield, kind)
+        cuts = width_cuts(low, high, shards) if high is not None else []
+    if end is not None:
+        integer = integer and "." not in str(endrange)
+
+    # cut points strictly inside the range and strictly increasing once formatted
+    formatted = []
+    last = low
+    for cut in sorted(cuts):
+        value = format_value(cut, kind, integer)
+        number = parse_value(value)[0]
+        if number <= last or (end is not None and number >= end[0]):
+            continue
+        formatted.append(value)
+        last = number
+
+    result = shard_ranges(str(startrange), endrange, formatted, lower_op, upper_op)
+    esextract.log("Shard plan (" + method + "): " + str(len(result)) + " shards - "
+                  + ", ".join("[" + s.label() + "]" for s in result))
+    return result
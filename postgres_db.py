@@ -2,32 +2,98 @@
 Postgres Database Specific Functions
 """
 
-from sqlalchemy import create_engine
+import atexit
+import io
+import threading
 import warnings
 with warnings.catch_warnings():
     warnings.filterwarnings("ignore", category=UserWarning)
     import psycopg2
 import psycopg2
+import psycopg2.extras
 
 import esextract
-import numpy
+import metrics
+
+POOL_SIZE = 5
+POOL_MAX_OVERFLOW = 10
+POOL_RECYCLE = 3600  # seconds before a pooled connection is replaced
+
+# process-wide engine (connection pool) cache - one per database config section
+_ENGINES = {}
+_ENGINES_LOCK = threading.Lock()
+
+# lock_not_available, query_canceled (statement / lock timeout), deadlock_detected, serialization_failure
+RETRYABLE_PGCODES = ["55P03", "57014", "40P01", "40001"]
 
 class ValuesNumpyArrayTypeError(Exception):
     pass
 
-def connection(username, password, host, port, database):
+def is_retryable(e):
+    """
+    True for errors that a smaller / later batch can get past - lock waits, timeouts, deadlocks
+    """
+    return getattr(e, "pgcode", None) in RETRYABLE_PGCODES
+
+def get_engine(pool_key, username, password, host, port, database,
+               pool_size=POOL_SIZE, max_overflow=POOL_MAX_OVERFLOW, pool_recycle=POOL_RECYCLE):
+    """
+    Return the cached SQLAlchemy engine for pool_key, creating it on first use.
+    The engine owns a pool of connections that is reused across scroll pages and operations.
+    """
+    with _ENGINES_LOCK:
+        engine = _ENGINES.get(pool_key)
+        if engine is None:
+            from sqlalchemy import create_engine
+            metrics.incr("db_engines_created")
+            engine = create_engine(
+                'postgresql+psycopg2://' + username + ':' + password + '@' + host + ':' + port + '/' + database,
+                pool_size=int(pool_size), max_overflow=int(max_overflow), pool_recycle=int(pool_recycle),
+                pool_pre_ping=True)
+            _ENGINES[pool_key] = engine
+    return engine
+
+def dispose_engines():
+    """
+    Close all pooled connections - registered to run at exit
+    """
+    with _ENGINES_LOCK:
+        for engine in _ENGINES.values():
+            engine.dispose()
+        _ENGINES.clear()
+
+atexit.register(dispose_engines)
+
+def connection(username, password, host, port, database, pool_key=None,
+               pool_size=POOL_SIZE, max_overflow=POOL_MAX_OVERFLOW, pool_recycle=POOL_RECYCLE):
     """
     Connect to a Postgres Database and pass back a connection
+    The connection is checked out of the pool for pool_key (default: the connect string) - conn.close() returns it
     """
+    if pool_key is None:
+        pool_key = username + '@' + host + ':' + port + '/' + database
 
     try:
-        engine = create_engine(
-            'postgresql+psycopg2://' + username + ':' + password + '@' + host + ':' + port + '/' + database)
+        engine = get_engine(pool_key, username, password, host, port, database, pool_size, max_overflow, pool_recycle)
         conn = engine.raw_connection()
 
     except Exception as e:
-        esextract.log("Postgres Database Connect Error:")
-        esextract.log(str(e))
+        esextract.log("Postgres Database Connect Error:", level="error")
+        esextract.log(str(e), level="error")
+        raise
+
+    return conn
+
+def direct_connection(username, password, host, port, database):
+    """
+    Plain psycopg2 connection, outside the pool - for one-off queries where creating the pool (and importing
+    SQLAlchemy) would cost more than the query.  conn.close() closes it.
+    """
+    try:
+        conn = psycopg2.connect(user=username, password=password, host=host, port=port, dbname=database)
+    except Exception as e:
+        esextract.log("Postgres Database Connect Error:", level="error")
+        esextract.log(str(e), level="error")
         raise
 
     return conn
@@ -41,6 +107,7 @@ def insert_statement(conn, insert_stmt, values_ndarray, slice_start=None, slice_
     :param values_ndarray: values to insert, passed in as numpy ndarry (i.e. Pandas df.values)
     :return:
     """
+    import numpy
     complete = False
 
     if slice_start:
@@ -55,19 +122,199 @@ def insert_statement(conn, insert_stmt, values_ndarray, slice_start=None, slice_
 
     try:
         cur = conn.cursor()
-        psycopg2.extras.execute_batch(cur, insert_stmt, values_ndarray)
-        conn.commit()
+        with metrics.timer("db_insert_commit"):
+            psycopg2.extras.execute_batch(cur, insert_stmt, values_ndarray)
+            conn.commit()
+        metrics.incr("db_commits")
+        metrics.incr("db_rows", len(values_ndarray))
         esextract.log("   Commited " + progress_message)
         complete = True
     except Exception as e:
-        esextract.log("Postgres Database Insert Error:")
-        esextract.log(str(e))
+        metrics.incr("db_errors")
+        esextract.log("Postgres Database Insert Error:", level="error")
+        esextract.log(str(e), level="error")
         raise
     cur.close()
 
 
     return complete
 
+def _copy_quote(text):
+    return '"' + text.replace('"', '""') + '"'
+
+
+def _array_literal(values):
+    """
+    list -> Postgres array literal {"a","b",NULL}
+    """
+    items = []
+    for v in values:
+        if v is None or (isinstance(v, float) and v != v):
+            items.append("NULL")
+        elif isinstance(v, (list, tuple)):
+            items.append(_array_literal(v))
+        else:
+            items.append('"' + _copy_scalar(v).replace("\\", "\\\\").replace('"', '\\"') + '"')
+    return "{" + ",".join(items) + "}"
+
+
+def _copy_number(v):
+    # ints that became float64 (a field missing from some docs) must not be sent as 1.0 to an integer column
+    if v != v:
+        return ""
+    if v.is_integer() and abs(v) < 1e16:
+        return str(int(v))
+    return repr(v)
+
+
+def _copy_scalar(v):
+    if isinstance(v, bool):
+        return "true" if v else "false"
+    if isinstance(v, float):
+        return _copy_number(v)
+    if isinstance(v, dict):
+        import json
+        return json.dumps(v)
+    return str(v)
+
+
+def _copy_value(v):
+    """
+    One value of an object column as a COPY CSV field - NULL is an unquoted empty field, so every other value is
+    quoted (an empty string stays an empty string)
+    """
+    if v is None:
+        return ""
+    if getattr(v, "ndim", 0) > 0:
+        v = v.tolist()
+    if isinstance(v, float):
+        return _copy_number(v)
+    if isinstance(v, (list, tuple)):
+        return _copy_quote(_array_literal(v))
+    try:
+        if v != v:
+            # NaN / NaT
+            return ""
+    except TypeError:
+        # pd.NA has no truth value
+        return ""
+    except ValueError:
+        pass
+    return _copy_quote(_copy_scalar(v))
+
+
+def copy_csv(dataframe):
+    """
+    COPY ... (FORMAT csv) input for a data-frame, formatted per dtype rather than by DataFrame.to_csv:
+    integral floats without ".0", bools as true / false, lists as array literals, dicts as JSON, NULL as an unquoted
+    empty field and every string quoted
+    """
+    import numpy
+    import pandas as pd
+    if len(dataframe) == 0:
+        return ""
+    fields = []
+    for name in dataframe.columns:
+        col = dataframe[name]
+        # nullable extension dtypes (Int64, boolean, string) go through the per-value path
+        kind = col.dtype.kind if isinstance(col.dtype, numpy.dtype) else "O"
+        if kind in "iu":
+            fields.append(col.astype(str))
+        elif kind == "f":
+            fields.append(col.map(_copy_number))
+        elif kind == "b":
+            fields.append(col.map(lambda v: "true" if v else "false"))
+        elif kind == "M":
+            fields.append(col.map(lambda v: "" if pd.isna(v) else v.isoformat()))
+        elif pd.api.types.infer_dtype(col, skipna=True) == "string":
+            text = col.astype(object)
+            fields.append(('"' + text.str.replace('"', '""', regex=False) + '"').where(text.notna(), "").astype(object))
+        else:
+            fields.append(col.astype(object).map(_copy_value))
+    lines = fields[0].str.cat(fields[1:], sep=",") if len(fields) > 1 else fields[0]
+    return "\n".join(lines.tolist()) + "\n"
+
+
+def copy_statement(conn, table_name, columns, dataframe, slice_start=None, slice_end=None, post_statements=None):
+    """
+    Bulk load a data-frame with COPY ... FROM STDIN (CSV format), streamed from an in-memory buffer - no temp file.
+    Much faster than INSERT for large loads.  NaN / None are loaded as NULL - see copy_csv.
+    :param conn: connection
+    :param table_name: target table
+    :param columns: comma separated list of target columns, in data-frame column order
+    :param dataframe: Pandas data-frame to load
+    :param post_statements: statements to run after the COPY, in the same transaction
+    :return: True if the COPY committed
+    """
+    complete = False
+
+    if slice_start is not None:
+        progress_message = str(slice_start) + ":" + str(slice_end)
+    else:
+        progress_message = ""
+
+    buffer = io.StringIO(copy_csv(dataframe))
+
+    copy_stmt = "COPY {} ({}) FROM STDIN WITH (FORMAT csv)".format(table_name, columns)
+    try:
+        cur = conn.cursor()
+        with metrics.timer("db_copy_commit"):
+            cur.copy_expert(copy_stmt, buffer)
+            for stmt in post_statements or []:
+                cur.execute(stmt)
+            conn.commit()
+        metrics.incr("db_commits")
+        metrics.incr("db_rows", len(dataframe))
+        metrics.incr("db_copy_bytes", buffer.tell())
+        esextract.log("   Commited (COPY) " + progress_message)
+        complete = True
+    except Exception as e:
+        conn.rollback()
+        metrics.incr("db_errors")
+        esextract.log("Postgres Database COPY Error:", level="error")
+        esextract.log(str(e), level="error")
+        raise
+    finally:
+        buffer.close()
+    cur.close()
+
+    return complete
+
+def insert_rows_isolate_errors(conn, insert_stmt, values_ndarray):
+    """
+    Row-by-row insert in a single transaction with a savepoint per row, so bad rows are skipped and the rest load.
+    Used to isolate the bad rows after a failed COPY batch - slow, only for the failed batch.
+    :param conn:
+    :param insert_stmt: statement to execute
+    :param values_ndarray: values to insert, passed in as numpy ndarry (i.e. Pandas df.values)
+    :return: list of positions (in values_ndarray) of the rows that failed to insert
+    """
+    failed = []
+    metrics.incr("db_retries")
+    cur = conn.cursor()
+    try:
+        for i, row in enumerate(values_ndarray):
+            cur.execute("SAVEPOINT insert_row")
+            try:
+                cur.execute(insert_stmt, tuple(row))
+                cur.execute("RELEASE SAVEPOINT insert_row")
+            except psycopg2.Error as e:
+                cur.execute("ROLLBACK TO SAVEPOINT insert_row")
+                esextract.log("   Rejected row " + str(i) + ": " + str(e).strip())
+                failed.append(i)
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        esextract.log("Postgres Database Insert Error:", level="error")
+        esextract.log(str(e), level="error")
+        raise
+    cur.close()
+    metrics.incr("db_commits")
+    metrics.incr("db_rows", len(values_ndarray) - len(failed))
+    metrics.incr("db_rejected_rows", len(failed))
+    esextract.log("   Commited " + str(len(values_ndarray) - len(failed)) + " rows, rejected " + str(len(failed)))
+    return failed
+
 def select_statement(conn, select_stmt,logPrintFlag):
     """
 
@@ -82,8 +329,8 @@ def select_statement(conn, select_stmt,logPrintFlag):
         cur.execute(select_stmt)
         records = cur.fetchall()
     except Exception as e:
-        esextract.log("Postgres Database Query Error:")
-        esextract.log(str(e))
+        esextract.log("Postgres Database Query Error:", level="error")
+        esextract.log(str(e), level="error")
         raise
 
     esextract.log("    Complete", logPrintFlag)
@@ -92,6 +339,19 @@ def select_statement(conn, select_stmt,logPrintFlag):
     cur.close()
     return(result)
 
+def table_columns(conn, table_name):
+    """
+    Column names of a table, in table order
+    """
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT * FROM {} WHERE false".format(table_name))
+        columns = [d[0] for d in cur.description]
+    finally:
+        cur.close()
+    conn.rollback()
+    return columns
+
 def insert_merge_statement(conn, merge_stmt, logPrintFlag):
     """
     Simple merge operation.  JUst insert from source into target table for all rows not in target
@@ -109,12 +369,33 @@ def insert_merge_statement(conn, merge_stmt, logPrintFlag):
         rowcount = cur.rowcount
         conn.commit()
     except Exception as e:
-        esextract.log("Postgres Database Error:")
-        esextract.log(str(e))
+        esextract.log("Postgres Database Error:", level="error")
+        esextract.log(str(e), level="error")
         raise
     cur.close()
     return rowcount
 
+def execute_statements(conn, statements, logPrintFlag=False):
+    """
+    Run a list of statements in a single transaction - all commit or none do
+    :return: list of rowcounts, one per statement
+    """
+    rowcounts = []
+    try:
+        cur = conn.cursor()
+        for stmt in statements:
+            esextract.log("    " + stmt, logPrintFlag)
+            cur.execute(stmt)
+            rowcounts.append(cur.rowcount)
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        esextract.log("Postgres Database Error:", level="error")
+        esextract.log(str(e), level="error")
+        raise
+    cur.close()
+    return rowcounts
+
 def delete_statement(conn, delete_stmt, logPrintFlag):
     rowcount = 0
     try:
@@ -125,8 +406,8 @@ def delete_statement(conn, delete_stmt, logPrintFlag):
         rowcount = cur.rowcount
         conn.commit()
     except Exception as e:
-        esextract.log("Postgres Database Error:")
-        esextract.log(str(e))
+        esextract.log("Postgres Database Error:", level="error")
+        esextract.log(str(e), level="error")
         raise
     cur.close()
     return rowcount
\ No newline at end of file
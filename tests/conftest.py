@@ -0,0 +1,33 @@
+"""
+Shared test setup - the repo modules are flat at the top level, and esextract reads CONFIG_PATH / LOG_ROOT when it
+is imported, so both are pointed at a scratch directory before any test module imports it.
+No live ElasticSearch or Postgres is needed: ES tests run against bench/fake_es.py.
+"""
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_SCRATCH = tempfile.mkdtemp(prefix="esextract_tests_")
+os.makedirs(os.path.join(_SCRATCH, "log"), exist_ok=True)
+os.environ.setdefault("LOG_ROOT", os.path.join(_SCRATCH, "log"))
+os.environ.setdefault("CONFIG_PATH", os.path.join(_SCRATCH, "esextract.conf"))
+
+
+@pytest.fixture(scope="session")
+def fake_es():
+    from bench.fake_es import FakeElasticsearch
+    server = FakeElasticsearch(docs_per_index=2000, indices=2).start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture(scope="session")
+def es_params(fake_es):
+    return {"class": "elasticsearch", "elasticsearchhost": "127.0.0.1", "elasticsearchport": str(fake_es.port),
+            "indexmask": "filebeat*", "querylimit": "1000"}
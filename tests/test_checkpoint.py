@@ -0,0 +1,136 @@
+import json
+import os
+import threading
+
+import pytest
+
+import checkpoint
+import esextract
+from bench.fake_es import end_time
+from conftest import ROOT
+
+
+def test_checkpoint_key():
+    assert checkpoint.checkpoint_key("ES", "DB", "endTime") == "ES|DB|endTime"
+    assert checkpoint.checkpoint_key("ES", "DB", "endTime", "jobStatus", "EXIT") == "ES|DB|endTime|jobStatus=EXIT"
+
+
+def test_save_load_round_trip(tmp_path):
+    store = checkpoint.CheckpointStore(str(tmp_path / "cp.json"))
+    assert store.load("a") is None
+    store.save("a", 1541680814, {"id1", "id2"}, 500, [1541680814, "id2"])
+    store.save("b", "2018-11-08T00:00:00Z")
+
+    reopened = checkpoint.CheckpointStore(str(tmp_path / "cp.json"))
+    record = reopened.load("a")
+    assert record["value"] == 1541680814
+    assert sorted(record["boundary_ids"]) == ["id1", "id2"]
+    assert (record["rows"], record["search_after"]) == (500, [1541680814, "id2"])
+    assert reopened.load("b")["boundary_ids"] == []
+
+    reopened.delete(["a", "missing"])
+    assert reopened.load("a") is None
+    assert reopened.load("b")["value"] == "2018-11-08T00:00:00Z"
+
+
+def test_failed_save_keeps_the_old_checkpoint(tmp_path, monkeypatch):
+    path = tmp_path / "cp.json"
+    store = checkpoint.CheckpointStore(str(path))
+    store.save("a", 1)
+
+    def broken_dump(obj, f, **kwargs):
+        f.write('{"a": {"val')
+        raise IOError("disk full")
+    monkeypatch.setattr(checkpoint.json, "dump", broken_dump)
+    with pytest.raises(IOError):
+        store.save("a", 2)
+    monkeypatch.undo()
+
+    assert store.load("a")["value"] == 1
+    assert os.listdir(str(tmp_path)) == ["cp.json"]
+
+
+def test_unreadable_checkpoint_file(tmp_path):
+    path = tmp_path / "cp.json"
+    path.write_text("{not json")
+    with pytest.raises(checkpoint.CheckpointFileError):
+        checkpoint.CheckpointStore(str(path)).load("a")
+
+
+def test_concurrent_saves(tmp_path):
+    store = checkpoint.get_store(str(tmp_path / "cp.json"))
+    assert checkpoint.get_store(os.path.relpath(str(tmp_path / "cp.json"))) is store
+
+    def save(n):
+        for i in range(20):
+            store.save("key" + str(n), i)
+    threads = [threading.Thread(target=save, args=(n,)) for n in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    with open(str(tmp_path / "cp.json")) as f:
+        saved = json.load(f)
+    assert {k: v["value"] for k, v in saved.items()} == {"key" + str(n): 19 for n in range(8)}
+
+
+class RecordingWriter:
+    """
+    Stand-in for esextract.DataFrameWriter - keeps the written frames, and can fail on a given write
+    """
+    fail_on = None
+    frames = []
+
+    def __init__(self, *args, **kwargs):
+        self.writes = 0
+
+    def write(self, data):
+        self.writes = self.writes + 1
+        if self.writes == RecordingWriter.fail_on:
+            raise RuntimeError("load failed")
+        RecordingWriter.frames.append(data)
+
+    def close(self, completed=True):
+        pass
+
+
+@pytest.fixture
+def incremental_source(fake_es, tmp_path, monkeypatch):
+    with open(esextract.CONFIG_PATH, "w") as f:
+        f.write("[ES]\nclass: elasticsearch\nelasticsearchhost: 127.0.0.1\nelasticsearchport: " + str(fake_es.port)
+                + "\nindexmask: filebeat*\nquerylimit: 500\n")
+    monkeypatch.setattr(esextract, "CHECKPOINT_PATH", str(tmp_path / "cp.json"))
+    monkeypatch.setattr(esextract, "DataFrameWriter", RecordingWriter)
+    RecordingWriter.frames = []
+    RecordingWriter.fail_on = None
+    return os.path.join(ROOT, "conf", "cols.conf")
+
+
+def extract(cols_file, startrange, endrange=None, equality=False):
+    return esextract.extract_incremental("ES", None, None, "endTime", startrange, endrange, cols_file=cols_file,
+                                         csvfile="out.csv", equality=equality)
+
+
+def loaded_ids():
+    return [i for frame in RecordingWriter.frames for i in frame["jobID"].tolist()]
+
+
+def test_incremental_resume_after_a_failed_page(incremental_source):
+    start = end_time(0, 0)
+    RecordingWriter.fail_on = 3
+    with pytest.raises(RuntimeError):
+        extract(incremental_source, start, equality=True)
+    assert len(loaded_ids()) == 1000
+
+    # the resumed run re-reads from the checkpoint value, skipping the docs committed there
+    RecordingWriter.fail_on = None
+    extract(incremental_source, start, equality=True)
+    ids = loaded_ids()
+    assert len(ids) == len(set(ids)) == 4000
+
+
+def test_incremental_first_run_operators(incremental_source):
+    start = end_time(0, 0)
+    extract(incremental_source, start, end_time(10, 0))
+    # gt / lt by default - the docs at the start value are not read
+    assert sorted(loaded_ids()) == [p for p in range(1, 10)] + [10000000 + p for p in range(0, 10)]
@@ -0,0 +1,118 @@
+import numpy
+import pandas as pd
+import pytest
+
+import dedupe
+import esextract
+
+
+def seen_set(backend, tmp_path):
+    if backend == "memory":
+        return dedupe.MemorySeenSet()
+    if backend == "disk":
+        return dedupe.DiskSeenSet(str(tmp_path / "seen.sqlite"))
+    return dedupe.BloomSeenSet(capacity=100000, error_rate=1e-9)
+
+
+def random_hashes(n, seed):
+    return numpy.random.default_rng(seed).integers(0, 2 ** 64 - 1, size=n, dtype=numpy.uint64)
+
+
+@pytest.mark.parametrize("backend", dedupe.BACKENDS)
+def test_seen_set_contains_added(backend, tmp_path):
+    seen = seen_set(backend, tmp_path)
+    added = random_hashes(3000, 1)
+    others = random_hashes(3000, 2)
+    assert not seen.contains(added).any()
+    for page in numpy.array_split(added, 7):
+        seen.add(page)
+    assert seen.contains(added).all()
+    assert not seen.contains(others).any()
+    assert len(seen.contains(added[:0])) == 0
+    seen.close()
+
+
+def test_disk_seen_set_removes_file(tmp_path):
+    path = tmp_path / "seen.sqlite"
+    seen = dedupe.DiskSeenSet(str(path))
+    seen.add(random_hashes(10, 3))
+    assert path.exists()
+    seen.close()
+    assert not path.exists()
+
+
+def test_memory_runs_merge_like_a_binary_counter():
+    seen = dedupe.MemorySeenSet()
+    hashes = random_hashes(11, 4)
+    for i, h in enumerate(hashes, start=1):
+        seen.add(hashes[i - 1:i])
+        # equal sized runs are merged - run lengths are the set bits of the row count, largest first
+        assert [len(r) for r in seen.runs] == [b for b in (8, 4, 2, 1) if i & b]
+    for run in seen.runs:
+        assert (numpy.diff(run.astype(object)) > 0).all()
+    assert seen.contains(hashes).all()
+
+
+def test_memory_runs_match_a_set():
+    seen = dedupe.MemorySeenSet()
+    expected = set()
+    rng = numpy.random.default_rng(5)
+    for page in range(40):
+        # pages overlap earlier ones, and page sizes vary so runs merge at different points
+        hashes = rng.integers(0, 5000, size=int(rng.integers(1, 400)), dtype=numpy.uint64)
+        found = seen.contains(hashes)
+        assert found.tolist() == [int(h) in expected for h in hashes]
+        new = numpy.unique(hashes[~found])
+        seen.add(new)
+        expected.update(int(h) for h in new)
+        assert len(seen.runs) <= max(1, int(numpy.log2(len(expected))) + 1)
+    assert sum(len(r) for r in seen.runs) == len(expected)
+
+
+@pytest.mark.parametrize("backend", dedupe.BACKENDS)
+def test_deduplicator_across_pages(backend, tmp_path):
+    deduper = dedupe.Deduplicator(backend=backend, path=str(tmp_path / "seen.sqlite"))
+    first = pd.DataFrame({"jobID": [1, 2, 2, 3], "endTime": [10, 20, 20, 30]})
+    second = pd.DataFrame({"jobID": [3, 4], "endTime": [30, 40]})
+    kept, dropped = deduper.drop_duplicates(first)
+    assert kept["jobID"].tolist() == [1, 2, 3]
+    assert dropped["jobID"].tolist() == [2]
+    kept, dropped = deduper.drop_duplicates(second)
+    assert kept["jobID"].tolist() == [4]
+    assert (deduper.rows, deduper.dropped) == (6, 2)
+    deduper.close()
+
+
+def test_deduplicator_keys_and_nested_values():
+    deduper = dedupe.Deduplicator(keys=["jobID"])
+    data = pd.DataFrame({"jobID": [1, 1, 2], "execHosts": [["a"], ["b"], ["a", "b"]]})
+    kept, dropped = deduper.drop_duplicates(data)
+    assert kept["jobID"].tolist() == [1, 2]
+    with pytest.raises(dedupe.DedupeConfigError):
+        deduper.drop_duplicates(pd.DataFrame({"other": [1]}))
+
+    everything = dedupe.Deduplicator()
+    kept, dropped = everything.drop_duplicates(data)
+    assert len(kept) == 3
+
+
+def test_from_config():
+    assert dedupe.from_config({"dedupe": "none"}) is None
+    deduper = dedupe.from_config({"dedupekeys": "jobID, endTime"})
+    assert (deduper.backend, deduper.keys) == ("memory", ["jobID", "endTime"])
+    with pytest.raises(dedupe.DedupeConfigError):
+        dedupe.from_config({"dedupe": "bogus"})
+    with pytest.raises(dedupe.DedupeConfigError):
+        dedupe.from_config({"dedupe": "disk"})
+
+
+def test_disk_deduplicators_do_not_share_a_file():
+    # concurrent extracts in one process (jobrunner jobs) each need their own seen-set
+    first = esextract.get_deduplicator({"dedupe": "disk"})
+    second = esextract.get_deduplicator({"dedupe": "disk"})
+    assert first.seen.path != second.seen.path
+    data = pd.DataFrame({"jobID": [1, 2, 3]})
+    assert len(first.drop_duplicates(data)[0]) == 3
+    assert len(second.drop_duplicates(data)[0]) == 3
+    first.close()
+    second.close()
@@ -0,0 +1,86 @@
+import pandas as pd
+import pytest
+
+import esextract
+import postgres_db
+
+COLUMNS = ["jobid", "endtime", "username"]
+
+
+def test_merge_except():
+    assert esextract.merge_statement("target", "staging", COLUMNS) == \
+        "INSERT INTO target SELECT * FROM staging EXCEPT SELECT * FROM target"
+
+
+def test_merge_range():
+    in_range = "t.endtime >= (SELECT MIN(endtime) FROM staging) AND t.endtime <= (SELECT MAX(endtime) FROM staging)"
+    assert esextract.merge_statement("target", "staging", COLUMNS, "range", range_key="endtime") == \
+        "INSERT INTO target SELECT * FROM staging EXCEPT SELECT t.* FROM target t WHERE " + in_range
+    assert esextract.merge_statement("target", "staging", COLUMNS, "range", ["jobid", "endtime"], "endtime") == \
+        ("INSERT INTO target SELECT DISTINCT s.* FROM staging s WHERE NOT EXISTS "
+         "(SELECT 1 FROM target t WHERE t.jobid = s.jobid AND t.endtime = s.endtime AND " + in_range + ")")
+
+
+def test_merge_nothing():
+    assert esextract.merge_statement("target", "staging", COLUMNS, "nothing", ["jobid"]) == \
+        "INSERT INTO target SELECT DISTINCT ON (jobid) * FROM staging ON CONFLICT (jobid) DO NOTHING"
+
+
+def test_merge_update():
+    assert esextract.merge_statement("target", "staging", COLUMNS, "UPDATE", ["jobid", "endtime"]) == \
+        ("INSERT INTO target SELECT DISTINCT ON (jobid,endtime) * FROM staging ON CONFLICT (jobid,endtime) "
+         "DO UPDATE SET username = EXCLUDED.username")
+    # nothing left to update when every column is a key
+    assert esextract.merge_statement("target", "staging", ["jobid"], "update", ["jobid"]).endswith(
+        "ON CONFLICT (jobid) DO NOTHING")
+
+
+@pytest.mark.parametrize("strategy, keys, range_key", [("bogus", None, None), ("nothing", None, None),
+                                                       ("update", [], None), ("range", ["jobid"], None)])
+def test_merge_config_errors(strategy, keys, range_key):
+    with pytest.raises(esextract.MergeConfigError):
+        esextract.merge_statement("target", "staging", COLUMNS, strategy, keys, range_key)
+
+
+def test_split_keys():
+    assert esextract.split_keys(None) == []
+    assert esextract.split_keys(" jobID , @timestamp,") == ["jobID", "timestamp"]
+
+
+class FakeConn:
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def database(monkeypatch):
+    params = {"type": "postgres", "table": "staging", "dbusername": "u", "dbhost": "h", "dbport": "1",
+              "database": "x"}
+    monkeypatch.setattr(esextract, "get_database_credentials", lambda database_conf: (params, "pwd"))
+    monkeypatch.setattr(esextract, "get_database_conn", lambda database_conf, pooled=True:
+                        (FakeConn(), "postgres", "staging"))
+    return params
+
+
+def test_merge_on_db_uses_the_config_strategy(database, monkeypatch):
+    database.update({"mergestrategy": "update", "mergekey": "jobID"})
+    statements = []
+    monkeypatch.setattr(postgres_db, "table_columns", lambda conn, table_name: COLUMNS)
+    monkeypatch.setattr(postgres_db, "insert_merge_statement",
+                        lambda conn, stmt, logPrintFlag=False: statements.append(stmt) or 7)
+    assert esextract.merge_on_db("target", "DB") == 7
+    assert statements == [esextract.merge_statement("target", "staging", COLUMNS, "update", ["jobID"])]
+
+
+def test_upsert_keys_must_be_in_the_data(database, monkeypatch):
+    database.update({"upsertkey": "jobID,endTime"})
+    loads = []
+    monkeypatch.setattr(esextract, "load_rows", lambda data, database_conf, **kwargs: loads.append(data))
+    with pytest.raises(esextract.MergeConfigError, match="endTime"):
+        esextract.dataframe_to_db(pd.DataFrame({"jobID": [1]}), "DB", upsert=True)
+    assert loads == []
+
+    # keys are matched with "@" stripped, and rows are de-duplicated on the whole key
+    data = pd.DataFrame({"jobID": [1, 1, 1], "@endTime": [10, 10, 20], "queue": ["a", "b", "c"]})
+    esextract.dataframe_to_db(data, "DB", upsert=True)
+    assert loads[0]["queue"].tolist() == ["b", "c"]
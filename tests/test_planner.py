@@ -0,0 +1,84 @@
+import pytest
+
+import elasticsearch_nosql
+import planner
+from bench.fake_es import end_time
+
+
+def contains(shard, value):
+    low = value > float(shard.start) if shard.lower_op == "gt" else value >= float(shard.start)
+    if shard.end is None:
+        return low
+    return low and (value < float(shard.end) if shard.upper_op == "lt" else value <= float(shard.end))
+
+
+def test_shard_ranges_operators():
+    shards = planner.shard_ranges("0", "100", ["25", "50", "75"], "gt", "lt")
+    assert [s.as_list() for s in shards] == [["0", "25", "gt", "lt"],
+                                             ["25", "50", "gte", "lt"],
+                                             ["50", "75", "gte", "lt"],
+                                             ["75", "100", "gte", "lt"]]
+
+
+def test_shard_ranges_equality_keeps_outer_operators():
+    shards = planner.shard_ranges("0", "100", ["50"], "gte", "lte")
+    assert [(s.lower_op, s.upper_op) for s in shards] == [("gte", "lt"), ("gte", "lte")]
+
+
+def test_shard_ranges_single():
+    shards = planner.shard_ranges("0", None, [], "gt", "lt")
+    assert [s.as_list() for s in shards] == [["0", None, "gt", "lt"]]
+
+
+def test_plan_width():
+    shards = planner.plan(None, "filebeat*", {}, "endTime", "0", "100", 4, method="width")
+    assert [s.as_list() for s in shards] == [["0", "25", "gt", "lt"],
+                                             ["25", "50", "gte", "lt"],
+                                             ["50", "75", "gte", "lt"],
+                                             ["75", "100", "gte", "lt"]]
+
+
+def test_plan_width_iso():
+    shards = planner.plan(None, "filebeat*", {}, "@timestamp", "2018-11-08T00:00:00Z", "2018-11-10T00:00:00Z", 2,
+                          method="width", equality=True)
+    assert [s.as_list() for s in shards] == [["2018-11-08T00:00:00Z", "2018-11-09T00:00:00.000Z", "gte", "lt"],
+                                             ["2018-11-09T00:00:00.000Z", "2018-11-10T00:00:00Z", "gte", "lte"]]
+
+
+def test_plan_drops_cuts_that_collapse():
+    # 3 integer values cannot be cut 8 ways - only distinct, increasing cuts inside the range are kept
+    shards = planner.plan(None, "filebeat*", {}, "endTime", "0", "3", 8, method="width")
+    assert [s.start for s in shards] == ["0", "1", "2"]
+    assert shards[-1].end == "3"
+
+
+def test_plan_single_shard():
+    for start, end, shards in [("now-1d", None, 4), ("0", "100", 1), ("0", "now", 4)]:
+        result = planner.plan(None, "filebeat*", {}, "endTime", start, end, shards, method="width")
+        assert len(result) == 1
+        assert (result[0].lower_op, result[0].upper_op) == ("gt", "lt")
+
+
+def test_plan_unknown_method():
+    with pytest.raises(planner.ShardPlanError):
+        planner.plan(None, "filebeat*", {}, "endTime", "0", "100", 2, method="bogus")
+
+
+@pytest.mark.parametrize("equality", [False, True])
+def test_plan_docs_covers_every_doc_once(fake_es, es_params, equality):
+    es = elasticsearch_nosql.es_connect(es_params)
+    start, end = end_time(0, 0), end_time(1999, 1)
+    body = elasticsearch_nosql.build_range_query(None, None, "endTime", start, end, equality)
+    shards = planner.plan(es, "filebeat*", body, "endTime", start, end, 4, method="docs", equality=equality)
+    assert len(shards) == 4
+    assert shards[0].lower_op == ("gte" if equality else "gt")
+    assert shards[-1].upper_op == ("lte" if equality else "lt")
+    for before, after in zip(shards, shards[1:]):
+        assert before.end == after.start
+        assert (before.upper_op, after.lower_op) == ("lt", "gte")
+
+    values = [end_time(pos, index_no) for index_no in range(2) for pos in range(2000)]
+    for value in values:
+        owners = [s for s in shards if contains(s, value)]
+        in_range = (start <= value <= end) if equality else (start < value < end)
+        assert len(owners) == (1 if in_range else 0), value